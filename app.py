@@ -1,24 +1,77 @@
+import collections
+import functools
+import hashlib
+import hmac
 import json
 import os
 import time
 import traceback
-import random
-import boto3
-from chalice import Chalice, Response
-from cachetools import TTLCache
-import requests
-from durations import Duration
-from durations.exceptions import ScaleFormatError, InvalidTokenError
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait
+from chalice import Chalice, Response, Rate, CORSConfig
+from chalicelib.breaker import CircuitBreaker, CircuitOpen
+from chalicelib.cache import TieredCache, FRESH, STALE
+from chalicelib.cadence import ScheduleBook, parse_time, schedule_key
+from chalicelib.keys import KeyScheduler, DEFAULT_DAILY_QUOTA, SEARCH_COST
+from chalicelib.metrics import Metrics, NullMetrics, NAMESPACE
+from chalicelib.payload import RendererSet, cache_control, etag_matches
+from chalicelib.query import canonical_params, is_search_key, search_cache_key
+from chalicelib.probe import ProbeState, search_response, probe_key, VIDEOS_COST, MAX_PROBE_IDS
+from chalicelib.record import encode_item, read_item, checked_before
+from chalicelib.registry import ChannelRegistry, InvalidChannel, RegistryConflict
+from chalicelib.singleflight import SingleFlight
+from chalicelib.store import SqliteStore
+from chalicelib.websub import Subscriptions, HUB_URL, SAFETY_INTERVAL, parse_feed, verify_signature, websub_key
 
 
 app = Chalice(app_name='hujjatytproxy')
-CACHE = TTLCache(maxsize=10, ttl=30)
+# boto3, requests and durations are imported where first needed: together they are most of
+# a cold start and a request answered from the cache needs none of them
+HTTP_OK = 200
+LIVE_CACHE_TTL = 60  # a stream that is on stays on for a while, an offline channel may start any moment
+OFFLINE_CACHE_TTL = 30
+CACHE_STALE_WINDOW = 30  # served while one background refresh replaces it
+CACHE_SIZE = 1000  # every registered channel, with room to spare
+SEARCH_CACHE_TTL = 300  # arbitrary /v3/search queries, kept apart so they can't push the channels out
+SEARCH_CACHE_SIZE = 1000
+SEARCH_ITEM_RETENTION = 24 * 3600  # how long a search# item outlives its last write in the table
+DYNAMODB_TTL_ATTRIBUTE = 'expires_at'  # the table's time to live attribute, epoch seconds
 DYNAMODB_IF_STREAM_TTL = 900
 DYNAMODB_IF_NO_STREAM_TTL = 200
 BEFORE_GOING_OFFLINE = 900
 MIN_TIME_BEFORE_UPSTREAM_CHECKS = 200
-MAX_GRACE_PERIOD = 100
-GRACE_PERIOD = random.choice(range(MAX_GRACE_PERIOD))  # this is to for all nodes to not go and query at the same time
+REFRESH_LEASE_SECONDS = 30  # how long one node may hold the right to refresh a channel from youtube
+NODE_ID = uuid.uuid4().hex
+IN_FLIGHT = SingleFlight()
+# conditional requests from the widget need If-None-Match allowed and ETag readable cross-origin
+LIVE_CORS = CORSConfig(allow_origin='*', allow_headers=['If-None-Match'], expose_headers=['ETag'])
+LIVE_DEADLINE = 10  # seconds per /live request, dynamodb included; a channel not settled by then is served stale
+MAX_WORKERS = 8
+POLL_RATE_MINUTES = 1
+WEBSUB_RENEW_HOURS = 1
+LONG_POLL_TIMEOUT = 27  # seconds for the whole /live/wait request, just under API Gateway's 29s limit
+LONG_POLL_INTERVAL = 2  # first pause between reads of the state, doubling up to LONG_POLL_MAX_INTERVAL
+LONG_POLL_MAX_INTERVAL = 8
+TRACE_SAMPLE_RATE = 0.1  # share of requests whose stages are traced; counts and timings cover them all
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+CACHE = TieredCache(LIVE_CACHE_TTL, OFFLINE_CACHE_TTL, CACHE_STALE_WINDOW, maxsize=CACHE_SIZE, submit=EXECUTOR.submit)
+SEARCH_CACHE = TieredCache(
+    SEARCH_CACHE_TTL, SEARCH_CACHE_TTL, CACHE_STALE_WINDOW, maxsize=SEARCH_CACHE_SIZE, submit=EXECUTOR.submit)
+DYNAMODB_BATCH_GET_LIMIT = 100
+DYNAMODB_BATCH_WRITE_LIMIT = 25
+DYNAMODB_BATCH_ATTEMPTS = 3
+DYNAMODB_MAX_ATTEMPTS = 2  # the first try included, a hung table costs 2 read timeouts per call
+YOUTUBE_RETRIES = 2
+# (connect, read) seconds; one call must fit well inside LIVE_DEADLINE
+YOUTUBE_TIMEOUT = (3.05, 5)
+DYNAMODB_TIMEOUT = (1, 2)
+YOUTUBE_SLOW_CALL = 3  # seconds after which a call that did answer still counts against the circuit
+DYNAMODB_SLOW_CALL = 1
+BREAKER_FAILURES = 3
+BREAKER_RESET = 30
+YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
+YOUTUBE_VIDEOS_URL = "https://www.googleapis.com/youtube/v3/videos"
 
 CHANNELS = {
     # "mainhall": "UCSSgKFdC-gRtxIgTrGGqP3g",
@@ -37,25 +90,160 @@ DEFAULT_PARAMS = {
 
 
 def reset_cache():
-    global CACHE
-    CACHE = TTLCache(maxsize=10, ttl=30)
+    CACHE.clear()
+    SEARCH_CACHE.clear()
 
 
 def get_cache():
     return CACHE
 
 
+# the compact summary is worked out once when a result is cached, not on every request
+CachedResult = collections.namedtuple('CachedResult', ['result', 'summary', 'fetched_at'])
+
+
+def summarize(result):
+    items = result.get("items", []) if isinstance(result, dict) else []
+    first = items[0] if items else {}
+    return {
+        "live": bool(items),
+        "videoId": first.get("id", {}).get("videoId"),
+        "title": first.get("snippet", {}).get("title")}
+
+
+def cache_for(key):
+    return SEARCH_CACHE if is_search_key(key) else CACHE
+
+
+def cache_result(channel, result, fetched_at=None, expiry_time=None, next_check=None):
+    live = are_there_videos(result)
+    # never fresh past the next upstream check, nor a forced or sticky video past its stored expiry_time
+    until = min([at for at in (next_check, expiry_time if live else None) if at], default=None)
+    cache_for(channel).put(channel, CachedResult(result, summarize(result), fetched_at or time.time()), live, until)
+
+
+def cached(channel):
+    return cache_for(channel).last_good(channel)
+
+
+def record_tier(channel, tier, outcome):
+    cache_for(channel).record(tier, outcome)
+    METRICS.count("TierLookups", Tier=tier, Outcome=outcome)
+
+
+def stale_info(fetched_at, reason):
+    return f"stale for {int(time.time() - fetched_at)}s: {reason}"
+
+
+def serve_stale(channel, reason):
+    """The last good result for channel while upstreams fail, or None if there never was one."""
+    entry = cache_for(channel).last_good(channel)
+    if entry is None:
+        return None
+    record_tier(channel, 'last good', 'hit')
+    return 200, entry.result, 'stale', stale_info(entry.fetched_at, reason), None
+
+
 def default_expiry(now):
     return now + BEFORE_GOING_OFFLINE
 
 
+def dynamodb_item(channel, result, create_time, last_checked_time, expiry_time=None):
+    if not expiry_time:
+        expiry_time = default_expiry(create_time)
+    item = encode_item(channel, result, create_time, last_checked_time, expiry_time, live_state(result))
+    if is_search_key(channel):
+        # third-party queries are open ended, so dynamodb's time to live deletes the ones nobody repeats
+        item[DYNAMODB_TTL_ATTRIBUTE] = {'N': str(int(last_checked_time + SEARCH_ITEM_RETENTION))}
+    return item
+
+
+def live_state(result):
+    # the change version /live/wait watches: the live video ids, or "offline"
+    items = result.get("items", []) if isinstance(result, dict) else []
+    video_ids = [item.get("id", {}).get("videoId") or "" for item in items]
+    return ",".join(video_ids) if video_ids else "offline"
+
+
+def is_conditional_check_failure(exc):
+    from botocore.exceptions import ClientError
+    return isinstance(exc, ClientError) and exc.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
 class RealYoutubeDynamodb:
-    @classmethod
-    def get_from_dynamodb(cls, channel):
+    """Long-lived YouTube and DynamoDB backend.
+
+    One instance lives for the whole container so the DynamoDB client and the pooled
+    requests Session (and their open connections) are reused across warm invocations.
+    Storage is get_from_dynamodb, batch_get_from_dynamodb, put_to_dynamodb,
+    conditional_put_to_dynamodb, batch_write_to_dynamodb, acquire_refresh_lease and
+    record_key_usage, over items in
+    dynamodb's attribute format; SqliteYoutubeDynamodb answers them from sqlite instead.
+    """
+    def __init__(self, youtube_search_url=YOUTUBE_SEARCH_URL, dynamodb_endpoint_url=None,
+                 youtube_videos_url=YOUTUBE_VIDEOS_URL, youtube_timeout=YOUTUBE_TIMEOUT,
+                 dynamodb_timeout=DYNAMODB_TIMEOUT):
+        self.youtube_search_url = youtube_search_url
+        self.youtube_videos_url = youtube_videos_url
+        self.dynamodb_endpoint_url = dynamodb_endpoint_url
+        self.youtube_timeout = youtube_timeout
+        self.dynamodb_timeout = dynamodb_timeout
+        self.youtube_breaker = CircuitBreaker('youtube', BREAKER_FAILURES, YOUTUBE_SLOW_CALL, BREAKER_RESET)
+        self.dynamodb_breaker = CircuitBreaker('dynamodb', BREAKER_FAILURES, DYNAMODB_SLOW_CALL, BREAKER_RESET)
+        self._client = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config as BotoConfig
+                    self._client = boto3.client(
+                        'dynamodb', endpoint_url=self.dynamodb_endpoint_url,
+                        config=BotoConfig(
+                            max_pool_connections=MAX_WORKERS,
+                            connect_timeout=self.dynamodb_timeout[0],
+                            read_timeout=self.dynamodb_timeout[1],
+                            # max_attempts would count retries only, one more attempt than it says
+                            retries={'total_max_attempts': DYNAMODB_MAX_ATTEMPTS}))
+        return self._client
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    from requests.packages.urllib3.util.retry import Retry
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1, pool_maxsize=MAX_WORKERS,
+                        # a read that timed out is not retried, the circuit breaker deals with a hung api
+                        max_retries=Retry(
+                            total=YOUTUBE_RETRIES, read=0, backoff_factor=0.2,
+                            status_forcelist=(500, 502, 503, 504), raise_on_status=False))
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def call_dynamodb(self, operation, **kwargs):
+        start = time.time()
+        try:
+            # a failed condition is an answer, not dynamodb misbehaving
+            return self.dynamodb_breaker.call(
+                getattr(self.client, operation), expected=is_conditional_check_failure, **kwargs)
+        finally:
+            METRICS.timing("DynamodbLatency", (time.time() - start) * 1000, Operation=operation)
+
+    def get_from_dynamodb(self, channel):
         try:
-            client = boto3.client('dynamodb')
             if 'TABLE' in os.environ:
-                result = client.get_item(Key={'channel': {'S': channel}}, TableName=os.environ['TABLE'])
+                result = self.call_dynamodb('get_item', Key={'channel': {'S': channel}}, TableName=os.environ['TABLE'])
                 if 'Item' in result:
                     return result['Item']
         except Exception as exc:
@@ -63,158 +251,688 @@ class RealYoutubeDynamodb:
             traceback.print_exc()
         return None
 
-    @classmethod
-    def write_to_dynamodb(cls, channel, result, expiry_time=None):
+    def batch_get_from_dynamodb(self, channels):
+        # returns None rather than {} on failure so callers can fall back to get_from_dynamodb
         try:
-            client = boto3.client('dynamodb')
             if 'TABLE' in os.environ:
-                now = time.time()
-                if not expiry_time:
-                    expiry_time = default_expiry(now)
-                result = client.put_item(
-                    Item={
-                        'channel': {'S': channel},
-                        'time': {'N': str(now)},
-                        'last_checked_time': {'N': str(now)},
-                        'expiry_time': {'N': str(expiry_time)},
-                        'result': {'S': json.dumps(result)}},
-                    TableName=os.environ['TABLE'])
+                table = os.environ['TABLE']
+                items = {}
+                channels = list(channels)
+                for start in range(0, len(channels), DYNAMODB_BATCH_GET_LIMIT):
+                    request = {table: {'Keys': [
+                        {'channel': {'S': channel}} for channel in channels[start:start + DYNAMODB_BATCH_GET_LIMIT]]}}
+                    for _attempt in range(DYNAMODB_BATCH_ATTEMPTS):
+                        result = self.call_dynamodb('batch_get_item', RequestItems=request)
+                        for item in result.get('Responses', {}).get(table, []):
+                            items[item['channel']['S']] = item
+                        request = result.get('UnprocessedKeys')
+                        if not request:
+                            break
+                    else:
+                        print(f"Giving up on unprocessed keys from dynamodb: {request}")
+                return items
+        except Exception as exc:
+            print("Exception batch retrieving from dynamodb: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def put_to_dynamodb(self, item):
+        try:
+            if 'TABLE' in os.environ:
+                self.call_dynamodb('put_item', Item=item, TableName=os.environ['TABLE'])
         except Exception as exc:
             print("Exception writing to dynamodb: %s" % (exc,))
             traceback.print_exc()
         return None
 
-    @classmethod
-    def update_dynamodb(cls, channel, result, create_time, expiry_time=None):
+    def conditional_put_to_dynamodb(self, item, revision):
+        """Puts item as `revision` + 1 unless the stored one has moved past `revision`.
+
+        Returns False only when another writer got there first; items written before
+        revisions were kept count as revision 0.
+        """
         try:
-            client = boto3.client('dynamodb')
             if 'TABLE' in os.environ:
-                print(f"Updating dynamodb for {channel} with a current last_checked_time")
-                if not expiry_time:
-                    expiry_time = default_expiry(create_time)
-                result = client.put_item(
-                    Item={
-                        'channel': {'S': channel},
-                        'time': {'N': str(create_time)},
-                        'last_checked_time': {'N': str(time.time())},
-                        'expiry_time': {'N': str(expiry_time)},
-                        'result': {'S': json.dumps(result)}},
-                    TableName=os.environ['TABLE'])
+                condition = {'ConditionExpression': 'attribute_not_exists(#revision)'}
+                if revision:
+                    condition = {
+                        'ConditionExpression': '#revision = :revision',
+                        'ExpressionAttributeValues': {':revision': {'N': str(revision)}}}
+                self.call_dynamodb(
+                    'put_item', Item=dict(item, revision={'N': str(revision + 1)}), TableName=os.environ['TABLE'],
+                    ExpressionAttributeNames={'#revision': 'revision'}, **condition)
         except Exception as exc:
+            if is_conditional_check_failure(exc):
+                return False
             print("Exception writing to dynamodb: %s" % (exc,))
             traceback.print_exc()
+        return True
+
+    def batch_write_to_dynamodb(self, items):
+        try:
+            if 'TABLE' in os.environ:
+                table = os.environ['TABLE']
+                for start in range(0, len(items), DYNAMODB_BATCH_WRITE_LIMIT):
+                    request = {table: [
+                        {'PutRequest': {'Item': item}} for item in items[start:start + DYNAMODB_BATCH_WRITE_LIMIT]]}
+                    for _attempt in range(DYNAMODB_BATCH_ATTEMPTS):
+                        result = self.call_dynamodb('batch_write_item', RequestItems=request)
+                        request = result.get('UnprocessedItems')
+                        if not request:
+                            break
+                    else:
+                        print(f"Giving up on unprocessed items for dynamodb: {request}")
+        except Exception as exc:
+            print("Exception batch writing to dynamodb: %s" % (exc,))
+            traceback.print_exc()
         return None
 
-    @classmethod
-    def request_from_youtube(cls, params, key_origin):
-        r = requests.get("https://www.googleapis.com/youtube/v3/search", params=params)
-        print(f"Youtube API Request for {params.get('channelId')} with key origin {key_origin}")
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        # the lease lives on the channel item and is cleared when the refreshed item is put back,
+        # so it is also refused once the item has been checked since the caller read last_checked_time
+        try:
+            if 'TABLE' in os.environ:
+                now = time.time()
+                condition = 'attribute_not_exists(lease_until) OR lease_until < :now'
+                values = {':owner': {'S': NODE_ID}, ':until': {'N': str(now + lease_seconds)}, ':now': {'N': str(now)}}
+                if last_checked_time is not None:
+                    condition = f'({condition}) AND (attribute_not_exists(last_checked_time) OR last_checked_time < :checked)'
+                    values[':checked'] = {'N': str(checked_before(last_checked_time))}
+                self.call_dynamodb(
+                    'update_item',
+                    TableName=os.environ['TABLE'],
+                    Key={'channel': {'S': channel}},
+                    UpdateExpression='SET lease_owner = :owner, lease_until = :until',
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues=values)
+        except Exception as exc:
+            if is_conditional_check_failure(exc):
+                return False
+            print("Exception acquiring lease from dynamodb: %s" % (exc,))
+            traceback.print_exc()
+        return True
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        try:
+            if 'TABLE' in os.environ:
+                update = 'ADD spent :units, failures :failures'
+                values = {':units': {'N': str(units)}, ':failures': {'N': str(failures)}}
+                if quarantined_until:
+                    update += ' SET quarantined_until = :until'
+                    values[':until'] = {'N': str(quarantined_until)}
+                self.call_dynamodb(
+                    'update_item',
+                    TableName=os.environ['TABLE'],
+                    Key={'channel': {'S': usage_key}},
+                    UpdateExpression=update,
+                    ExpressionAttributeValues=values)
+        except Exception as exc:
+            print("Exception recording api key usage in dynamodb: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def write_to_dynamodb(self, channel, result, expiry_time=None):
+        now = time.time()
+        return self.put_to_dynamodb(dynamodb_item(channel, result, now, now, expiry_time))
+
+    def update_dynamodb(self, channel, result, create_time, expiry_time=None):
+        return self.put_to_dynamodb(dynamodb_item(channel, result, create_time, time.time(), expiry_time))
+
+    def request_from_youtube(self, params, key_origin):
+        return self.get_from_youtube(self.youtube_search_url, params, key_origin)
+
+    def request_videos_from_youtube(self, params, key_origin):
+        return self.get_from_youtube(self.youtube_videos_url, params, key_origin)
+
+    def post_to_hub(self, hub_url, data):
+        r = self.youtube_breaker.call(
+            self.session.post, hub_url, data=data, timeout=self.youtube_timeout,
+            failed=lambda response: response.status_code >= 500)
+        print(f"Websub {data.get('hub.mode')} request for {data.get('hub.topic')} answered {r.status_code}")
+        return r.status_code
+
+    def get_from_youtube(self, url, params, key_origin):
+        r = self.youtube_breaker.call(
+            self.session.get, url, params=params, timeout=self.youtube_timeout,
+            failed=lambda response: response.status_code >= 500)
         try:
             result = r.json()
         except json.decoder.JSONDecodeError:
             result = r.text
-        print(f"Youtube API Response code: {r.status_code} for {params.get('channelId')} with key origin {key_origin}")
         return r.status_code, result
 
 
+class SqliteYoutubeDynamodb(SqliteStore, RealYoutubeDynamodb):
+    """The real youtube side with items in a sqlite database instead of dynamodb.
+
+    For running several workers on one host (`chalice local`, a wsgi server) without a
+    TABLE: they share one cached state, last_checked_time and refresh lease per channel.
+    """
+    def __init__(self, path, **kwargs):
+        RealYoutubeDynamodb.__init__(self, **kwargs)
+        SqliteStore.__init__(self, path, NODE_ID)
+
+
+def storage_backend():
+    if os.environ.get("SQLITE_PATH"):
+        return SqliteYoutubeDynamodb(os.environ["SQLITE_PATH"])
+    return RealYoutubeDynamodb()
+
+
+YOUTUBE_AND_DYNAMODB = storage_backend()
+
+
+class BatchedYoutubeDynamodb:
+    """Serves channel items from one BatchGetItem and coalesces writes into one BatchWriteItem.
+
+    Anything written after flush() (e.g. a channel that missed the /live deadline) goes
+    straight through to the wrapped backend so it is not lost. `videos` holds videos.list
+    answers fetched up front for many channels at once and `unprobed` the ids whose
+    probe failed, see prefetch_probes().
+    """
+    def __init__(self, youtube_and_dynamodb, channels):
+        self.youtube_and_dynamodb = youtube_and_dynamodb
+        self.prefetched = set(channels)
+        self.items = youtube_and_dynamodb.batch_get_from_dynamodb(channels) if channels else {}
+        self.videos = {}
+        self.unprobed = set()
+        self.pending = {}
+        self.flushed = False
+        self.lock = threading.Lock()
+
+    def get_from_dynamodb(self, channel):
+        if self.items is None or channel not in self.prefetched:
+            return self.youtube_and_dynamodb.get_from_dynamodb(channel)
+        return self.items.get(channel)
+
+    def write_to_dynamodb(self, channel, result, expiry_time=None):
+        now = time.time()
+        self.queue_item(dynamodb_item(channel, result, now, now, expiry_time))
+
+    def update_dynamodb(self, channel, result, create_time, expiry_time=None):
+        self.queue_item(dynamodb_item(channel, result, create_time, time.time(), expiry_time))
+
+    def put_to_dynamodb(self, item):
+        self.queue_item(item)
+
+    def queue_item(self, item):
+        with self.lock:
+            if not self.flushed:
+                self.pending[item['channel']['S']] = item
+                return
+        self.youtube_and_dynamodb.put_to_dynamodb(item)
+
+    def conditional_put_to_dynamodb(self, item, revision):
+        # whether this write wins or loses, what was prefetched is out of date from now on
+        with self.lock:
+            self.prefetched.discard(item['channel']['S'])
+        return self.youtube_and_dynamodb.conditional_put_to_dynamodb(item, revision)
+
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        return self.youtube_and_dynamodb.acquire_refresh_lease(channel, lease_seconds, last_checked_time)
+
+    def batch_get_from_dynamodb(self, keys):
+        return self.youtube_and_dynamodb.batch_get_from_dynamodb(keys)
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        return self.youtube_and_dynamodb.record_key_usage(usage_key, units, failures, quarantined_until)
+
+    def request_from_youtube(self, params, key_origin):
+        return self.youtube_and_dynamodb.request_from_youtube(params, key_origin)
+
+    def request_videos_from_youtube(self, params, key_origin):
+        return self.youtube_and_dynamodb.request_videos_from_youtube(params, key_origin)
+
+    def flush(self):
+        with self.lock:
+            self.flushed = True
+            items = list(self.pending.values())
+            self.pending = {}
+        if items:
+            self.youtube_and_dynamodb.batch_write_to_dynamodb(items)
+
+
 def are_there_videos(result):
     if not result:
         return False
     return result.get('pageInfo', {}).get('totalResults', 0) > 0
 
 
-def do_search_on_youtube(params, youtube_and_dynamodb=RealYoutubeDynamodb):
-    channel = params.get("channelId")
-    result = CACHE.get(channel)
-    if result:
-        return 200, result, 'cache', None, None
+def search_key(params):
+    # the default live search is keyed by its channel so /live, the poller and /v3/search share it
+    if is_default_live_search(params) and params.get("channelId"):
+        return params["channelId"]
+    return search_cache_key(params)
+
+
+def do_search_on_youtube(params, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    # only whitelisted params go to youtube; a caller's own api key is used but doesn't split the cache
+    params = dict(canonical_params(params), **({"key": params["key"]} if (params or {}).get("key") else {}))
+    channel = search_key(params)
+    # concurrent misses for the same query share one dynamodb read and youtube check
+    search = functools.partial(IN_FLIGHT.do, channel, search_uncached, params, youtube_and_dynamodb)
+    entry, state = cache_for(channel).get(channel, refresh=search)
+    METRICS.count("TierLookups", Tier='memory', Outcome='hit' if state == FRESH else state)
+    if state == FRESH:
+        return 200, entry.result, 'cache', None, None
+    elif state == STALE:
+        return 200, entry.result, 'cache', f"refreshing in the background, {int(time.time() - entry.fetched_at)}s old", None
     else:
-        dresult = None
+        return search()
+
+
+def stored_item(item):
+    # an item holding only a refresh lease has no result yet
+    try:
+        return read_item(item)
+    except Exception as exc:
+        print("Exception decoding from dynamodb: %s" % (exc,))
+        traceback.print_exc()
+        return None
+
+
+def decode_item(item):
+    """Returns (result, create_time, last_checked_time, expiry_time) from a stored channel item."""
+    decoded_dresult = None
+    create_time = 0
+    last_checked_time = 0
+    expiry_time = 0
+    stored = stored_item(item)
+    try:
+        if stored:
+            decoded_dresult = stored.result()
+            create_time = stored.create_time
+            expiry_time = stored.expiry_time if stored.expiry_time is not None else int(default_expiry(create_time))
+            last_checked_time = stored.last_checked_time
+    except Exception as exc:
+        print("Exception decoding from dynamodb: %s" % (exc,))
+        traceback.print_exc()
         decoded_dresult = None
-        create_time = 0
-        last_checked_time = 0
-        expiry_time = 0
+    return decoded_dresult, create_time, last_checked_time, expiry_time
+
+
+def stored_ttl(result):
+    return DYNAMODB_IF_STREAM_TTL if are_there_videos(result) else DYNAMODB_IF_NO_STREAM_TTL
+
+
+def next_check_time(channel, since, live, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    # learnt from when the channel usually goes live; the fixed ttls until there is any history.
+    # while the websub hub pushes new broadcasts to us polling is only a safety net
+    SCHEDULES.load(channel, youtube_and_dynamodb)
+    safety_interval = SAFETY_INTERVAL if SUBSCRIPTIONS.active(channel, youtube_and_dynamodb) else None
+    return SCHEDULES.next_check_time(
+        channel, since, live, DYNAMODB_IF_STREAM_TTL if live else DYNAMODB_IF_NO_STREAM_TTL, safety_interval)
+
+
+def earliest_upstream_check(since, next_check):
+    # youtube isn't asked again within MIN_TIME_BEFORE_UPSTREAM_CHECKS unless the learnt cadence polls
+    # more tightly, near a usual or scheduled start; that never goes below the cadence's MIN_INTERVAL
+    return min(since + MIN_TIME_BEFORE_UPSTREAM_CHECKS, next_check)
+
+
+def next_upstream_check(channel, last_checked_time, live, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    gate = last_checked_time + MIN_TIME_BEFORE_UPSTREAM_CHECKS
+    if is_search_key(channel) or time.time() >= gate:
+        return gate
+    return earliest_upstream_check(
+        last_checked_time, next_check_time(channel, last_checked_time, live, youtube_and_dynamodb))
+
+
+def read_only_request_path():
+    # set when the scheduled poller is the only thing that goes to youtube
+    return os.environ.get("READ_ONLY_REQUEST_PATH", "").lower() in ("1", "true", "yes")
+
+
+def search_uncached(params, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    channel = search_key(params)
+    with METRICS.span("dynamodb_read", key=channel):
         item = youtube_and_dynamodb.get_from_dynamodb(channel)
+        decoded_dresult, create_time, last_checked_time, expiry_time = decode_item(item)
+    if read_only_request_path():
+        if decoded_dresult is None:
+            record_tier(channel, 'dynamodb', 'miss')
+            return 503, {}, 'dynamodb', "not polled from youtube yet", None
+        record_tier(channel, 'dynamodb', 'hit')
+        cache_result(channel, decoded_dresult, create_time, expiry_time)
+        return 200, decoded_dresult, 'dynamodb', None, None
+    if decoded_dresult is not None:
+        now = time.time()
+        if is_search_key(channel):
+            next_check = create_time + stored_ttl(decoded_dresult)
+        else:
+            next_check = next_check_time(channel, create_time, are_there_videos(decoded_dresult), youtube_and_dynamodb)
+        if now < next_check:
+            record_tier(channel, 'dynamodb', 'hit')
+            cache_result(channel, decoded_dresult, create_time, expiry_time, next_check)
+            return 200, decoded_dresult, 'dynamodb', None, None
+    record_tier(channel, 'dynamodb', 'miss')
+    return request_from_youtube_and_write_to_cache(
+        params, decoded_dresult, create_time, last_checked_time, expiry_time, youtube_and_dynamodb)
+
+
+def reset_key_scheduler():
+    global KEY_SCHEDULER
+    KEY_SCHEDULER = KeyScheduler(
+        os.environ.get("YOUTUBE_API_KEYS", 'test_key:blah'),
+        daily_quota=int(os.environ.get("YOUTUBE_API_KEY_QUOTA", DEFAULT_DAILY_QUOTA)))
+
+
+reset_key_scheduler()
+
+
+def get_key_scheduler():
+    return KEY_SCHEDULER
+
+
+def reset_probes():
+    global PROBES
+    PROBES = ProbeState()
+
+
+reset_probes()
+
+
+def get_probes():
+    return PROBES
+
+
+def reset_schedules():
+    global SCHEDULES
+    SCHEDULES = ScheduleBook()
+
+
+reset_schedules()
+
+
+def get_schedules():
+    return SCHEDULES
+
+
+def reset_subscriptions():
+    global SUBSCRIPTIONS
+    SUBSCRIPTIONS = Subscriptions(
+        os.environ.get("WEBSUB_CALLBACK_URL"), os.environ.get("WEBSUB_SECRET"),
+        os.environ.get("WEBSUB_HUB_URL", HUB_URL))
+
+
+reset_subscriptions()
+
+
+def get_subscriptions():
+    return SUBSCRIPTIONS
+
+
+def reset_registry():
+    global REGISTRY
+    REGISTRY = ChannelRegistry()
+
+
+reset_registry()
+
+
+def get_registry():
+    return REGISTRY
+
+
+def registered_channels(youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    # the built in CHANNELS until the first channel is registered
+    channels = REGISTRY.snapshot(youtube_and_dynamodb)
+    return CHANNELS if channels is None else channels
+
+
+def reset_metrics():
+    global METRICS
+    # METRICS=off swaps in a recorder whose every call returns at once
+    if os.environ.get("METRICS", "on").lower() in ("off", "0", "false", "no"):
+        METRICS = NullMetrics()
+    else:
+        METRICS = Metrics(
+            os.environ.get("METRICS_NAMESPACE", NAMESPACE),
+            sample_rate=float(os.environ.get("METRICS_SAMPLE_RATE", TRACE_SAMPLE_RATE)))
+
+
+reset_metrics()
+
+
+def get_metrics():
+    return METRICS
+
+
+def traced(fn):
+    """Runs a route or scheduled function in a trace, flushing the metrics it recorded when it returns."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with METRICS.trace(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def call_youtube(api, call, *args):
+    start = time.time()
+    status_code = 'error'
+    try:
+        status_code, result = call(*args)
+        return status_code, result
+    finally:
+        METRICS.timing("YoutubeLatency", (time.time() - start) * 1000, Api=api)
+        METRICS.count("YoutubeCalls", Api=api, Status=str(status_code))
+
+
+def upstream_errors():
+    # only evaluated once something was raised, so requests is loaded by then if it raised it
+    from requests.exceptions import RequestException
+    return CircuitOpen, RequestException
+
+
+def with_key_health(info, key_origin):
+    if key_origin in (None, "provided_in_apicall"):
+        return info
+    return f"{info}; api keys: {KEY_SCHEDULER.health_summary()}"
+
+
+def request_with_key(call, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, units=SEARCH_COST, api='search.list'):
+    status_code, result, key_origin = 429, {"error": "no youtube api key with quota left"}, None
+    tried = set()
+    # on 403/429 retry once with a different key rather than falling back to stale data
+    for _attempt in range(2):
+        choice = KEY_SCHEDULER.pick(youtube_and_dynamodb, exclude=tried)
+        if not choice:
+            print(f"No youtube api key left to try, already tried {tried}")
+            break
+        key_origin, key = choice
+        tried.add(key_origin)
+        status_code, result = call_youtube(api, call, key, key_origin)
+        KEY_SCHEDULER.record(youtube_and_dynamodb, key_origin, status_code, result, units)
+        if status_code == HTTP_OK:
+            # as KEY_SCHEDULER reckons it, refused and failed calls spend nothing
+            METRICS.count("QuotaUnits", units, Key=key_origin)
+        if status_code not in (403, 429):
+            break
+    return status_code, result, key_origin
+
+
+def request_from_youtube_with_key(params, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    if params.get("key"):
+        key_origin = "provided_in_apicall"
+        status_code, result = call_youtube('search.list', youtube_and_dynamodb.request_from_youtube, params, key_origin)
+        return status_code, result, key_origin
+    # keep our key out of the caller's params
+    return request_with_key(
+        lambda key, key_origin: youtube_and_dynamodb.request_from_youtube(dict(params, key=key), key_origin),
+        youtube_and_dynamodb)
+
+
+def request_videos_with_key(video_ids, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    params = {"part": "snippet,liveStreamingDetails", "id": ",".join(video_ids)}
+    return request_with_key(
+        lambda key, key_origin: youtube_and_dynamodb.request_videos_from_youtube(dict(params, key=key), key_origin),
+        youtube_and_dynamodb, VIDEOS_COST, 'videos.list')
+
+
+def prefetched_videos(video_ids, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    videos = getattr(youtube_and_dynamodb, 'videos', None)
+    if not video_ids or not videos or any(video_id not in videos for video_id in video_ids):
+        return None
+    # ids youtube didn't return are None, as they'd be missing from the response
+    items = [videos[video_id] for video_id in video_ids if videos[video_id]]
+    return HTTP_OK, {"kind": "youtube#videoListResponse", "items": items}, None
+
+
+def prefetch_probes(channel_ids, batched):
+    """Probes every channel's known broadcasts with as few videos.list calls as there are 50 ids.
+
+    Each channel's own probe is then answered from `batched.videos`. The ids of a chunk
+    that fails go in `batched.unprobed` so their channels fall back to search.list
+    rather than trying youtube again for the same ids.
+    """
+    known = []
+    for channel_id in channel_ids:
+        PROBES.load(channel_id, batched)
+        known += PROBES.known(channel_id)
+    video_ids = list(dict.fromkeys(known))
+    chunks = [video_ids[start:start + MAX_PROBE_IDS] for start in range(0, len(video_ids), MAX_PROBE_IDS)]
+    futures = [EXECUTOR.submit(request_videos_with_key, chunk, batched) for chunk in chunks]
+    for chunk, future in zip(chunks, futures):
         try:
-            if item:
-                dresult = item.get('result', {}).get('S')
-                create_time = item.get('time').get('N')
-                expiry_time = item.get('expiry_time', {"N": default_expiry(int(float(create_time)))}).get('N')
-                last_checked_time = item.get('last_checked_time', {"N": "0"}).get('N')
-                if create_time and dresult:
-                    create_time = int(float(create_time))
-                    decoded_dresult = json.loads(dresult)
-                    ttl = DYNAMODB_IF_STREAM_TTL if are_there_videos(decoded_dresult) else DYNAMODB_IF_NO_STREAM_TTL
-                    now = time.time()
-                    if now - create_time < ttl:
-                        print(f"Using Dynamodb result as within ttl: now={now} create_time={create_time} ttl={ttl}")
-                        return 200, decoded_dresult, 'dynamodb', None, None
-        except Exception as exc:
-            print("Exception decoding from dynamodb: %s" % (exc,))
-            traceback.print_exc()
-        return request_from_youtube_and_write_to_cache(
-            params, decoded_dresult, create_time,
-            int(float(last_checked_time)), int(float(expiry_time)), youtube_and_dynamodb)
+            status_code, result, key_origin = future.result()
+        except upstream_errors() as exc:
+            status_code, result = 503, {"error": str(exc)}
+        if status_code != HTTP_OK or not isinstance(result, dict):
+            print(f"Batched probe of {len(chunk)} videos failed with youtube status {status_code}")
+            batched.unprobed.update(chunk)
+            continue
+        found = {video['id']: video for video in result.get('items', [])}
+        batched.videos.update({video_id: found.get(video_id) for video_id in chunk})
+    return len(chunks)
 
 
-def pick_youtube_api_key():
-    keys = os.environ.get("YOUTUBE_API_KEYS", 'test_key:blah')
-    all_keys = []
-    for key in keys.split(','):
-        origin, value = key.split(':')
-        all_keys.append((origin, value))
-    choice = random.choice(all_keys)
-    return choice
+def is_default_live_search(params):
+    return {name: value for name, value in params.items() if name not in ("channelId", "key")} == DEFAULT_PARAMS
 
 
-def request_from_youtube_and_write_to_cache(params, decoded_dresult=None, create_time=0, last_checked_time=0,
-                                            expiry_time=0, youtube_and_dynamodb=RealYoutubeDynamodb):
+def detect_live(params, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    status_code, result, key_origin = probe_or_search(params, youtube_and_dynamodb)
+    if status_code == HTTP_OK and is_default_live_search(params) and isinstance(result, dict):
+        SCHEDULES.observe(params.get("channelId"), time.time(), are_there_videos(result), youtube_and_dynamodb)
+    return status_code, result, key_origin
+
+
+def probe_or_search(params, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    """Answers a live search.list as cheaply as possible.
+
+    Known broadcasts for the channel are checked first with one videos.list call. Only
+    when that can't settle it (nothing known, the probe failed, nothing left that could
+    still go live, or search.list hasn't run for SEARCH_SAFETY_INTERVAL) do we pay for
+    search.list.
+    """
     channel = params.get("channelId")
+    if not params.get("key") and is_default_live_search(params):
+        PROBES.load(channel, youtube_and_dynamodb)
+        known = PROBES.known(channel)
+        if known and not set(known) & getattr(youtube_and_dynamodb, 'unprobed', set()):
+            status_code, result, key_origin = (
+                prefetched_videos(known, youtube_and_dynamodb) or request_videos_with_key(known, youtube_and_dynamodb))
+            if status_code == HTTP_OK:
+                live_videos, upcoming = PROBES.learn_from_probe(channel, known, result, youtube_and_dynamodb)
+                import_scheduled_starts(channel, upcoming, youtube_and_dynamodb)
+                if live_videos:
+                    print(f"Probe found {channel} live without a search")
+                    return status_code, search_response(live_videos), key_origin
+                if upcoming and not PROBES.search_due(channel):
+                    print(f"Probe found {channel} offline with {len(upcoming)} upcoming broadcasts")
+                    return status_code, search_response([]), key_origin
+    status_code, result, key_origin = request_from_youtube_with_key(params, youtube_and_dynamodb)
+    if status_code == HTTP_OK and is_default_live_search(params) and isinstance(result, dict):
+        PROBES.learn_from_search(channel, result, youtube_and_dynamodb)
+    return status_code, result, key_origin
+
+
+def import_scheduled_starts(channel, upcoming, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    starts = []
+    for video in upcoming:
+        try:
+            starts.append(parse_time(video['liveStreamingDetails']['scheduledStartTime']))
+        except (KeyError, ValueError):
+            pass
+    if starts:
+        SCHEDULES.add_scheduled(channel, time.time(), starts, youtube_and_dynamodb)
+
+
+def request_from_youtube_and_write_to_cache(params, decoded_dresult=None, create_time=0, last_checked_time=0,
+                                            expiry_time=0, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, forced=False):
+    # the channel id for a default live search, a canonical search# key for anything else
+    channel = search_key(params)
     try:
         key_origin = None
-        if not params.get("key"):
-            key_origin, params["key"] = pick_youtube_api_key()
-        else:
-            key_origin = "provided_in_apicall"
         since_last_check = time.time() - last_checked_time
-        if since_last_check > MIN_TIME_BEFORE_UPSTREAM_CHECKS + GRACE_PERIOD:
-            print(f"Going to youtube to check because last check was done {since_last_check} ago")
-            status_code, result = youtube_and_dynamodb.request_from_youtube(params, key_origin)
-            if status_code == requests.codes.ok:
-                now = time.time()
-                if (are_there_videos(decoded_dresult) and not are_there_videos(result) and
-                        expiry_time > now):
-                    print(
-                        f"Still using dynamodb result because youtube had no videos and "
-                        f"{now - expiry_time} seconds left until expiry")
-                    youtube_and_dynamodb.update_dynamodb(channel, decoded_dresult, create_time, expiry_time)
-                    return (
-                        200, decoded_dresult, 'dynamodb',
-                        f"youtube status {status_code} with data {result}", key_origin)
-                print(f"Caching result for {channel} from youtube")
-                CACHE[channel] = result
-                youtube_and_dynamodb.write_to_dynamodb(channel, result)
-                return status_code, result, 'youtube', f"youtube status {status_code}", key_origin
+        next_check = next_upstream_check(channel, last_checked_time, are_there_videos(decoded_dresult), youtube_and_dynamodb)
+        if time.time() >= next_check:
+            with METRICS.span("lease", key=channel):
+                # a forced refresh read nothing, so only another node's lease in force holds it back
+                leased = youtube_and_dynamodb.acquire_refresh_lease(
+                    channel, REFRESH_LEASE_SECONDS, None if forced else last_checked_time)
+            if not leased:
+                METRICS.count("Decisions", Decision='leased elsewhere')
+                if decoded_dresult:
+                    return 200, decoded_dresult, 'dynamodb', "refresh in progress on another node", None
+                return (
+                    serve_stale(channel, "refresh in progress on another node") or
+                    (503, {}, 'dynamodb', "refresh in progress on another node", None))
+            METRICS.count("Decisions", Decision='youtube check')
+            with METRICS.span("youtube", key=channel) as span:
+                try:
+                    status_code, result, key_origin = detect_live(params, youtube_and_dynamodb)
+                except upstream_errors() as exc:
+                    # hung, failing or tripped: fall back to what we have like any other youtube error
+                    status_code, result = 503, {"error": str(exc)}
+                span.set(status_code=status_code, key_origin=key_origin)
+            if status_code == HTTP_OK:
+                if are_there_videos(decoded_dresult) and not are_there_videos(result):
+                    # youtube has nothing but the stored video may be forced or sticky until its expiry_time
+                    sticky = expiry_time > time.time()
+                    METRICS.count("StickyDecisions", Outcome='kept' if sticky else 'expired')
+                    if sticky:
+                        with METRICS.span("dynamodb_write", key=channel):
+                            youtube_and_dynamodb.update_dynamodb(channel, decoded_dresult, create_time, expiry_time)
+                        # held until the earlier of its expiry_time and the next check youtube may get
+                        cache_result(
+                            channel, decoded_dresult, create_time, expiry_time,
+                            next_upstream_check(channel, time.time(), True, youtube_and_dynamodb))
+                        return (
+                            200, decoded_dresult, 'dynamodb',
+                            with_key_health(f"youtube status {status_code} with data {result}", key_origin),
+                            key_origin)
+                cache_result(channel, result)
+                with METRICS.span("dynamodb_write", key=channel):
+                    youtube_and_dynamodb.write_to_dynamodb(channel, result)
+                return (
+                    status_code, result, 'youtube', with_key_health(f"youtube status {status_code}", key_origin),
+                    key_origin)
             else:
-                print(f"Youtube returned {status_code}")
+                METRICS.count("Decisions", Decision='youtube error')
+                info = with_key_health(f"youtube status {status_code} with data {result}", key_origin)
                 if decoded_dresult:
-                    youtube_and_dynamodb.update_dynamodb(channel, decoded_dresult, create_time)
-                    return (
-                        200, decoded_dresult, 'dynamodb',
-                        f"youtube status {status_code} with data {result}", key_origin)
+                    with METRICS.span("dynamodb_write", key=channel):
+                        youtube_and_dynamodb.update_dynamodb(channel, decoded_dresult, create_time)
+                    record_tier(channel, 'dynamodb', 'stale')
+                    return 200, decoded_dresult, 'dynamodb', stale_info(create_time, info), key_origin
                 else:
-                    return 500, {}, 'youtube', f"youtube status {status_code} with data {result}", key_origin
+                    return serve_stale(channel, info) or (500, {}, 'youtube', info, key_origin)
         else:
-            print(f"Using dynamodb because last check was done {since_last_check} ago")
+            METRICS.count("Decisions", Decision='checked recently')
             if decoded_dresult:
+                cache_result(channel, decoded_dresult, create_time, expiry_time, next_check)
                 return 200, decoded_dresult, 'dynamodb', None, None
+            info = f"no stored result and last check was done {since_last_check} ago"
+            return serve_stale(channel, info) or (503, {}, 'dynamodb', info, None)
     except Exception as exc:
-        print(exc)
-        return 500, {}, 'youtube', f"error {exc}", key_origin
+        traceback.print_exc()
+        METRICS.count("Decisions", Decision='error')
+        return serve_stale(channel, f"error {exc}") or (500, {}, 'youtube', f"error {exc}", key_origin)
 
 
-def force_video_id(video_id, channel, ttl, youtube_and_dynamodb=RealYoutubeDynamodb):
-    channel_id = CHANNELS[channel]
+def force_video_id(video_id, channel, ttl, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    channel_id = registered_channels(youtube_and_dynamodb)[channel]
     if video_id:
         result = json.loads("""
         {
@@ -263,7 +981,7 @@ def force_video_id(video_id, channel, ttl, youtube_and_dynamodb=RealYoutubeDynam
             }""")
         result["items"][0]["id"]["videoId"] = video_id
     else:
-        result = """
+        result = json.loads("""
     {
         "kind": "youtube#searchListResponse",
         "etag": "8jEFfXBrqiSrcF6Ee7MQuz8XuAM/nxmhARCBNQQrPOpwtM0UNWBXCsg",
@@ -273,14 +991,20 @@ def force_video_id(video_id, channel, ttl, youtube_and_dynamodb=RealYoutubeDynam
             "resultsPerPage": 1
         },
         "items": []
-        }"""
-    youtube_and_dynamodb.write_to_dynamodb(channel_id, result, time.time() + ttl)
+        }""")
+    expiry_time = time.time() + ttl
+    youtube_and_dynamodb.write_to_dynamodb(channel_id, result, expiry_time)
+    cache_result(channel_id, result, expiry_time=expiry_time)
+    if video_id:
+        PROBES.learn(channel_id, [video_id], youtube_and_dynamodb)
 
 
 @app.route('/v3/search', cors=True)
+@traced
 def youtube():
-    status_code, result, how = do_search_on_youtube(app.current_request.query_params)
-    if status_code == requests.codes.ok:
+    status_code, result, how, info, key_origin = do_search_on_youtube(
+        app.current_request.query_params or {}, YOUTUBE_AND_DYNAMODB)
+    if status_code == HTTP_OK:
         return result
     else:
         return Response(
@@ -289,31 +1013,193 @@ def youtube():
             headers={"Content-Type": "application/json"})
 
 
-@app.route('/live', cors=True)
+@app.route('/live', cors=LIVE_CORS)
+@traced
 def any_live():
-    return live(skip_cache=False)
+    deadline = time.time() + LIVE_DEADLINE
+    channels = requested_channels(YOUTUBE_AND_DYNAMODB, deadline=deadline)
+    if channels is None:
+        return Response(body=json.dumps({}), status_code=400)
+    return live_response(
+        live(skip_cache=False, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, deadline=remaining(deadline),
+             channels=channels),
+        LIVE_RENDERER)
+
+
+@app.route('/live/compact', cors=LIVE_CORS)
+@traced
+def any_live_compact():
+    deadline = time.time() + LIVE_DEADLINE
+    channels = requested_channels(YOUTUBE_AND_DYNAMODB, deadline=deadline)
+    if channels is None:
+        return Response(body=json.dumps({}), status_code=400)
+    return live_response(
+        live(skip_cache=False, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, deadline=remaining(deadline),
+             channels=channels),
+        COMPACT_RENDERER)
+
+
+def remaining(deadline):
+    return max(0, deadline - time.time())
+
+
+def within(deadline, fn, *args, default=None):
+    """fn(*args), or `default` once `deadline` passes; a late fn carries on in the pool."""
+    future = EXECUTOR.submit(METRICS.bind(fn), *args)
+    try:
+        return future.result(timeout=remaining(deadline))
+    except FuturesTimeout:
+        print(f"{fn.__name__} did not finish within the request's deadline")
+        return default
+
+
+def requested_channels(youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, request=None, deadline=None):
+    """The registered channels named by ?channels=a,b, all of them without it, or None if any is unknown."""
+    request = request or app.current_request
+    if deadline is None:
+        registered = registered_channels(youtube_and_dynamodb)
+    else:
+        # a registry read still going at the deadline leaves the snapshot we have, or the built in CHANNELS
+        registered = within(deadline, registered_channels, youtube_and_dynamodb) or (
+            REGISTRY.channels if REGISTRY.channels is not None else CHANNELS)
+    names = (request.query_params or {}).get('channels')
+    if names is None:
+        return registered
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    if not names or any(name not in registered for name in names):
+        return None
+    return {name: registered[name] for name in names}
+
+
+def render_compact(results):
+    # only what the widget reads; rendered once per state change, so when each result was fetched
+    # goes out as an epoch the client ages itself rather than an age frozen at render time
+    channels = REGISTRY.channels if REGISTRY.channels is not None else CHANNELS
+    compact = {}
+    for channel, entry in results.items():
+        if not isinstance(entry, dict):
+            compact[channel] = entry
+            continue
+        cached_entry = cached(channels.get(channel))
+        if cached_entry and cached_entry.result is entry["result"]:
+            summary, fetched_at = cached_entry.summary, int(cached_entry.fetched_at)
+        else:
+            summary, fetched_at = summarize(entry["result"]), None
+        compact[channel] = dict(summary, how=entry["how"], status_code=entry["status_code"], fetched_at=fetched_at)
+    return json.dumps(compact, separators=(',', ':'))
+
+
+def reset_live_renderers():
+    global LIVE_RENDERER, COMPACT_RENDERER, WAIT_RENDERER
+    LIVE_RENDERER = RendererSet()
+    COMPACT_RENDERER = RendererSet(serialize=render_compact)
+    WAIT_RENDERER = RendererSet(signature=lambda results: results["version"], serialize=render_compact)
+
+
+reset_live_renderers()
+
+
+def reset_all():
+    reset_cache()
+    reset_key_scheduler()
+    reset_probes()
+    reset_schedules()
+    reset_subscriptions()
+    reset_registry()
+    reset_metrics()
+    reset_live_renderers()
+
+
+def live_response(results, renderer, request=None):
+    request = request or app.current_request
+    payload = renderer.render(results)
+    now = time.time()
+    cacheable = all(
+        entry["status_code"] == HTTP_OK and entry["how"] != 'stale'
+        for channel, entry in results.items() if isinstance(entry, dict))
+    headers = {
+        "Content-Type": "application/json",
+        "ETag": payload.etag,
+        "Cache-Control": cache_control(payload, stored_ttl_for_any_live(results), now, cacheable)}
+    if etag_matches((request.headers or {}).get('if-none-match'), payload.etag):
+        return Response(body='', status_code=304, headers=headers)
+    return Response(body=payload.body, status_code=200, headers=headers)
+
+
+def stored_ttl_for_any_live(results):
+    return DYNAMODB_IF_STREAM_TTL if results.get("any_live") else DYNAMODB_IF_NO_STREAM_TTL
 
 
 @app.route('/refresh', cors=True)
+@traced
 def refresh_cache():
-    return live(skip_cache=True)
+    return live(skip_cache=True, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB)
+
+
+def search_channel(channel_id, skip_cache=False, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    params = {}
+    params.update(DEFAULT_PARAMS)
+    params["channelId"] = channel_id
+    if skip_cache and read_only_request_path():
+        # the poller is the only thing that goes to youtube, so a refresh re-reads what it stored
+        return IN_FLIGHT.do(channel_id, search_uncached, params, youtube_and_dynamodb)
+    if skip_cache:
+        return IN_FLIGHT.do(
+            channel_id, request_from_youtube_and_write_to_cache, params, youtube_and_dynamodb=youtube_and_dynamodb,
+            forced=True)
+    else:
+        return do_search_on_youtube(params, youtube_and_dynamodb)
+
 
+def prefetch_keys(channel_ids):
+    # a cold container also needs the known broadcasts to probe and the stream schedules
+    return list(channel_ids) + (
+        [probe_key(id) for id in channel_ids if PROBES.stale(id)] +
+        [schedule_key(id) for id in channel_ids if SCHEDULES.stale(id)] +
+        [websub_key(id) for id in channel_ids if SUBSCRIPTIONS.enabled() and id not in SUBSCRIPTIONS.loaded])
 
-def live(skip_cache=False):
+
+def live(skip_cache=False, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, deadline=LIVE_DEADLINE, channels=None):
+    """Every channel's search, all within `deadline` seconds; what hasn't settled by then is served stale.
+
+    The prefetch and the flush of the batched writes come out of the same budget, so a hung
+    table costs the request its deadline and no more.
+    """
+    until = time.time() + deadline
+    if channels is None:
+        channels = registered_channels(youtube_and_dynamodb)
     results = {}
     any_live = False
-    for channel, id in CHANNELS.items():
-        params = {}
-        params.update(DEFAULT_PARAMS)
-        params["channelId"] = id
-        if skip_cache:
-            status_code, result, how, info, key_origin = request_from_youtube_and_write_to_cache(params)
+    to_prefetch = [] if skip_cache else prefetch_keys([id for id in channels.values() if id not in CACHE])
+    with METRICS.span("dynamodb_prefetch", keys=len(to_prefetch)):
+        # without the prefetch each channel reads its own items, inside its share of the deadline
+        batched = (
+            within(until, BatchedYoutubeDynamodb, youtube_and_dynamodb, to_prefetch) or
+            BatchedYoutubeDynamodb(youtube_and_dynamodb, []))
+    futures = {
+        channel: EXECUTOR.submit(METRICS.bind(search_channel), id, skip_cache, batched)
+        for channel, id in channels.items()}
+    with METRICS.span("channels", channels=len(futures)):
+        done, _ = wait(futures.values(), timeout=remaining(until))
+    with METRICS.span("dynamodb_flush"):
+        # the answer doesn't wait for the writes; an unfinished flush completes in the pool
+        within(until, batched.flush)
+    for channel, future in futures.items():
+        if future not in done:
+            # leave the slow channel running in the pool but don't hold up the others
+            future.cancel()
+            info = f"no result within {deadline:.3g} seconds"
+            status_code, result, how, info, key_origin = (
+                serve_stale(channels[channel], info) or (504, {}, 'timeout', info, None))
         else:
-            status_code, result, how, info, key_origin = do_search_on_youtube(params)
-        print(
-            f"Retrieved {channel} from {how} with status_code {status_code} with info: {info}"
-            f"and key origin: {key_origin}")
-        if status_code == requests.codes.ok:
+            try:
+                status_code, result, how, info, key_origin = future.result()
+            except Exception as exc:
+                traceback.print_exc()
+                status_code, result, how, info, key_origin = (
+                    serve_stale(channels[channel], f"error {exc}") or (500, {}, 'error', f"error {exc}", None))
+        METRICS.count("ChannelResults", How=how)
+        if status_code == HTTP_OK:
             if len(result.get("items", [])) > 0:
                 any_live = True
         results[channel] = {
@@ -326,10 +1212,259 @@ def live(skip_cache=False):
     return results
 
 
+def prefetch_channels(youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    """Caches every registered channel whose stored result is still within its ttl, without going to youtube.
+
+    Run while the lambda initialises when PREFETCH_ON_INIT is set, so the first request after a
+    cold start finds the dynamodb client built and the channels already cached.
+    """
+    channel_ids = [id for id in registered_channels(youtube_and_dynamodb).values() if id not in CACHE]
+    batched = BatchedYoutubeDynamodb(youtube_and_dynamodb, prefetch_keys(channel_ids))
+    prefetched = []
+    now = time.time()
+    for channel_id in channel_ids:
+        decoded_dresult, create_time, _, expiry_time = decode_item(batched.get_from_dynamodb(channel_id))
+        if decoded_dresult is None:
+            continue
+        next_check = next_check_time(channel_id, create_time, are_there_videos(decoded_dresult), batched)
+        if now < next_check:
+            cache_result(channel_id, decoded_dresult, create_time, expiry_time, next_check)
+            prefetched.append(channel_id)
+    return prefetched
+
+
+@app.route('/live/wait', cors=LIVE_CORS)
+@traced
+def wait_for_live():
+    params = app.current_request.query_params or {}
+    try:
+        timeout = min(float(params.get('timeout', LONG_POLL_TIMEOUT)), LONG_POLL_TIMEOUT)
+    except ValueError:
+        return Response(body=json.dumps({}), status_code=400)
+    deadline = time.time() + timeout
+    channels = requested_channels(YOUTUBE_AND_DYNAMODB, deadline=deadline)
+    if channels is None:
+        return Response(body=json.dumps({}), status_code=400)
+    return live_wait(params.get('etag'), remaining(deadline), YOUTUBE_AND_DYNAMODB, channels)
+
+
+def read_live_items(channels, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    channel_ids = list(channels.values())
+    items = youtube_and_dynamodb.batch_get_from_dynamodb(channel_ids)
+    if items is None:
+        items = {id: youtube_and_dynamodb.get_from_dynamodb(id) for id in channel_ids}
+    return items
+
+
+def shared_live_items(channels, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    # waiters for the same channels in the same process share one read
+    return IN_FLIGHT.do("live/wait#" + ",".join(sorted(channels)), read_live_items, channels, youtube_and_dynamodb)
+
+
+def live_version(items, channels):
+    states = []
+    for channel, id in sorted(channels.items()):
+        item = items.get(id) or {}
+        state = item.get('state', {}).get('S')
+        if state is None:
+            # items written before the state attribute existed
+            result = decode_item(item)[0]
+            state = live_state(result) if result is not None else "unknown"
+        states.append(f"{channel}={state}")
+    return '"%s"' % (hashlib.sha1("|".join(states).encode('utf-8')).hexdigest()[:16],)
+
+
+def results_from_items(items, version, channels):
+    results = {"version": version}
+    any_live = False
+    for channel, id in channels.items():
+        result = decode_item(items.get(id))[0]
+        any_live = any_live or are_there_videos(result)
+        results[channel] = {
+            "status_code": HTTP_OK if result is not None else 503,
+            "result": result if result is not None else {},
+            "how": 'dynamodb',
+            "extra_info": None,
+            "key_origin": None}
+    results["any_live"] = any_live
+    return results
+
+
+def live_wait(etag, timeout, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, channels=None):
+    """Holds the request until the stored live state differs from `etag` or `timeout` passes.
+
+    The state is read from the channel items' state attributes, never from youtube; one
+    ordinary /live pass up front refreshes anything that is due, as a poll would have.
+    That pass comes out of `timeout` too, so the whole request stays within it. The
+    pauses between reads back off from LONG_POLL_INTERVAL to LONG_POLL_MAX_INTERVAL, as
+    a state that hasn't changed for a while is unlikely to change in the next seconds.
+    """
+    deadline = time.time() + timeout
+    if channels is None:
+        channels = registered_channels(youtube_and_dynamodb)
+    # leaving the wait at least one read of the state
+    live(skip_cache=False, youtube_and_dynamodb=youtube_and_dynamodb,
+         deadline=min(LIVE_DEADLINE, max(0, remaining(deadline) - LONG_POLL_INTERVAL)), channels=channels)
+    interval = LONG_POLL_INTERVAL
+    while True:
+        items = within(deadline, shared_live_items, channels, youtube_and_dynamodb)
+        if items is None:
+            # the table didn't answer in time, so nothing is known to have changed
+            return Response(body='', status_code=304, headers={"ETag": etag or '""', "Cache-Control": "no-cache"})
+        version = live_version(items, channels)
+        if version != etag:
+            payload = WAIT_RENDERER.render(results_from_items(items, version, channels))
+            return Response(
+                body=payload.body, status_code=200,
+                headers={"Content-Type": "application/json", "ETag": version, "Cache-Control": "no-cache"})
+        # leaving the last read LONG_POLL_INTERVAL to answer in
+        pause = min(interval, remaining(deadline) - LONG_POLL_INTERVAL)
+        if pause <= 0:
+            return Response(body='', status_code=304, headers={"ETag": version, "Cache-Control": "no-cache"})
+        time.sleep(pause)
+        interval = min(interval * 2, LONG_POLL_MAX_INTERVAL)
+
+
+def poll_due(channel_id, item, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    # the live flag and times are enough to tell, so the payload of a channel that isn't due stays undecoded
+    stored = stored_item(item)
+    return stored is None or time.time() >= next_check_time(
+        channel_id, stored.last_checked_time, stored.live, youtube_and_dynamodb)
+
+
+def poll_channel(channel_id, item, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    if not poll_due(channel_id, item, youtube_and_dynamodb):
+        return None
+    decoded_dresult, create_time, last_checked_time, expiry_time = decode_item(item)
+    params = {}
+    params.update(DEFAULT_PARAMS)
+    params["channelId"] = channel_id
+    # the stored result and expiry_time go along so a forced video stays sticky, and last_checked_time
+    # so no other node's refresh since this item was read is repeated
+    return IN_FLIGHT.do(
+        channel_id, request_from_youtube_and_write_to_cache, params, decoded_dresult, create_time, last_checked_time,
+        expiry_time, youtube_and_dynamodb)
+
+
+def poll(youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB, deadline=LIVE_DEADLINE):
+    channel_ids = list(registered_channels(youtube_and_dynamodb).values())
+    batched = BatchedYoutubeDynamodb(
+        youtube_and_dynamodb,
+        channel_ids + [probe_key(id) for id in channel_ids if PROBES.stale(id)] +
+        [schedule_key(id) for id in channel_ids if SCHEDULES.stale(id)] +
+        [websub_key(id) for id in channel_ids if SUBSCRIPTIONS.enabled()])
+    items = {id: batched.get_from_dynamodb(id) for id in channel_ids}
+    # search.list takes one channel at a time but the probes of every due channel can share videos.list calls
+    prefetch_probes([id for id in channel_ids if poll_due(id, items[id], batched)], batched)
+    futures = {id: EXECUTOR.submit(METRICS.bind(poll_channel), id, items[id], batched) for id in channel_ids}
+    done, _ = wait(futures.values(), timeout=deadline)
+    batched.flush()
+    polled = {}
+    for id, future in futures.items():
+        if future not in done:
+            polled[id] = 'timeout'
+        elif future.exception():
+            polled[id] = f"error {future.exception()}"
+        elif future.result() is None:
+            polled[id] = 'not due'
+        else:
+            polled[id] = future.result()[2]
+    print(f"Polled youtube: {polled}")
+    return polled
+
+
+@app.schedule(Rate(POLL_RATE_MINUTES, unit=Rate.MINUTES))
+@traced
+def poll_youtube(event):
+    poll()
+
+
+@app.schedule(Rate(WEBSUB_RENEW_HOURS, unit=Rate.HOURS))
+@traced
+def renew_websub(event):
+    SUBSCRIPTIONS.renew(registered_channels(YOUTUBE_AND_DYNAMODB).values(), YOUTUBE_AND_DYNAMODB)
+
+
+# a GET carries no body and chalice takes it to be json
+@app.route('/websub', methods=['GET', 'POST'], content_types=[
+    'application/json', 'application/atom+xml', 'application/xml', 'text/xml'])
+@traced
+def websub_callback():
+    request = app.current_request
+    if request.method == 'GET':
+        params = request.query_params or {}
+        challenge = SUBSCRIPTIONS.verify(
+            params.get('hub.mode'), params.get('hub.topic'), params.get('hub.challenge'),
+            params.get('hub.lease_seconds'), list(registered_channels(YOUTUBE_AND_DYNAMODB).values()),
+            YOUTUBE_AND_DYNAMODB)
+        if challenge is None:
+            return Response(body='', status_code=404)
+        return Response(body=challenge, status_code=200, headers={"Content-Type": "text/plain"})
+    if not verify_signature(SUBSCRIPTIONS.secret, request.raw_body, (request.headers or {}).get('x-hub-signature')):
+        # the hub wants a 2xx whatever we make of it, otherwise it keeps retrying
+        print("Ignoring websub notification without a valid signature")
+        return Response(body='', status_code=202)
+    checked = handle_notification(request.raw_body, YOUTUBE_AND_DYNAMODB)
+    return Response(body=json.dumps(checked), status_code=200, headers={"Content-Type": "application/json"})
+
+
+def handle_notification(body, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    try:
+        entries = parse_feed(body)
+    except Exception as exc:
+        print("Exception parsing websub notification: %s" % (exc,))
+        return {}
+    channel_ids = set(registered_channels(youtube_and_dynamodb).values())
+    checked = {}
+    for entry in entries:
+        if entry.channel_id not in channel_ids:
+            continue
+        try:
+            checked[entry.video_id] = check_announced_video(entry.channel_id, entry.video_id, youtube_and_dynamodb)
+        except Exception as exc:
+            traceback.print_exc()
+            checked[entry.video_id] = f"error {exc}"
+    print(f"Checked videos from websub notification: {checked}")
+    return checked
+
+
+def check_announced_video(channel, video_id, youtube_and_dynamodb=YOUTUBE_AND_DYNAMODB):
+    """Settles what a pushed video means for its channel with one videos.list call instead of a search."""
+    status_code, result, key_origin = request_videos_with_key([video_id], youtube_and_dynamodb)
+    if status_code != HTTP_OK or not isinstance(result, dict):
+        return f"youtube status {status_code}"
+    live_videos, upcoming = PROBES.learn_from_probe(channel, [video_id], result, youtube_and_dynamodb)
+    if live_videos or upcoming:
+        PROBES.learn(channel, [video_id], youtube_and_dynamodb)
+    import_scheduled_starts(channel, upcoming, youtube_and_dynamodb)
+    stored, create_time, _, expiry_time = decode_item(youtube_and_dynamodb.get_from_dynamodb(channel))
+    if live_videos:
+        result = search_response(live_videos)
+        state = 'live'
+    elif video_id in live_state(stored).split(","):
+        # the broadcast we are showing has ended or gone, but like a poll that finds nothing
+        # a forced or sticky result is kept until its expiry_time
+        sticky = expiry_time > time.time()
+        METRICS.count("StickyDecisions", Outcome='kept' if sticky else 'expired')
+        if sticky:
+            youtube_and_dynamodb.update_dynamodb(channel, stored, create_time, expiry_time)
+            cache_result(channel, stored, create_time, expiry_time)
+            return 'sticky'
+        result = search_response([])
+        state = 'ended'
+    else:
+        return 'upcoming' if upcoming else 'not live'
+    print(f"Websub notification shows {channel} {state}")
+    cache_result(channel, result)
+    youtube_and_dynamodb.write_to_dynamodb(channel, result)
+    SCHEDULES.observe(channel, time.time(), are_there_videos(result), youtube_and_dynamodb)
+    return state
+
+
 @app.route('/ping', cors=True)
 def ping():
     if False:
-        client = boto3.client('dynamodb')
+        client = YOUTUBE_AND_DYNAMODB.client
         result = client.get_item(Key={'channel': {'S': 'mainhall'}}, TableName=os.environ['TABLE'])
         client.put_item(
                     Item={
@@ -341,17 +1476,69 @@ def ping():
 
 
 @app.route('/forcevideo', cors=True)
+@traced
 def force_video():
     video_id = app.current_request.query_params.get('videoId')
     channel = app.current_request.query_params.get('channel')
     ttl = app.current_request.query_params.get('ttl')
+    from durations import Duration
+    from durations.exceptions import ScaleFormatError, InvalidTokenError
     try:
         duration = Duration(ttl).to_seconds()
     except (InvalidTokenError, ScaleFormatError, ValueError):
         return Response(body=json.dumps({}), status_code=400)
-    if channel not in CHANNELS:
+    if channel not in registered_channels(YOUTUBE_AND_DYNAMODB):
         return Response(body=json.dumps({}), status_code=400)
     if video_id:
         return force_video_id(video_id, channel, duration)
     else:
         return Response(body=json.dumps({}), status_code=400)
+
+
+def is_admin(request):
+    token = os.environ.get("ADMIN_TOKEN")
+    given = (request.headers or {}).get('x-admin-token')
+    # without a token configured nobody can change the channels
+    return bool(token and given) and hmac.compare_digest(token.encode('utf-8'), given.encode('utf-8'))
+
+
+@app.route('/channels', cors=True)
+@traced
+def list_channels():
+    return registered_channels(YOUTUBE_AND_DYNAMODB)
+
+
+@app.route('/channels/{name}', methods=['PUT', 'DELETE'])
+@traced
+def update_channel(name):
+    request = app.current_request
+    if not is_admin(request):
+        return Response(body=json.dumps({}), status_code=403)
+    if request.method == 'DELETE':
+        try:
+            channels = REGISTRY.remove(name, YOUTUBE_AND_DYNAMODB, CHANNELS)
+        except RegistryConflict as exc:
+            return Response(body=json.dumps({"error": str(exc)}), status_code=409)
+        if channels is None:
+            return Response(body=json.dumps({}), status_code=404)
+        print(f"Removed channel {name}")
+        return channels
+    channel_id = (request.query_params or {}).get('channelId')
+    try:
+        channels = REGISTRY.add(name, channel_id, YOUTUBE_AND_DYNAMODB, CHANNELS)
+    except InvalidChannel as exc:
+        return Response(body=json.dumps({"error": str(exc)}), status_code=400)
+    except RegistryConflict as exc:
+        return Response(body=json.dumps({"error": str(exc)}), status_code=409)
+    print(f"Registered channel {name} as {channel_id}")
+    # rather than waiting up to an hour for renew_websub to notice it
+    SUBSCRIPTIONS.renew([channel_id], YOUTUBE_AND_DYNAMODB)
+    return channels
+
+
+if os.environ.get("PREFETCH_ON_INIT", "").lower() in ("1", "true", "yes") and 'TABLE' in os.environ:
+    # the init phase runs before the first request is waiting on it
+    try:
+        print(f"Prefetched {len(prefetch_channels())} channels on init")
+    except Exception:
+        traceback.print_exc()
@@ -0,0 +1,92 @@
+"""/live latency and upstream calls as the number of registered channels grows.
+
+Runs against an in-memory stand-in for DynamoDB and the YouTube API that sleeps for a
+typical round trip per call. For each channel count it times a cold /live (nothing
+cached or stored), a warm /live and a /live?channels= subset, then a poll where every
+channel has two known upcoming broadcasts, counting the calls each one made upstream:
+
+    python benchmarks/bench_channels.py [--channels 3 30 100 300] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.pop('TABLE', None)
+os.environ.setdefault('YOUTUBE_API_KEY_QUOTA', str(10 ** 9))  # the benchmark shouldn't run out of quota
+
+from chalice.config import Config  # noqa: E402
+from chalice.local import LocalGateway  # noqa: E402
+import app  # noqa: E402
+from chalicelib.keys import SEARCH_COST  # noqa: E402
+from chalicelib.probe import VIDEOS_COST  # noqa: E402
+from standins import StandInYoutubeDynamodb, fixed  # noqa: E402
+
+YOUTUBE_LATENCY = 0.02
+DYNAMODB_LATENCY = 0.005
+
+
+def upstream(calls):
+    return {
+        "youtube_calls": calls['search.list'] + calls['videos.list'],
+        "quota_units": calls['search.list'] * SEARCH_COST + calls['videos.list'] * VIDEOS_COST,
+        "dynamodb_calls": sum(count for name, count in calls.items() if not name.endswith('.list'))}
+
+
+def timed_get(gateway, backend, path):
+    backend.calls.clear()
+    start = time.perf_counter()
+    response = gateway.handle_request('GET', path, {'Host': 'localhost'}, b'')
+    elapsed = (time.perf_counter() - start) * 1000
+    assert response['statusCode'] == 200, response
+    return dict(latency_ms=round(elapsed, 1), **upstream(backend.calls))
+
+
+def run(count):
+    app.reset_all()
+    channels = {f"centre{index}": "UC%022d" % (index,) for index in range(count)}
+    backend = StandInYoutubeDynamodb(fixed(YOUTUBE_LATENCY), fixed(DYNAMODB_LATENCY))
+    report = {}
+    with mock.patch.dict('app.CHANNELS', channels, clear=True), mock.patch('app.YOUTUBE_AND_DYNAMODB', backend):
+        gateway = LocalGateway(app.app, Config())
+        report["cold_live"] = timed_get(gateway, backend, '/live')
+        report["warm_live"] = timed_get(gateway, backend, '/live')
+        report["subset_live"] = timed_get(gateway, backend, '/live?channels=' + ",".join(list(channels)[:3]))
+
+        # every channel due, with broadcasts known from an earlier search
+        backend.items.clear()
+        app.reset_probes()
+        for channel_id in channels.values():
+            app.get_probes().learn(channel_id, [channel_id + "-a", channel_id + "-b"], searched=True)
+        backend.calls.clear()
+        start = time.perf_counter()
+        app.poll(backend, deadline=60)
+        report["poll"] = dict(latency_ms=round((time.perf_counter() - start) * 1000, 1), **upstream(backend.calls))
+        # what probing each channel on its own would have taken
+        report["poll"]["unbatched_youtube_calls"] = count
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, nargs='+', default=[3, 30, 100, 300])
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+    report = {count: run(count) for count in args.channels}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'channels':>8}{'scenario':>13}{'latency':>12}{'youtube':>9}{'quota':>8}{'dynamodb':>10}{'unbatched':>11}")
+    for count, scenarios in report.items():
+        for name, result in scenarios.items():
+            print(f"{count:>8}{name:>13}{result['latency_ms']:>10}ms{result['youtube_calls']:>9}"
+                  f"{result['quota_units']:>8}{result['dynamodb_calls']:>10}"
+                  f"{result.get('unbatched_youtube_calls', ''):>11}")
+
+
+if __name__ == '__main__':
+    main()
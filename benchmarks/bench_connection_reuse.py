@@ -0,0 +1,93 @@
+"""Per-call overhead of building clients per request vs. reusing RealYoutubeDynamodb.
+
+Starts local stand-ins for the YouTube search API and DynamoDB on 127.0.0.1 and times
+`get_from_dynamodb` and `request_from_youtube` both ways:
+
+    python benchmarks/bench_connection_reuse.py [iterations]
+"""
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+os.environ.setdefault('TABLE', 'bench')
+
+import boto3  # noqa: E402
+import requests  # noqa: E402
+from app import RealYoutubeDynamodb  # noqa: E402
+
+SEARCH_RESPONSE = json.dumps({
+    "kind": "youtube#searchListResponse", "pageInfo": {"totalResults": 0, "resultsPerPage": 1}, "items": []}).encode()
+GET_ITEM_RESPONSE = json.dumps({"Item": {"channel": {"S": "bench"}, "time": {"N": "0"}}}).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real endpoints
+    disable_nagle_algorithm = True
+    wbufsize = -1  # send headers and body in one segment, avoiding delayed-ACK stalls on reused connections
+
+    def do_GET(self):
+        self.reply('application/json', SEARCH_RESPONSE)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply('application/x-amz-json-1.0', GET_ITEM_RESPONSE)
+
+    def reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def per_call_dynamodb(endpoint):
+    client = boto3.client('dynamodb', endpoint_url=endpoint)
+    client.get_item(Key={'channel': {'S': 'bench'}}, TableName=os.environ['TABLE'])
+
+
+def per_call_youtube(url):
+    requests.get(url, params={"channelId": "bench"}).json()
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:<32} mean {statistics.mean(samples):7.3f} ms  median {statistics.median(samples):7.3f} ms")
+
+
+def main(iterations=200):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    backend = RealYoutubeDynamodb(youtube_search_url=base + "/youtube/v3/search", dynamodb_endpoint_url=base)
+    try:
+        report("dynamodb, client per call", timed(lambda: per_call_dynamodb(base), iterations))
+        report("dynamodb, reused client", timed(lambda: backend.get_from_dynamodb('bench'), iterations))
+        report("youtube, bare requests.get", timed(lambda: per_call_youtube(base + "/youtube/v3/search"), iterations))
+        report("youtube, pooled session",
+               timed(lambda: backend.request_from_youtube({"channelId": "bench"}, 'bench'), iterations))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
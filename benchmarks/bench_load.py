@@ -0,0 +1,233 @@
+"""Latency, throughput and upstream calls per request path under concurrent load.
+
+Drives /v3/search and /live in-process, through chalice's LocalGateway or a local HTTP
+server, with stand-in YouTube and DynamoDB backends whose round trips follow lognormal
+distributions. Each scenario arranges for every request to take one path:
+
+    cache_hit        served from the in-process cache
+    dynamodb_hit     cache disabled, a stored result still within its ttl
+    youtube_refresh  cache disabled, a stored result past its ttl, youtube answers
+    sticky_expiry    as youtube_refresh with a live result whose expiry_time hasn't passed
+    error_fallback   as youtube_refresh but youtube fails, so the stored result is served
+
+p50/p95/p99 latency, throughput and upstream calls per 1k requests are printed and
+saved as JSON; pass an earlier file to --compare to see what changed since:
+
+    python benchmarks/bench_load.py [--requests 500] [--concurrency 8] [--mode gateway|http]
+                                    [--output FILE] [--compare OLD_FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.pop('TABLE', None)
+os.environ.pop('READ_ONLY_REQUEST_PATH', None)
+os.environ.setdefault('YOUTUBE_API_KEY_QUOTA', str(10 ** 12))  # the benchmark shouldn't run out of quota
+
+import requests  # noqa: E402
+from chalice.config import Config  # noqa: E402
+from chalice.local import ChaliceRequestHandler, LocalChalice, LocalGateway, create_local_server  # noqa: E402
+import app  # noqa: E402
+from chalicelib.cache import TieredCache  # noqa: E402
+from standins import StandInYoutubeDynamodb, lognormal  # noqa: E402
+
+CHANNEL_ID = "UCvjUFF1C3yO2KK17EjpiWGQ"
+LIVE = {"kind": "youtube#searchListResponse", "pageInfo": {"totalResults": 1, "resultsPerPage": 1}, "items": [
+    {"id": {"kind": "youtube#video", "videoId": "bench"}, "snippet": {"title": "Live", "channelId": CHANNEL_ID}}]}
+OFFLINE = {"kind": "youtube#searchListResponse", "pageInfo": {"totalResults": 0, "resultsPerPage": 1}, "items": []}
+ROUTES = {
+    "search": "/v3/search?" + "&".join(f"{name}={value}" for name, value in sorted(
+        dict(app.DEFAULT_PARAMS, channelId=CHANNEL_ID).items())),
+    "live": "/live"}
+SCENARIOS = ["cache_hit", "dynamodb_hit", "youtube_refresh", "sticky_expiry", "error_fallback"]
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def backend_for(scenario, args):
+    """A stand-in whose stored item sends every request down the scenario's path."""
+    backend = StandInYoutubeDynamodb(
+        lognormal(args.youtube_median * args.latency_scale, args.youtube_p99 * args.latency_scale),
+        lognormal(args.dynamodb_median * args.latency_scale, args.dynamodb_p99 * args.latency_scale),
+        youtube_status=500 if scenario == 'error_fallback' else 200,
+        frozen=scenario != 'cache_hit')
+    now = time.time()
+    if scenario == 'dynamodb_hit':
+        backend.items[CHANNEL_ID] = app.dynamodb_item(CHANNEL_ID, OFFLINE, now, now)
+    elif scenario == 'sticky_expiry':
+        stored_at = now - 2 * app.DYNAMODB_IF_STREAM_TTL
+        backend.items[CHANNEL_ID] = app.dynamodb_item(CHANNEL_ID, LIVE, stored_at, stored_at, now + 3600)
+    elif scenario != 'cache_hit':
+        stored_at = now - 2 * app.DYNAMODB_IF_STREAM_TTL
+        backend.items[CHANNEL_ID] = app.dynamodb_item(CHANNEL_ID, OFFLINE, stored_at, stored_at)
+    return backend
+
+
+def tier_counts(before, after):
+    return {
+        tier: {outcome: count - before.get(tier, {}).get(outcome, 0) for outcome, count in outcomes.items()}
+        for tier, outcomes in after.items()}
+
+
+class GatewayClient:
+    def __init__(self):
+        # as `chalice local` does, so concurrent requests each see their own current_request
+        app.app.__class__ = LocalChalice
+        self.gateway = LocalGateway(app.app, Config())
+
+    def get(self, path):
+        response = self.gateway.handle_request('GET', path, {'Host': 'localhost'}, b'')
+        return response['statusCode'], response['body']
+
+    def close(self):
+        pass
+
+
+class HttpClient:
+    """Goes through chalice's local dev server over keep-alive connections, one per thread."""
+    def __init__(self):
+        # the dev server writes headers and body separately, which would otherwise stall
+        # on delayed ACKs for ~40ms a request
+        ChaliceRequestHandler.disable_nagle_algorithm = True
+        self.server = create_local_server(app.app, Config(), '127.0.0.1', 0)
+        self.base = "http://127.0.0.1:%s" % (self.server.server.server_address[1],)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.local = threading.local()
+
+    def get(self, path):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        response = session.get(self.base + path)
+        return response.status_code, response.text
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(route, scenario, args):
+    app.reset_all()
+    backend = backend_for(scenario, args)
+    # a cache whose entries expire as they are put makes every request go past it
+    cache = app.CACHE if scenario == 'cache_hit' else TieredCache(0, 0, 0, submit=app.EXECUTOR.submit)
+    with mock.patch.dict('app.CHANNELS', {"elc": CHANNEL_ID}, clear=True), \
+            mock.patch('app.YOUTUBE_AND_DYNAMODB', backend), mock.patch('app.CACHE', cache):
+        client = HttpClient() if args.mode == 'http' else GatewayClient()
+        try:
+            if scenario == 'cache_hit':
+                client.get(ROUTES[route])
+            with backend.lock:
+                backend.calls.clear()
+            before = cache.stats()
+
+            def one(_):
+                start = time.perf_counter()
+                status_code, body = client.get(ROUTES[route])
+                return (time.perf_counter() - start) * 1000, status_code
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                samples = list(pool.map(one, range(args.requests)))
+            wall = time.perf_counter() - start
+            tiers = tier_counts(before, cache.stats())
+        finally:
+            client.close()
+    latencies = [elapsed for elapsed, _ in samples]
+    youtube_calls, dynamodb_calls = backend.upstream_calls()
+    result = {
+        "requests": args.requests,
+        "errors": sum(1 for _, status_code in samples if status_code != 200),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "mean_ms": round(statistics.mean(latencies), 2),
+        "throughput_rps": round(args.requests / wall, 1),
+        "youtube_calls_per_1k": round(youtube_calls * 1000 / args.requests, 1),
+        "dynamodb_calls_per_1k": round(dynamodb_calls * 1000 / args.requests, 1),
+        # how the requests were answered, tier by tier, so a scenario that missed its path shows up
+        "tiers": tiers}
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(report, previous=None):
+    print(f"{'route':<8}{'scenario':<17}{'p50':>9}{'p95':>9}{'p99':>9}{'rps':>9}{'yt/1k':>9}{'ddb/1k':>9}{'errors':>8}")
+    for route, scenarios in report["results"].items():
+        for scenario, result in scenarios.items():
+            print(f"{route:<8}{scenario:<17}{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}"
+                  f"{result['throughput_rps']:>9}{result['youtube_calls_per_1k']:>9}"
+                  f"{result['dynamodb_calls_per_1k']:>9}{result['errors']:>8}")
+            old = (previous or {}).get("results", {}).get(route, {}).get(scenario)
+            if old:
+                changes = []
+                for name in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "youtube_calls_per_1k"):
+                    if old[name]:
+                        changes.append(f"{name} {100 * (result[name] - old[name]) / old[name]:+.0f}%")
+                print(f"{'':<25}vs {previous['commit']}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500, help="requests per route and scenario")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=['gateway', 'http'], default='gateway')
+    parser.add_argument('--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--youtube-median', type=float, default=0.12, help="seconds")
+    parser.add_argument('--youtube-p99', type=float, default=0.6)
+    parser.add_argument('--dynamodb-median', type=float, default=0.006)
+    parser.add_argument('--dynamodb-p99', type=float, default=0.03)
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplies every upstream latency")
+    parser.add_argument('--output', help="where to save the JSON report, by default results/load-<commit>.json")
+    parser.add_argument('--compare', help="an earlier JSON report to compare with")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+        "python": platform.python_version(),
+        "settings": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "results": {}}
+    # the app's request logging would swamp the report
+    with open(os.devnull, 'w') as devnull, mock.patch('sys.stdout', devnull):
+        for route in args.routes:
+            report["results"][route] = {
+                scenario: run_scenario(route, scenario, args) for scenario in args.scenarios}
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    print(f"Saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
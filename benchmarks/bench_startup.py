@@ -0,0 +1,111 @@
+"""Cold start cost: importing app.py and answering the first request in a fresh interpreter.
+
+Each run starts a new python under `-X importtime` and times, in that process:
+
+    import_ms         importing app, as the lambda init phase does
+    first_live_ms     the first /live, against stand-ins answering at once, nothing cached
+    second_live_ms    the same request again, now from the cache
+    deferred_ms       importing boto3 and requests, which the first cache miss pays for
+
+The slowest of app's imports by cumulative time come from the importtime output of the last run:
+
+    python benchmarks/bench_startup.py [--runs 5] [--top 10] [--json]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def child():
+    sys.path.insert(0, os.path.dirname(BENCHMARKS))
+    os.environ.pop('TABLE', None)
+    start = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    from unittest import mock
+    from chalice.config import Config
+    from chalice.local import LocalGateway
+    from standins import StandInYoutubeDynamodb, fixed
+    backend = StandInYoutubeDynamodb(fixed(0), fixed(0))
+    timings = {"import_ms": (imported - start) * 1000}
+    with mock.patch('app.YOUTUBE_AND_DYNAMODB', backend):
+        gateway = LocalGateway(app.app, Config())
+        for name in ("first_live_ms", "second_live_ms"):
+            start = time.perf_counter()
+            response = gateway.handle_request('GET', '/live', {'Host': 'localhost'}, b'')
+            timings[name] = (time.perf_counter() - start) * 1000
+            assert response['statusCode'] == 200, response
+    start = time.perf_counter()
+    import boto3  # noqa: F401
+    import requests  # noqa: F401
+    timings["deferred_ms"] = (time.perf_counter() - start) * 1000
+    # on stderr like -X importtime, so the app's own logging on stdout doesn't get in the way
+    print("timings " + json.dumps(timings), file=sys.stderr)
+
+
+def slowest_imports(stderr, top):
+    """What importing app pulled in, by cumulative milliseconds; each module is printed after its own imports."""
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3))))
+    end = next(index for index, (module, _, _, _) in enumerate(imports) if module == 'app')
+    depth = imports[end][3]
+    start = end
+    while start > 0 and imports[start - 1][3] > depth:
+        start -= 1
+    return [
+        {"module": module, "self_ms": round(own / 1000, 1), "cumulative_ms": round(cumulative / 1000, 1)}
+        for module, own, cumulative, level in sorted(imports[start:end + 1], key=lambda i: -i[2])
+        if level <= depth + 2][:top]
+
+
+def run_once():
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child'],
+        cwd=os.path.dirname(BENCHMARKS), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    timings = next(
+        json.loads(line[len("timings "):]) for line in process.stderr.splitlines() if line.startswith("timings "))
+    return timings, process.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="how many of the slowest imports to list")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+    runs = [run_once() for _ in range(args.runs)]
+    report = {
+        "runs": args.runs,
+        "median": {
+            name: round(statistics.median(timings[name] for timings, _ in runs), 1)
+            for name in runs[0][0]},
+        "slowest_imports": slowest_imports(runs[-1][1], args.top)}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for name, value in report["median"].items():
+        print(f"{name:<16}{value:>9}ms")
+    print()
+    print(f"{'module':<40}{'self':>9}{'cumulative':>13}")
+    for entry in report["slowest_imports"]:
+        print(f"{entry['module']:<40}{entry['self_ms']:>7}ms{entry['cumulative_ms']:>11}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Replays a synthetic week of streams and compares polling policies.
+
+The learnt cadence is trained by running it over a few warm-up weeks first, the way
+it would learn in production. For each policy it reports the quota spent (one 100 unit
+search.list per check, ignoring cheaper probes) and how long each stream start took
+to detect. Checks are gated the way the request path gates them: youtube isn't asked
+again within MIN_TIME_BEFORE_UPSTREAM_CHECKS unless the cadence wants it sooner. The
+learnt_fixed_gate row shows the cadence under that gate alone, which caps it at the
+fixed ttls' rate:
+
+    python benchmarks/simulate_cadence.py [--weeks N] [--seed S] [--json]
+"""
+import argparse
+import calendar
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import DYNAMODB_IF_STREAM_TTL, DYNAMODB_IF_NO_STREAM_TTL, MIN_TIME_BEFORE_UPSTREAM_CHECKS  # noqa: E402
+from app import earliest_upstream_check  # noqa: E402
+from chalicelib.cadence import StreamSchedule  # noqa: E402
+from chalicelib.keys import SEARCH_COST  # noqa: E402
+
+WEEK = 7 * 24 * 3600
+DAY = 24 * 3600
+
+
+def synthetic_week(week_start, rng):
+    """Nightly majlis around 19:30 UTC, Friday prayers at 12:15 and a couple of one-offs."""
+    streams = []
+    for day in range(7):
+        midnight = week_start + day * DAY
+        start = midnight + 19.5 * 3600 + rng.uniform(-600, 600)
+        streams.append((start, start + rng.uniform(1.5, 2.5) * 3600))
+        if datetime.datetime.utcfromtimestamp(midnight).weekday() == 4:
+            start = midnight + 12.25 * 3600 + rng.uniform(-300, 300)
+            streams.append((start, start + 3600))
+    for _ in range(2):
+        start = week_start + rng.uniform(0, WEEK - DAY)
+        streams.append((start, start + 3600))
+    return sorted(streams)
+
+
+def is_live(streams, at):
+    return any(start <= at < end for start, end in streams)
+
+
+def replay(streams, week_start, next_check):
+    checks = 0
+    delays = []
+    missed = 0
+    pending = [start for start, _end in streams]
+    at = week_start
+    while at < week_start + WEEK:
+        checks += 1
+        live = is_live(streams, at)
+        while pending and pending[0] <= at:
+            start = pending.pop(0)
+            delays.append(at - start)
+            missed += not live  # over before we looked
+        at = next_check(at, live)
+    return {
+        "checks": checks,
+        "quota_units": checks * SEARCH_COST,
+        "mean_detection_delay": round(statistics.mean(delays), 1) if delays else None,
+        "p95_detection_delay": round(sorted(delays)[int(len(delays) * 0.95) - 1], 1) if delays else None,
+        "max_detection_delay": round(max(delays), 1) if delays else None,
+        "streams": len(streams),
+        "missed_streams": missed}
+
+
+def fixed_policy(at, live):
+    return at + (DYNAMODB_IF_STREAM_TTL if live else DYNAMODB_IF_NO_STREAM_TTL)
+
+
+def learnt_policy(schedule, streams):
+    def next_check(at, live):
+        schedule.observe(at, is_live(streams, at))
+        return schedule.next_check_time(at, live, DYNAMODB_IF_STREAM_TTL if live else DYNAMODB_IF_NO_STREAM_TTL)
+    return next_check
+
+
+def gated(policy, earliest=earliest_upstream_check):
+    """The policy, checking no sooner than `earliest(last check, wanted check)` lets youtube be asked again."""
+    def next_check(at, live):
+        wanted = policy(at, live)
+        return max(wanted, earliest(at, wanted))
+    return next_check
+
+
+def fixed_gate(since, next_check):
+    return since + MIN_TIME_BEFORE_UPSTREAM_CHECKS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--weeks', type=int, default=4, help="warm-up weeks to learn from")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    first_week = calendar.timegm(datetime.datetime(2026, 9, 7).timetuple())  # a Monday
+
+    schedule = StreamSchedule()
+    for week in range(args.weeks):
+        week_start = first_week + week * WEEK
+        streams = synthetic_week(week_start, rng)
+        replay(streams, week_start, gated(learnt_policy(schedule, streams)))
+
+    week_start = first_week + args.weeks * WEEK
+    streams = synthetic_week(week_start, rng)
+    trained = schedule.to_json()
+    report = {
+        "fixed_ttls": replay(streams, week_start, gated(fixed_policy)),
+        "learnt_cadence": replay(streams, week_start, gated(learnt_policy(schedule, streams))),
+        "learnt_fixed_gate": replay(
+            streams, week_start, gated(learnt_policy(StreamSchedule.from_json(trained), streams), fixed_gate))}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'policy':<20}{'checks':>8}{'quota':>10}{'mean delay':>12}{'p95 delay':>12}{'max delay':>12}{'missed':>8}")
+    for name, result in report.items():
+        print(f"{name:<20}{result['checks']:>8}{result['quota_units']:>10}"
+              f"{result['mean_detection_delay']:>11}s{result['p95_detection_delay']:>11}s"
+              f"{result['max_detection_delay']:>11}s{result['missed_streams']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""In-memory stand-ins for DynamoDB and the YouTube API shared by the benchmarks."""
+import collections
+import math
+import random
+import threading
+import time
+
+import app
+
+OFFLINE = {"kind": "youtube#searchListResponse", "pageInfo": {"totalResults": 0, "resultsPerPage": 1}, "items": []}
+
+
+def fixed(seconds):
+    return lambda: seconds
+
+
+def lognormal(median, p99, rng=None):
+    """Round trips that usually take about `median` seconds with a long tail reaching `p99`."""
+    rng = rng or random.Random(1)
+    sigma = math.log(p99 / median) / 2.326
+    return lambda: rng.lognormvariate(math.log(median), sigma)
+
+
+class StandInYoutubeDynamodb:
+    """Keeps items in a dict and answers every search offline and every probed video as upcoming.
+
+    Each call sleeps for a draw from its latency distribution. With `frozen` set,
+    writes are counted but dropped, so every request finds the same stored items;
+    `youtube_status` other than 200 makes every youtube call fail.
+    """
+    def __init__(self, youtube_latency=fixed(0.02), dynamodb_latency=fixed(0.005), youtube_status=200,
+                 frozen=False):
+        self.youtube_latency = youtube_latency
+        self.dynamodb_latency = dynamodb_latency
+        self.youtube_status = youtube_status
+        self.frozen = frozen
+        self.items = {}
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name, latency):
+        with self.lock:
+            self.calls[name] += 1
+        time.sleep(latency())
+
+    def upstream_calls(self):
+        with self.lock:
+            youtube = self.calls['search.list'] + self.calls['videos.list']
+            return youtube, sum(self.calls.values()) - youtube
+
+    def get_from_dynamodb(self, key):
+        self.count('get_item', self.dynamodb_latency)
+        return self.items.get(key)
+
+    def batch_get_from_dynamodb(self, keys):
+        keys = list(keys)
+        for _ in range(0, len(keys), app.DYNAMODB_BATCH_GET_LIMIT):
+            self.count('batch_get_item', self.dynamodb_latency)
+        return {key: self.items[key] for key in keys if key in self.items}
+
+    def put_to_dynamodb(self, item):
+        self.count('put_item', self.dynamodb_latency)
+        if not self.frozen:
+            self.items[item['channel']['S']] = item
+
+    def conditional_put_to_dynamodb(self, item, revision):
+        self.count('put_item', self.dynamodb_latency)
+        stored = self.items.get(item['channel']['S']) or {}
+        if int(stored.get('revision', {}).get('N', 0)) != revision:
+            return False
+        if not self.frozen:
+            self.items[item['channel']['S']] = dict(item, revision={'N': str(revision + 1)})
+        return True
+
+    def batch_write_to_dynamodb(self, items):
+        for _ in range(0, len(items), app.DYNAMODB_BATCH_WRITE_LIMIT):
+            self.count('batch_write_item', self.dynamodb_latency)
+        if not self.frozen:
+            self.items.update((item['channel']['S'], item) for item in items)
+
+    def write_to_dynamodb(self, channel, result, expiry_time=None):
+        now = time.time()
+        self.put_to_dynamodb(app.dynamodb_item(channel, result, now, now, expiry_time))
+
+    def update_dynamodb(self, channel, result, create_time, expiry_time=None):
+        self.put_to_dynamodb(app.dynamodb_item(channel, result, create_time, time.time(), expiry_time))
+
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        self.count('update_item', self.dynamodb_latency)
+        return True
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        self.count('update_item', self.dynamodb_latency)
+
+    def request_from_youtube(self, params, key_origin):
+        self.count('search.list', self.youtube_latency)
+        if self.youtube_status != 200:
+            return self.youtube_status, {"error": {"code": self.youtube_status}}
+        return 200, OFFLINE
+
+    def request_videos_from_youtube(self, params, key_origin):
+        self.count('videos.list', self.youtube_latency)
+        if self.youtube_status != 200:
+            return self.youtube_status, {"error": {"code": self.youtube_status}}
+        start = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600))
+        return 200, {"kind": "youtube#videoListResponse", "items": [
+            {"id": video_id, "liveStreamingDetails": {"scheduledStartTime": start}}
+            for video_id in params["id"].split(",")]}
@@ -0,0 +1,73 @@
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a dependency that keeps failing or answering slowly.
+
+    After failure_threshold consecutive bad calls (errors, failed results, or calls
+    slower than slow_call_seconds) the circuit opens and calls raise CircuitOpen at
+    once. After reset_timeout one trial call is let through; a good one closes it again.
+    """
+    def __init__(self, name, failure_threshold=3, slow_call_seconds=None, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record(self, ok, duration=0):
+        if ok and self.slow_call_seconds is not None and duration > self.slow_call_seconds:
+            print(f"{self.name} call took {duration:.2f}s")
+            ok = False
+        with self.lock:
+            self.trial_running = False
+            if ok:
+                if self.state != CLOSED:
+                    print(f"Closing {self.name} circuit")
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    print(f"Opening {self.name} circuit after {self.failures} bad calls")
+                self.state = OPEN
+                self.opened_at = self.clock()
+
+    def call(self, fn, *args, failed=None, expected=None, **kwargs):
+        """Calls fn unless the circuit is open; `failed(result)` and `expected(exc)` say what counts against it."""
+        if not self.allow():
+            raise CircuitOpen(f"{self.name} circuit open")
+        start = self.clock()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exc:
+            self.record(bool(expected and expected(exc)), self.clock() - start)
+            raise
+        self.record(not (failed and failed(result)), self.clock() - start)
+        return result
@@ -0,0 +1,123 @@
+import collections
+import threading
+import time
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISS = 'miss'
+
+CacheEntry = collections.namedtuple('CacheEntry', ['value', 'fresh_until', 'stale_until'])
+
+
+def start_thread(fn, *args):
+    thread = threading.Thread(target=fn, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class TieredCache:
+    """In-process results in front of dynamodb and youtube.
+
+    Live and offline entries get their own ttl and never stay fresh past the stored
+    expiry_time they are put with. For stale_window seconds after that an entry is still
+    served, marked STALE, while exactly one background refresh per key replaces it.
+    Past the window a lookup misses, but the entry is kept as the last good value
+    until maxsize pushes it out. Hits, misses and stale serves are counted per tier;
+    lookups count against the "memory" tier and callers record the tiers behind it.
+    """
+    def __init__(self, live_ttl, offline_ttl, stale_window, maxsize=100, clock=time.time, submit=start_thread):
+        self.live_ttl = live_ttl
+        self.offline_ttl = offline_ttl
+        self.stale_window = stale_window
+        self.maxsize = maxsize
+        self.clock = clock
+        self.submit = submit
+        self.entries = collections.OrderedDict()
+        self.refreshing = set()
+        self.counts = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+
+    def put(self, key, value, live=False, expiry_time=None):
+        fresh_until = self.clock() + (self.live_ttl if live else self.offline_ttl)
+        if expiry_time:
+            fresh_until = min(fresh_until, expiry_time)
+        with self.lock:
+            self.entries[key] = CacheEntry(value, fresh_until, fresh_until + self.stale_window)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get(self, key, refresh=None):
+        """Returns (value, FRESH or STALE) or (None, MISS); a STALE lookup starts `refresh` unless one is running."""
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or now >= entry.stale_until:
+                self.counts['memory'][MISS] += 1
+                return None, MISS
+            self.entries.move_to_end(key)
+            if now < entry.fresh_until:
+                self.counts['memory']['hit'] += 1
+                return entry.value, FRESH
+            self.counts['memory'][STALE] += 1
+            start = refresh is not None and key not in self.refreshing
+            if start:
+                self.refreshing.add(key)
+        if start:
+            try:
+                self.submit(self.run_refresh, key, refresh)
+            except Exception:
+                with self.lock:
+                    self.refreshing.discard(key)
+                raise
+        return entry.value, STALE
+
+    def run_refresh(self, key, refresh):
+        try:
+            refresh()
+        except Exception as exc:
+            print(f"Exception refreshing {key} in the background: {exc}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def last_good(self, key):
+        """The newest value put for key, however old."""
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry.value if entry else None
+
+    def invalidate(self, key):
+        # ends the entry's fresh and stale life but keeps it as the last good value
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries[key] = CacheEntry(entry.value, 0, 0)
+
+    def record(self, tier, outcome):
+        with self.lock:
+            self.counts[tier][outcome] += 1
+
+    def stats(self):
+        with self.lock:
+            return {tier: dict(counts) for tier, counts in self.counts.items()}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.refreshing.clear()
+            self.counts.clear()
+
+    def __contains__(self, key):
+        """Whether a lookup would be served, fresh or stale."""
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and self.clock() < entry.stale_until
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.entries[key].value
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,194 @@
+import datetime
+import json
+import math
+import threading
+import time
+import traceback
+
+BUCKET_SECONDS = 15 * 60
+BUCKETS = 7 * 24 * 3600 // BUCKET_SECONDS  # a week of quarter hours
+WINDOW_BUCKETS = 2  # a start counts towards the half hour either side of it
+DECAY = 0.97  # each new start fades older ones so a changed timetable is learnt in a few weeks
+MIN_INTERVAL = 60
+MAX_INTERVAL = 1800
+SCHEDULED_LEAD = 10 * 60  # poll tightly from this long before a scheduled start...
+SCHEDULED_LAG = 30 * 60  # ...until this long after it
+SCHEDULED_RETENTION = 6 * 3600
+STEP = 60
+RELOAD_INTERVAL = 300  # how soon what another container learnt (e.g. the api's for the poller) is used here
+SAVE_ATTEMPTS = 3  # writes to one item racing another container's
+
+
+def schedule_key(channel):
+    return f"schedule#{channel}"
+
+
+def week_bucket(now):
+    # buckets are in UTC, so a timetable fixed to local time smears by an hour across DST changes
+    return int(now % (7 * 24 * 3600) // BUCKET_SECONDS)
+
+
+def parse_time(value):
+    return (datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S') - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+class StreamSchedule:
+    """What one channel's live/offline history says about when it next goes live.
+
+    Stream starts are counted in a weekday/time-of-day histogram; scheduled starts of
+    upcoming broadcasts are kept alongside. With neither, next_check_time falls back to
+    the fixed interval it is given.
+    """
+    def __init__(self, counts=None, scheduled=None, live=None):
+        self.counts = {int(bucket): count for bucket, count in (counts or {}).items()}
+        self.scheduled = sorted(scheduled or [])
+        self.live = live
+        self._hottest = None
+
+    def to_json(self):
+        return json.dumps({"counts": self.counts, "scheduled": self.scheduled, "live": self.live})
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data.get("counts"), data.get("scheduled"), data.get("live"))
+
+    def copy(self):
+        return StreamSchedule(dict(self.counts), list(self.scheduled), self.live)
+
+    def observe(self, now, live):
+        """Records a live/offline observation, returning True when it is a transition."""
+        first = self.live is None
+        changed = not first and self.live != live
+        if live and self.live is False:
+            for bucket in self.counts:
+                self.counts[bucket] *= DECAY
+            bucket = week_bucket(now)
+            self.counts[bucket] = self.counts.get(bucket, 0) + 1
+            self._hottest = None
+        self.live = live
+        return first or changed
+
+    def add_scheduled(self, now, start_times):
+        known = set(self.scheduled)
+        self.scheduled = sorted(
+            start for start in known.union(start_times) if start > now - SCHEDULED_RETENTION)
+        return set(self.scheduled) != known
+
+    def has_model(self):
+        return bool(self.counts) or bool(self.scheduled)
+
+    def heat(self, at):
+        """How likely a start is around `at`, from 0 (never seen) to 1 (the busiest slot)."""
+        if not self.counts:
+            return 0
+        if self._hottest is None:
+            self._hottest = max(self.window_mass(bucket) for bucket in self.counts)
+        return self.window_mass(week_bucket(at)) / self._hottest if self._hottest else 0
+
+    def window_mass(self, bucket):
+        return sum(
+            self.counts.get((bucket + offset) % BUCKETS, 0) for offset in range(-WINDOW_BUCKETS, WINDOW_BUCKETS + 1))
+
+    def interval_at(self, at, safety_interval=None):
+        for start in self.scheduled:
+            if start - SCHEDULED_LEAD <= at <= start + SCHEDULED_LAG:
+                return MIN_INTERVAL
+        if safety_interval:
+            return safety_interval
+        # geometric between MAX_INTERVAL when cold and MIN_INTERVAL at the busiest slot
+        return MAX_INTERVAL * math.pow(MIN_INTERVAL / MAX_INTERVAL, self.heat(at))
+
+    def next_check_time(self, last_checked, live, fixed_interval, safety_interval=None):
+        """When to next check; with a safety_interval (push notifications announce new broadcasts)
+        the history is ignored and only scheduled starts are polled tightly."""
+        if live or not (self.has_model() or safety_interval):
+            return last_checked + fixed_interval
+        # a stream starting at any t after the last check should be seen within interval_at(t)
+        next_check = last_checked + (safety_interval or MAX_INTERVAL)
+        at = last_checked
+        while at < next_check:
+            next_check = min(next_check, at + self.interval_at(at, safety_interval))
+            at += STEP
+        return next_check
+
+
+class ScheduleBook:
+    """In-process StreamSchedules, persisted as ``schedule#<channel>`` items when they change.
+
+    The api and the poller lambdas both observe channels, so a schedule is re-read every
+    RELOAD_INTERVAL and changes are applied to the stored one, written back only if no
+    other container wrote it in between.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.schedules = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def get(self, channel):
+        with self.lock:
+            return self.schedules.setdefault(channel, StreamSchedule())
+
+    def trial(self, channel):
+        # what a change would do, tried first so most observations, which change nothing, cost no read
+        with self.lock:
+            return self.schedules.get(channel, StreamSchedule()).copy()
+
+    def stale(self, channel):
+        return channel not in self.loaded or self.clock() - self.loaded[channel] >= RELOAD_INTERVAL
+
+    def read(self, channel, store):
+        try:
+            return store.get_from_dynamodb(schedule_key(channel))
+        except Exception as exc:
+            print("Exception loading stream schedule: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def load(self, channel, store, force=False):
+        if not force and not self.stale(channel):
+            return
+        item = self.read(channel, store)
+        with self.lock:
+            self.loaded[channel] = self.clock()
+            if item and item.get('schedule', {}).get('S'):
+                self.schedules[channel] = StreamSchedule.from_json(item['schedule']['S'])
+
+    def update(self, channel, store, change):
+        """Applies change(schedule), which says whether it changed anything, to the stored schedule and ours."""
+        for _attempt in range(SAVE_ATTEMPTS):
+            item = self.read(channel, store)
+            with self.lock:
+                if item and item.get('schedule', {}).get('S'):
+                    schedule = StreamSchedule.from_json(item['schedule']['S'])
+                else:
+                    schedule = self.schedules.get(channel, StreamSchedule()).copy()
+                changed = change(schedule)
+                self.schedules[channel] = schedule
+                self.loaded[channel] = self.clock()
+                data = schedule.to_json()
+            if not changed:
+                return False
+            revision = int(item.get('revision', {}).get('N', 0)) if item else 0
+            if store.conditional_put_to_dynamodb(
+                    {'channel': {'S': schedule_key(channel)}, 'schedule': {'S': data}}, revision):
+                return True
+        print(f"Gave up saving the stream schedule for {channel} after {SAVE_ATTEMPTS} conflicting writes")
+        return True
+
+    def observe(self, channel, now, live, store):
+        self.load(channel, store)
+        if self.trial(channel).observe(now, live) and self.update(
+                channel, store, lambda schedule: schedule.observe(now, live)):
+            print(f"Recording {channel} as {'live' if live else 'offline'} in its stream schedule")
+
+    def add_scheduled(self, channel, now, start_times, store):
+        self.load(channel, store)
+        if self.trial(channel).add_scheduled(now, start_times):
+            self.update(channel, store, lambda schedule: schedule.add_scheduled(now, start_times))
+
+    def next_check_time(self, channel, last_checked, live, fixed_interval, safety_interval=None):
+        schedule = self.get(channel)
+        with self.lock:
+            return schedule.next_check_time(last_checked, live, fixed_interval, safety_interval)
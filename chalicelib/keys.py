@@ -0,0 +1,194 @@
+import datetime
+import random
+import threading
+import time
+import traceback
+
+SEARCH_COST = 100  # quota units for one search.list call
+DEFAULT_DAILY_QUOTA = 10000
+RATE_LIMIT_BACKOFF = 60  # seconds a key sits out after a 429 or a 403 for its per-second rate
+USAGE_REFRESH_INTERVAL = 60  # how often to pull other containers' spend from storage
+EXHAUSTED_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def pacific_offset(now):
+    # youtube quotas reset at midnight Pacific time: UTC-7 from the second Sunday of March
+    # at 02:00 local until the first Sunday of November at 02:00 local, UTC-8 otherwise
+    utc = datetime.datetime.utcfromtimestamp(now)
+    march = datetime.datetime(utc.year, 3, 8)
+    dst_start = march + datetime.timedelta(days=(6 - march.weekday()) % 7, hours=10)
+    november = datetime.datetime(utc.year, 11, 1)
+    dst_end = november + datetime.timedelta(days=(6 - november.weekday()) % 7, hours=9)
+    return -7 if dst_start <= utc < dst_end else -8
+
+
+def pacific_day(now):
+    return (datetime.datetime.utcfromtimestamp(now) + datetime.timedelta(hours=pacific_offset(now))).date().isoformat()
+
+
+def next_pacific_midnight(now):
+    local = datetime.datetime.utcfromtimestamp(now) + datetime.timedelta(hours=pacific_offset(now))
+    midnight = datetime.datetime.combine(local.date() + datetime.timedelta(days=1), datetime.time())
+    epoch = datetime.datetime(1970, 1, 1)
+    candidate = (midnight - epoch).total_seconds() - pacific_offset(now) * 3600
+    # the offset may differ at midnight if DST changed since now
+    return (midnight - epoch).total_seconds() - pacific_offset(candidate) * 3600
+
+
+def parse_keys(keys):
+    all_keys = []
+    for key in keys.split(','):
+        origin, value = key.split(':')
+        all_keys.append((origin, value))
+    return all_keys
+
+
+def error_reasons(result):
+    try:
+        return [error.get('reason') for error in result['error']['errors']]
+    except (KeyError, TypeError, AttributeError):
+        return []
+
+
+def is_rate_limit_error(status_code, result):
+    # short term limits on calls per second, which lift again well before the daily quota resets
+    if status_code == 429:
+        return True
+    return status_code == 403 and any(reason in RATE_LIMIT_REASONS for reason in error_reasons(result))
+
+
+def is_quota_error(status_code, result):
+    if status_code != 403 or is_rate_limit_error(status_code, result):
+        return False
+    reasons = error_reasons(result)
+    return any(reason in EXHAUSTED_REASONS for reason in reasons) or not reasons
+
+
+class KeyUsage:
+    def __init__(self):
+        self.spent = 0
+        self.failures = 0
+        self.quarantined_until = 0
+
+
+class KeyScheduler:
+    """Picks the youtube api key with the most remaining daily quota.
+
+    Spend and failures are kept per key per Pacific day, both in-process and in storage
+    (items keyed ``apikey#<origin>#<day>``) so every container sees the same budget.
+    A key that runs out is quarantined until the next Pacific midnight, one that is
+    rate limited for RATE_LIMIT_BACKOFF seconds.
+    """
+    def __init__(self, keys, daily_quota=DEFAULT_DAILY_QUOTA, clock=time.time):
+        self.keys = dict(parse_keys(keys))
+        self.daily_quota = daily_quota
+        self.clock = clock
+        self.day = None
+        self.usage = {}
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def usage_key(self, origin):
+        return f"apikey#{origin}#{self.day}"
+
+    def roll_day(self, now):
+        day = pacific_day(now)
+        if day != self.day:
+            self.day = day
+            self.usage = {origin: KeyUsage() for origin in self.keys}
+            self.refreshed_at = 0
+
+    def refresh(self, store, now):
+        # the read is made outside the lock so picks on other threads don't wait on storage meanwhile
+        with self.lock:
+            self.roll_day(now)
+            if now - self.refreshed_at < USAGE_REFRESH_INTERVAL:
+                return
+            self.refreshed_at = now
+            day = self.day
+            usage_keys = {origin: self.usage_key(origin) for origin in self.keys}
+        try:
+            items = store.batch_get_from_dynamodb(list(usage_keys.values()))
+        except Exception as exc:
+            print("Exception reading api key usage: %s" % (exc,))
+            traceback.print_exc()
+            return
+        with self.lock:
+            if self.day == day:
+                self.merge(items or {}, usage_keys)
+
+    def merge(self, items, usage_keys):
+        for origin, usage_key in usage_keys.items():
+            item = items.get(usage_key)
+            if item:
+                usage = self.usage[origin]
+                usage.spent = max(usage.spent, int(float(item.get('spent', {}).get('N', 0))))
+                usage.failures = max(usage.failures, int(float(item.get('failures', {}).get('N', 0))))
+                usage.quarantined_until = max(
+                    usage.quarantined_until, float(item.get('quarantined_until', {}).get('N', 0)))
+
+    def remaining(self, origin):
+        return self.daily_quota - self.usage[origin].spent
+
+    def pick(self, store, exclude=()):
+        now = self.clock()
+        self.refresh(store, now)
+        with self.lock:
+            self.roll_day(now)
+            candidates = [
+                origin for origin in self.keys
+                if origin not in exclude and self.usage[origin].quarantined_until <= now and self.remaining(origin) > 0]
+            if not candidates:
+                return None
+            best = max(self.remaining(origin) for origin in candidates)
+            origin = random.choice([origin for origin in candidates if self.remaining(origin) == best])
+            return origin, self.keys[origin]
+
+    def record(self, store, origin, status_code, result=None, units=SEARCH_COST):
+        if origin not in self.keys:
+            return
+        now = self.clock()
+        quarantined_until = None
+        failures = 0
+        with self.lock:
+            self.roll_day(now)
+            usage = self.usage[origin]
+            if status_code == 200:
+                usage.spent += units
+                if self.remaining(origin) <= 0:
+                    quarantined_until = next_pacific_midnight(now)
+            else:
+                failures = 1
+                usage.failures += 1
+                if is_rate_limit_error(status_code, result):
+                    quarantined_until = now + RATE_LIMIT_BACKOFF
+                elif is_quota_error(status_code, result):
+                    quarantined_until = next_pacific_midnight(now)
+                    usage.spent = max(usage.spent, self.daily_quota)
+            if quarantined_until:
+                usage.quarantined_until = max(usage.quarantined_until, quarantined_until)
+            usage_key = self.usage_key(origin)
+        store.record_key_usage(usage_key, units if status_code == 200 else 0, failures, quarantined_until)
+
+    def health(self):
+        now = self.clock()
+        with self.lock:
+            self.roll_day(now)
+            return {
+                origin: {
+                    "remaining": max(self.remaining(origin), 0),
+                    "failures": self.usage[origin].failures,
+                    "quarantined_until": (
+                        self.usage[origin].quarantined_until if self.usage[origin].quarantined_until > now else None)}
+                for origin in self.keys}
+
+    def health_summary(self):
+        parts = []
+        for origin, health in sorted(self.health().items()):
+            if health["quarantined_until"]:
+                until = datetime.datetime.utcfromtimestamp(health["quarantined_until"]).strftime('%Y-%m-%dT%H:%M:%SZ')
+                parts.append(f"{origin} quarantined until {until}")
+            else:
+                parts.append(f"{origin} {health['remaining']} units left")
+        return ", ".join(parts)
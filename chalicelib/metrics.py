@@ -0,0 +1,183 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import random
+import threading
+import time
+import uuid
+
+NAMESPACE = "HujjatYtProxy"
+MAX_VALUES = 100  # CloudWatch takes at most 100 values per metric in one record
+
+CURRENT_TRACE = contextvars.ContextVar('trace', default=None)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullMetrics:
+    """What the app records into when metrics are off: every call returns at once."""
+    enabled = False
+
+    def count(self, name, value=1, **dimensions):
+        pass
+
+    def timing(self, name, milliseconds, **dimensions):
+        pass
+
+    def span(self, name, **attributes):
+        return NULL_SPAN
+
+    def trace(self, name, **properties):
+        return NULL_SPAN
+
+    def bind(self, fn):
+        return fn
+
+    def flush(self, trace=None):
+        pass
+
+
+class Trace:
+    def __init__(self, name, properties, clock):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.properties = properties
+        self.clock = clock
+        self.start = clock()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def record(self):
+        with self.lock:
+            spans = list(self.spans)
+        return dict(
+            self.properties, trace_id=self.id, trace=self.name,
+            duration_ms=round((self.clock() - self.start) * 1000, 3), spans=spans)
+
+
+class Span:
+    def __init__(self, metrics, trace, name, attributes):
+        self.metrics = metrics
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = self.trace.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = self.trace.clock()
+        duration = (end - self.start) * 1000
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.trace.add(dict(
+            self.attributes, name=self.name, start_ms=round((self.start - self.trace.start) * 1000, 3),
+            duration_ms=round(duration, 3)))
+        self.metrics.timing("StageLatency", duration, Stage=self.name)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Metrics(NullMetrics):
+    """Counts and timings emitted as CloudWatch Embedded Metric Format log lines.
+
+    Counts and timings are aggregated per name and dimensions until flush(), which
+    writes one EMF record per set of dimensions. trace() wraps a request; a
+    `sample_rate` share of requests also get their stages timed as spans, emitted
+    with the trace when it ends. Work handed to other threads keeps its request's
+    trace when submitted through bind().
+    """
+    enabled = True
+
+    def __init__(self, namespace=NAMESPACE, sample_rate=1.0, emit=print, clock=time.time, rng=random.random):
+        self.namespace = namespace
+        self.sample_rate = sample_rate
+        self.emit = emit
+        self.clock = clock
+        self.rng = rng
+        self.counts = collections.Counter()
+        self.timings = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1, **dimensions):
+        key = (name, tuple(sorted(dimensions.items())))
+        with self.lock:
+            self.counts[key] += value
+
+    def timing(self, name, milliseconds, **dimensions):
+        key = (name, tuple(sorted(dimensions.items())))
+        with self.lock:
+            self.timings[key].append(round(milliseconds, 3))
+
+    def span(self, name, **attributes):
+        trace = CURRENT_TRACE.get()
+        if trace is None:
+            return NULL_SPAN
+        return Span(self, trace, name, attributes)
+
+    @contextlib.contextmanager
+    def trace(self, name, **properties):
+        if self.rng() >= self.sample_rate:
+            try:
+                yield NULL_SPAN
+            finally:
+                self.flush()
+            return
+        trace = Trace(name, properties, self.clock)
+        token = CURRENT_TRACE.set(trace)
+        try:
+            yield trace
+        finally:
+            CURRENT_TRACE.reset(token)
+            self.flush(trace)
+
+    def bind(self, fn):
+        # each call needs its own copy; one context can't be entered by two threads at once
+        return functools.partial(contextvars.copy_context().run, fn)
+
+    def flush(self, trace=None):
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+            timings, self.timings = self.timings, collections.defaultdict(list)
+        groups = collections.defaultdict(dict)
+        for (name, dimensions), value in counts.items():
+            groups[dimensions][name] = ('Count', [value])
+        for (name, dimensions), values in timings.items():
+            groups[dimensions][name] = ('Milliseconds', values)
+        timestamp = int(self.clock() * 1000)
+        for dimensions, metrics in groups.items():
+            for start in range(0, max(len(values) for _, values in metrics.values()), MAX_VALUES):
+                record = {"_aws": {"Timestamp": timestamp, "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [[name for name, _ in dimensions]],
+                    "Metrics": []}]}}
+                record.update(dimensions)
+                for name, (unit, values) in metrics.items():
+                    chunk = values[start:start + MAX_VALUES]
+                    if chunk:
+                        record["_aws"]["CloudWatchMetrics"][0]["Metrics"].append({"Name": name, "Unit": unit})
+                        record[name] = chunk[0] if len(chunk) == 1 else chunk
+                self.emit(json.dumps(record, separators=(',', ':')))
+        if trace is not None:
+            self.emit(json.dumps(trace.record(), separators=(',', ':')))
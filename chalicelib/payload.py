@@ -0,0 +1,105 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+MIN_MAX_AGE = 10
+MAX_MAX_AGE = 60  # browsers and CloudFront come back at least this often, so a stream going live shows quickly
+
+
+def live_signature(results):
+    """What a /live response means, ignoring how each channel was fetched: status, video ids and
+    whether it is a stale fallback, per channel."""
+    signature = []
+    for channel, entry in sorted(results.items()):
+        if not isinstance(entry, dict):
+            continue
+        result = entry.get("result")
+        items = result.get("items", []) if isinstance(result, dict) else []
+        signature.append((
+            channel, entry.get("status_code"), entry.get("how") == 'stale',
+            tuple(item.get("id", {}).get("videoId") for item in items)))
+    return tuple(signature)
+
+
+class RenderedPayload:
+    def __init__(self, body, signature, now):
+        self.body = body
+        self.signature = signature
+        # from the state rather than the body, which also holds how this container fetched each channel,
+        # so every container tags the same live state alike and revalidations elsewhere still match
+        self.etag = '"%s"' % (hashlib.sha1(json.dumps(signature).encode('utf-8')).hexdigest(),)
+        self.since = now
+
+
+class PayloadRenderer:
+    """Serializes a response body once per state change instead of once per request.
+
+    render() is handed the freshly assembled results on every request but only runs
+    json.dumps when their signature differs from the one it last rendered.
+    """
+    def __init__(self, signature=live_signature, serialize=json.dumps, clock=time.time):
+        self.signature = signature
+        self.serialize = serialize
+        self.clock = clock
+        self.payload = None
+        self.lock = threading.Lock()
+
+    def render(self, results):
+        signature = self.signature(results)
+        with self.lock:
+            if self.payload is None or self.payload.signature != signature:
+                self.payload = RenderedPayload(self.serialize(results), signature, self.clock())
+            return self.payload
+
+
+def channel_names(results):
+    return tuple(sorted(channel for channel, entry in results.items() if isinstance(entry, dict)))
+
+
+class RendererSet:
+    """A PayloadRenderer per set of channels, so pages asking for different ?channels= subsets
+    don't keep re-rendering each other's bodies. The least recently asked for sets are dropped
+    past maxsize."""
+    def __init__(self, maxsize=64, **kwargs):
+        self.maxsize = maxsize
+        self.kwargs = kwargs
+        self.renderers = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def render(self, results):
+        names = channel_names(results)
+        with self.lock:
+            renderer = self.renderers.get(names)
+            if renderer is None:
+                renderer = self.renderers[names] = PayloadRenderer(**self.kwargs)
+            self.renderers.move_to_end(names)
+            while len(self.renderers) > self.maxsize:
+                self.renderers.popitem(last=False)
+        return renderer.render(results)
+
+
+def cache_control(payload, ttl, now, cacheable=True):
+    """Cache-Control for a payload whose state is re-checked upstream every ttl seconds."""
+    if not cacheable:
+        return "no-cache"
+    remaining = max(ttl - (now - payload.since), 0)
+    max_age = int(max(MIN_MAX_AGE, min(remaining, MAX_MAX_AGE)))
+    stale_while_revalidate = int(max(remaining - max_age, MIN_MAX_AGE))
+    return f"public, max-age={max_age}, stale-while-revalidate={stale_while_revalidate}"
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # weak comparison is fine for a GET, and CloudFront may weaken our tag
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
@@ -0,0 +1,170 @@
+import json
+import threading
+import time
+import traceback
+
+VIDEOS_COST = 1  # quota units for one videos.list call, whatever the number of ids
+MAX_PROBE_IDS = 50  # videos.list accepts up to 50 ids per call
+SEARCH_SAFETY_INTERVAL = 1800  # never trust the probe alone for longer than this
+KNOWN_VIDEO_RETENTION = 2 * 24 * 3600
+RELOAD_INTERVAL = 300  # how soon ids learnt on another container (e.g. the api's for the poller) are probed here
+SAVE_ATTEMPTS = 3  # writes to one item racing another container's
+
+
+def probe_key(channel):
+    return f"probe#{channel}"
+
+
+def broadcast_state(video):
+    details = video.get('liveStreamingDetails', {})
+    if details.get('actualEndTime'):
+        return 'ended'
+    if details.get('actualStartTime'):
+        return 'live'
+    if details.get('scheduledStartTime') or video.get('snippet', {}).get('liveBroadcastContent') == 'upcoming':
+        return 'upcoming'
+    return 'none'
+
+
+def search_response(videos, results_per_page=1):
+    """Synthesizes the youtube#searchListResponse that a live search.list would have returned."""
+    items = []
+    for video in videos[:results_per_page]:
+        snippet = video.get('snippet', {})
+        items.append({
+            "kind": "youtube#searchResult",
+            "etag": video.get('etag'),
+            "id": {"kind": "youtube#video", "videoId": video['id']},
+            "snippet": {
+                "publishedAt": snippet.get('publishedAt'),
+                "channelId": snippet.get('channelId'),
+                "title": snippet.get('title'),
+                "description": snippet.get('description', ''),
+                "thumbnails": snippet.get('thumbnails', {}),
+                "channelTitle": snippet.get('channelTitle'),
+                "liveBroadcastContent": "live"}})
+    return {
+        "kind": "youtube#searchListResponse",
+        "pageInfo": {"totalResults": len(videos), "resultsPerPage": results_per_page},
+        "items": items}
+
+
+class ProbeState:
+    """Broadcasts worth probing per channel with the 1 unit videos.list instead of search.list.
+
+    Ids are learnt from search results, forced videos, websub notifications and probes,
+    dropped once the broadcast has ended, and persisted as a ``probe#<channel>`` item.
+    Other containers learn ids too (the poller is a lambda of its own), so the item is
+    re-read every RELOAD_INTERVAL and changes are applied to what is stored, written
+    back only if nobody else wrote it in between, rather than overwriting it.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.videos = {}
+        self.last_search = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def stale(self, channel):
+        return channel not in self.loaded or self.clock() - self.loaded[channel] >= RELOAD_INTERVAL
+
+    def read(self, channel, store):
+        try:
+            return store.get_from_dynamodb(probe_key(channel))
+        except Exception as exc:
+            print("Exception loading probe state: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def load(self, channel, store, force=False):
+        if not force and not self.stale(channel):
+            return
+        item = self.read(channel, store)
+        with self.lock:
+            self.loaded[channel] = self.clock()
+            if item:
+                videos = json.loads(item.get('videos', {}).get('S', '{}'))
+                self.videos.setdefault(channel, {}).update(videos)
+                self.last_search[channel] = max(
+                    self.last_search.get(channel, 0), float(item.get('last_search', {}).get('N', 0)))
+
+    def update(self, channel, store, change, searched_at=None):
+        """Applies change(videos), which says whether it changed anything, to the stored ids and ours."""
+        for _attempt in range(SAVE_ATTEMPTS):
+            item = self.read(channel, store)
+            with self.lock:
+                if item:
+                    videos = json.loads(item.get('videos', {}).get('S', '{}'))
+                    last_search = float(item.get('last_search', {}).get('N', 0))
+                else:
+                    videos = dict(self.videos.get(channel, {}))
+                    last_search = self.last_search.get(channel, 0)
+                changed = change(videos) or searched_at is not None
+                self.videos[channel] = videos
+                self.last_search[channel] = max(last_search, searched_at or 0)
+                self.loaded[channel] = self.clock()
+                revised = {
+                    'channel': {'S': probe_key(channel)},
+                    'videos': {'S': json.dumps(videos)},
+                    'last_search': {'N': str(self.last_search[channel])}}
+            if not changed:
+                return
+            revision = int(item.get('revision', {}).get('N', 0)) if item else 0
+            if store.conditional_put_to_dynamodb(revised, revision):
+                return
+        print(f"Gave up saving probe state for {channel} after {SAVE_ATTEMPTS} conflicting writes")
+
+    def known(self, channel):
+        now = self.clock()
+        with self.lock:
+            videos = self.videos.get(channel, {})
+            for video_id, seen in list(videos.items()):
+                if now - seen > KNOWN_VIDEO_RETENTION:
+                    del videos[video_id]
+            return sorted(videos, key=videos.get, reverse=True)[:MAX_PROBE_IDS]
+
+    def search_due(self, channel):
+        return self.clock() - self.last_search.get(channel, 0) > SEARCH_SAFETY_INTERVAL
+
+    def learn(self, channel, video_ids, store=None, searched=False):
+        now = self.clock()
+
+        def change(videos):
+            new = any(video_id not in videos for video_id in video_ids)
+            videos.update((video_id, now) for video_id in video_ids)
+            return new
+        if store is not None:
+            self.update(channel, store, change, now if searched else None)
+            return
+        with self.lock:
+            change(self.videos.setdefault(channel, {}))
+            if searched:
+                self.last_search[channel] = now
+
+    def learn_from_search(self, channel, result, store=None):
+        video_ids = [item['id']['videoId'] for item in result.get('items', []) if item.get('id', {}).get('videoId')]
+        self.learn(channel, video_ids, store, searched=True)
+
+    def learn_from_probe(self, channel, probed_ids, result, store=None):
+        """Forgets ended or vanished broadcasts and returns (live videos, upcoming videos)."""
+        videos = {video['id']: video for video in result.get('items', [])}
+        live, upcoming, ended = [], [], []
+        for video_id in probed_ids:
+            state = broadcast_state(videos[video_id]) if video_id in videos else 'ended'
+            if state == 'live':
+                live.append(videos[video_id])
+            elif state == 'upcoming':
+                upcoming.append(videos[video_id])
+            else:
+                ended.append(video_id)
+
+        def change(known):
+            gone = [video_id for video_id in ended if video_id in known]
+            for video_id in gone:
+                del known[video_id]
+            return bool(gone)
+        with self.lock:
+            changed = change(self.videos.setdefault(channel, {}))
+        if changed and store is not None:
+            self.update(channel, store, change)
+        return live, upcoming
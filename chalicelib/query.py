@@ -0,0 +1,35 @@
+import hashlib
+from urllib.parse import urlencode
+
+# search.list parameters that can change its answer; anything else, `key` included, is dropped
+SEARCH_PARAMS = frozenset([
+    "channelId", "channelType", "eventType", "fields", "location", "locationRadius", "maxResults", "order",
+    "pageToken", "part", "publishedAfter", "publishedBefore", "q", "regionCode", "relevanceLanguage",
+    "safeSearch", "topicId", "type", "videoCaption", "videoCategoryId", "videoDefinition", "videoDimension",
+    "videoDuration", "videoEmbeddable", "videoLicense", "videoSyndicated", "videoType"])
+UNORDERED_LIST_PARAMS = frozenset(["part", "type"])  # comma separated, in any order
+SEARCH_KEY_PREFIX = "search#"
+
+
+def canonical_params(params):
+    """The whitelisted search.list params, trimmed, with list values sorted and empty ones dropped."""
+    canonical = {}
+    for name, value in (params or {}).items():
+        if name not in SEARCH_PARAMS or value is None:
+            continue
+        value = str(value).strip()
+        if name in UNORDERED_LIST_PARAMS:
+            value = ",".join(sorted(set(part.strip() for part in value.split(",") if part.strip())))
+        if value:
+            canonical[name] = value
+    return dict(sorted(canonical.items()))
+
+
+def search_cache_key(params):
+    # hashed since a query string can be longer than dynamodb allows for a key
+    query = urlencode(sorted(canonical_params(params).items()))
+    return SEARCH_KEY_PREFIX + hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+def is_search_key(key):
+    return bool(key) and key.startswith(SEARCH_KEY_PREFIX)
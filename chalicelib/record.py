@@ -0,0 +1,91 @@
+import json
+import zlib
+
+RECORD_VERSION = 2
+
+
+def essentials(result):
+    """What is worth reading without the payload: whether a video is live and which."""
+    items = result.get("items", []) if isinstance(result, dict) else []
+    first = items[0] if items else {}
+    snippet = first.get("snippet", {})
+    return {
+        "live": bool(result.get("pageInfo", {}).get("totalResults", 0) > 0) if isinstance(result, dict) else False,
+        "videoId": first.get("id", {}).get("videoId"),
+        "title": snippet.get("title"),
+        "publishedAt": snippet.get("publishedAt")}
+
+
+def encode_item(channel, result, create_time, last_checked_time, expiry_time, state):
+    """A version 2 channel item: whole-second times, the essentials as attributes of their own
+    and the youtube response zlib compressed in a binary attribute."""
+    summary = essentials(result)
+    item = {
+        'channel': {'S': channel},
+        'v': {'N': str(RECORD_VERSION)},
+        'time': {'N': str(int(create_time))},
+        'last_checked_time': {'N': str(int(last_checked_time))},
+        'expiry_time': {'N': str(int(expiry_time))},
+        'state': {'S': state},
+        'live': {'BOOL': summary["live"]},
+        'payload': {'B': zlib.compress(json.dumps(result, separators=(',', ':')).encode('utf-8'))}}
+    # dynamodb refuses empty strings, so missing essentials are left out
+    for name in ("videoId", "title", "publishedAt"):
+        if summary[name]:
+            item[name] = {'S': summary[name]}
+    return item
+
+
+class StoredItem:
+    """A channel item read back, in either format; the payload is only decoded when result() is asked for.
+
+    Version 1 items hold the youtube response as a json string in `result` and their
+    times as stringified floats, and are still read as they are.
+    """
+    def __init__(self, item):
+        self.version = int(item['v']['N']) if 'v' in item else 1
+        self.create_time = int(float(item['time']['N']))
+        self.expiry_time = int(float(item['expiry_time']['N'])) if 'expiry_time' in item else None
+        self.last_checked_time = int(float(item.get('last_checked_time', {"N": "0"})['N']))
+        self.state = item.get('state', {}).get('S')
+        self.item = item
+        self.decoded = None
+
+    @property
+    def live(self):
+        if self.version >= 2:
+            return self.item['live']['BOOL']
+        return essentials(self.result())["live"]
+
+    def result(self):
+        if self.decoded is None:
+            if self.version >= 2:
+                self.decoded = json.loads(zlib.decompress(self.item['payload']['B']).decode('utf-8'))
+            else:
+                self.decoded = json.loads(self.item['result']['S'])
+        return self.decoded
+
+
+def read_item(item):
+    """A StoredItem, or None for an item holding no result yet (e.g. only a refresh lease)."""
+    if not item or 'time' not in item or not ('payload' in item or item.get('result', {}).get('S')):
+        return None
+    return StoredItem(item)
+
+
+def checked_before(last_checked_time):
+    """Below this a stored last_checked_time is the one read back as `last_checked_time` or earlier.
+
+    Times are read back as whole seconds, and version 1 items kept the fraction.
+    """
+    return int(last_checked_time) + 1
+
+
+def checked_since(item, last_checked_time):
+    """Whether the channel was checked after the caller read `last_checked_time` from it.
+
+    None is for a caller that read nothing to compare against, e.g. a forced refresh.
+    """
+    if last_checked_time is None:
+        return False
+    return float(item.get('last_checked_time', {'N': '0'})['N']) >= checked_before(last_checked_time)
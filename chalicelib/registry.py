@@ -0,0 +1,101 @@
+import json
+import re
+import threading
+import time
+import traceback
+
+REGISTRY_KEY = "registry#channels"
+RELOAD_INTERVAL = 60  # how soon other containers see a channel added or removed
+SAVE_ATTEMPTS = 3  # writes to the registry racing another container's
+CHANNEL_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+CHANNEL_ID = re.compile(r'^UC[A-Za-z0-9_-]{22}$')
+RESERVED_NAMES = frozenset(["any_live", "version"])  # keys of their own in /live responses
+
+
+class InvalidChannel(ValueError):
+    pass
+
+
+class RegistryConflict(Exception):
+    """Other containers kept changing the registry while this one tried to."""
+
+
+class ChannelRegistry:
+    """The channels /live reports on, by name, kept as one ``registry#channels`` item.
+
+    Each container works from an in-memory snapshot that is re-read at most every
+    RELOAD_INTERVAL seconds. A snapshot is never changed in place, so callers can
+    iterate one while a channel is being added. snapshot() returns None until
+    anything has been registered, leaving the caller to use its built-in channels.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.channels = None
+        self.revision = 0  # of the stored item our channels came from
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def read(self, store):
+        try:
+            return store.get_from_dynamodb(REGISTRY_KEY)
+        except Exception as exc:
+            print("Exception loading channel registry: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def load(self, store, force=False):
+        now = self.clock()
+        if not force and self.loaded_at is not None and now - self.loaded_at < RELOAD_INTERVAL:
+            return
+        item = self.read(store)
+        with self.lock:
+            self.loaded_at = now
+            # a failed read keeps the snapshot we have rather than forgetting every registered channel
+            if item:
+                self.channels = json.loads(item.get('channels', {}).get('S', '{}'))
+                self.revision = int(item.get('revision', {}).get('N', 0))
+
+    def snapshot(self, store):
+        self.load(store)
+        return self.channels
+
+    def update(self, store, change, defaults=None):
+        """Saves change(channels) over the stored channels, or the defaults before any are stored.
+
+        change returns the new channels, or None to leave them as they are. A write that
+        loses to another container's is retried on top of the winner's channels.
+        """
+        for _attempt in range(SAVE_ATTEMPTS):
+            self.load(store, force=True)
+            with self.lock:
+                current = self.channels if self.channels is not None else defaults or {}
+                revision = self.revision
+            channels = change(current)
+            if channels is None:
+                return None
+            if store.conditional_put_to_dynamodb({
+                    'channel': {'S': REGISTRY_KEY},
+                    'channels': {'S': json.dumps(channels, sort_keys=True)},
+                    'time': {'N': str(self.clock())}}, revision):
+                with self.lock:
+                    self.channels = channels
+                    self.revision = revision + 1
+                    self.loaded_at = self.clock()
+                return channels
+        raise RegistryConflict(f"gave up changing the channel registry after {SAVE_ATTEMPTS} conflicting writes")
+
+    def add(self, name, channel_id, store, defaults=None):
+        """Registers or re-points `name`; the first registration starts from `defaults`."""
+        if not name or not CHANNEL_NAME.match(name) or name in RESERVED_NAMES:
+            raise InvalidChannel(f"invalid channel name {name!r}")
+        if not channel_id or not CHANNEL_ID.match(channel_id):
+            raise InvalidChannel(f"invalid channel id {channel_id!r}")
+        return self.update(store, lambda current: dict(current, **{name: channel_id}), defaults)
+
+    def remove(self, name, store, defaults=None):
+        """Unregisters `name`, returning the remaining channels or None if it wasn't registered."""
+        def without(current):
+            if name not in current:
+                return None
+            return {other: channel_id for other, channel_id in current.items() if other != name}
+        return self.update(store, without, defaults)
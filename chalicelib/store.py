@@ -0,0 +1,162 @@
+import base64
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from chalicelib.record import checked_since
+
+BUSY_TIMEOUT = 5  # seconds a worker waits for another worker's write to finish
+MAX_VARIABLES = 500  # per query, well under sqlite's default limit of 999
+
+
+def dumps_item(item):
+    # binary attributes (the compressed payload) are bytes, which json can't hold
+    return json.dumps({
+        name: {'B': base64.b64encode(value['B']).decode('ascii')} if 'B' in value else value
+        for name, value in item.items()}, separators=(',', ':'))
+
+
+def loads_item(text):
+    return {
+        name: {'B': base64.b64decode(value['B'])} if 'B' in value else value
+        for name, value in json.loads(text).items()}
+
+
+def add_number(item, name, value):
+    total = float(item.get(name, {}).get('N', 0)) + value
+    item[name] = {'N': str(int(total)) if total == int(total) else str(total)}
+
+
+class SqliteStore:
+    """Items kept in a sqlite database in WAL mode that every worker on one host shares.
+
+    Answers the storage half of what the app asks of RealYoutubeDynamodb, with items
+    in dynamodb's attribute format keyed by `channel`, so workers under `chalice local`
+    or a wsgi server see one another's results, last_checked_time, refresh leases and
+    api key usage. Each thread opens its own connection. The read-modify-writes run in
+    IMMEDIATE transactions, which makes them atomic across processes as their
+    conditional dynamodb updates are. Like RealYoutubeDynamodb, failures are logged
+    and answered as if nothing was stored.
+    """
+    def __init__(self, path, node_id, clock=time.time):
+        self.path = path
+        self.node_id = node_id
+        self.clock = clock
+        self.local = threading.local()
+        self.db.execute('CREATE TABLE IF NOT EXISTS items (channel TEXT PRIMARY KEY, item TEXT NOT NULL)')
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            # readers don't block the writer nor each other; a crash can only lose the last commits
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def read(self, db, channel):
+        row = db.execute('SELECT item FROM items WHERE channel = ?', (channel,)).fetchone()
+        return loads_item(row[0]) if row else None
+
+    def write(self, db, items):
+        db.executemany(
+            'INSERT OR REPLACE INTO items (channel, item) VALUES (?, ?)',
+            [(item['channel']['S'], dumps_item(item)) for item in items])
+
+    def get_from_dynamodb(self, channel):
+        try:
+            return self.read(self.db, channel)
+        except Exception as exc:
+            print("Exception retrieving from sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def batch_get_from_dynamodb(self, channels):
+        # None rather than {} on failure, as RealYoutubeDynamodb, so callers fall back to get_from_dynamodb
+        try:
+            items = {}
+            channels = list(channels)
+            for start in range(0, len(channels), MAX_VARIABLES):
+                chunk = channels[start:start + MAX_VARIABLES]
+                rows = self.db.execute(
+                    'SELECT channel, item FROM items WHERE channel IN (%s)' % (','.join('?' * len(chunk)),), chunk)
+                items.update((channel, loads_item(item)) for channel, item in rows)
+            return items
+        except Exception as exc:
+            print("Exception batch retrieving from sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def put_to_dynamodb(self, item):
+        try:
+            self.write(self.db, [item])
+        except Exception as exc:
+            print("Exception writing to sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def conditional_put_to_dynamodb(self, item, revision):
+        try:
+            with self.transaction() as db:
+                stored = self.read(db, item['channel']['S'])
+                if int((stored or {}).get('revision', {}).get('N', 0)) != revision:
+                    return False
+                self.write(db, [dict(item, revision={'N': str(revision + 1)})])
+        except Exception as exc:
+            print("Exception writing to sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return True
+
+    def batch_write_to_dynamodb(self, items):
+        try:
+            with self.transaction() as db:
+                self.write(db, items)
+        except Exception as exc:
+            print("Exception batch writing to sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return None
+
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        # on the channel item, like the dynamodb lease, so putting the refreshed item back clears it
+        try:
+            with self.transaction() as db:
+                now = self.clock()
+                item = self.read(db, channel) or {'channel': {'S': channel}}
+                if float(item.get('lease_until', {}).get('N', 0)) >= now or checked_since(item, last_checked_time):
+                    return False
+                item['lease_owner'] = {'S': self.node_id}
+                item['lease_until'] = {'N': str(now + lease_seconds)}
+                self.write(db, [item])
+        except Exception as exc:
+            print("Exception acquiring lease from sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return True
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        try:
+            with self.transaction() as db:
+                item = self.read(db, usage_key) or {'channel': {'S': usage_key}}
+                add_number(item, 'spent', units)
+                add_number(item, 'failures', failures)
+                if quarantined_until:
+                    item['quarantined_until'] = {'N': str(quarantined_until)}
+                self.write(db, [item])
+        except Exception as exc:
+            print("Exception recording api key usage in sqlite: %s" % (exc,))
+            traceback.print_exc()
+        return None
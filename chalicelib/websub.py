@@ -0,0 +1,207 @@
+import collections
+import hashlib
+import hmac
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ElementTree
+
+HUB_URL = "https://pubsubhubbub.appspot.com/subscribe"
+TOPIC_URL = "https://www.youtube.com/xml/feeds/videos.xml?channel_id="
+LEASE_SECONDS = 5 * 24 * 3600
+RENEW_BEFORE = 24 * 3600  # renew this long before the hub's lease runs out
+RESUBSCRIBE_AFTER = 3600  # a request the hub never verified is sent again after this long
+RELOAD_INTERVAL = 600  # the hub verifies through whichever container it reaches, so re-read leases this often
+SAFETY_INTERVAL = 3600  # how often a subscribed, offline channel is still polled
+NAMESPACES = {
+    'atom': 'http://www.w3.org/2005/Atom',
+    'yt': 'http://www.youtube.com/xml/schemas/2015',
+    'at': 'http://purl.org/atompub/tombstones/1.0'}
+SIGNATURE_METHODS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha384': hashlib.sha384,
+    'sha512': hashlib.sha512}
+
+FeedEntry = collections.namedtuple('FeedEntry', ['video_id', 'channel_id', 'deleted'])
+
+
+def websub_key(channel):
+    return f"websub#{channel}"
+
+
+def topic_url(channel):
+    return TOPIC_URL + channel
+
+
+def topic_channel(topic):
+    if not topic or not topic.startswith(TOPIC_URL):
+        return None
+    return topic[len(TOPIC_URL):]
+
+
+def verify_signature(secret, body, signature):
+    """Checks an X-Hub-Signature header (``sha1=<hex hmac of the body>``) against our secret."""
+    if not secret or not signature or '=' not in signature:
+        return False
+    method, digest = signature.split('=', 1)
+    if method.lower() not in SIGNATURE_METHODS:
+        return False
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    expected = hmac.new(secret.encode('utf-8'), body or b'', SIGNATURE_METHODS[method.lower()]).hexdigest()
+    return hmac.compare_digest(expected, digest.strip().lower())
+
+
+def parse_feed(body):
+    """The videos a youtube Atom notification announces, new or updated ones and deleted ones."""
+    root = ElementTree.fromstring(body)
+    entries = []
+    for entry in root.findall('atom:entry', NAMESPACES):
+        video_id = entry.findtext('yt:videoId', namespaces=NAMESPACES)
+        channel_id = entry.findtext('yt:channelId', namespaces=NAMESPACES)
+        if video_id and channel_id:
+            entries.append(FeedEntry(video_id, channel_id, False))
+    for deleted in root.findall('at:deleted-entry', NAMESPACES):
+        # <at:deleted-entry ref="yt:video:ID"><at:by><uri>https://www.youtube.com/channel/ID</uri></at:by>
+        video_id = deleted.get('ref', '').rpartition(':')[2]
+        uri = deleted.findtext('at:by/atom:uri', namespaces=NAMESPACES) or ''
+        channel_id = uri.rstrip('/').rpartition('/')[2]
+        if video_id and channel_id:
+            entries.append(FeedEntry(video_id, channel_id, True))
+    return entries
+
+
+class Subscriptions:
+    """WebSub subscriptions to each channel's upload feed on youtube's hub.
+
+    Subscribing only asks the hub; the lease starts when the hub calls back to verify,
+    possibly on another container, so leases are kept in ``websub#<channel>`` items.
+    Nothing is subscribed unless both a callback url and a secret are configured.
+    """
+    def __init__(self, callback_url=None, secret=None, hub_url=HUB_URL, clock=time.time):
+        self.callback_url = callback_url
+        self.secret = secret
+        self.hub_url = hub_url
+        self.clock = clock
+        self.leases = {}
+        self.requested = {}
+        self.unsubscribing = {}
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return bool(self.callback_url and self.secret)
+
+    def remember(self, channel, item, now):
+        with self.lock:
+            self.loaded[channel] = now
+            if item:
+                self.leases[channel] = float(item.get('lease_until', {}).get('N', 0))
+                self.requested[channel] = max(
+                    self.requested.get(channel, 0), float(item.get('requested_at', {}).get('N', 0)))
+                self.unsubscribing[channel] = max(
+                    self.unsubscribing.get(channel, 0), float(item.get('unsubscribe_requested_at', {}).get('N', 0)))
+
+    def load(self, channel, store, force=False):
+        now = self.clock()
+        if not force and now - self.loaded.get(channel, 0) < RELOAD_INTERVAL:
+            return
+        item = None
+        try:
+            item = store.get_from_dynamodb(websub_key(channel))
+        except Exception as exc:
+            print("Exception loading websub subscription: %s" % (exc,))
+            traceback.print_exc()
+        self.remember(channel, item, now)
+
+    def save(self, channel, store):
+        with self.lock:
+            item = {
+                'channel': {'S': websub_key(channel)},
+                'lease_until': {'N': str(self.leases.get(channel, 0))},
+                'requested_at': {'N': str(self.requested.get(channel, 0))},
+                'unsubscribe_requested_at': {'N': str(self.unsubscribing.get(channel, 0))}}
+        store.put_to_dynamodb(item)
+
+    def active(self, channel, store):
+        """Whether the hub is currently pushing this channel's notifications to us."""
+        if not self.enabled():
+            return False
+        self.load(channel, store)
+        return self.leases.get(channel, 0) > self.clock()
+
+    def due(self, channel, now):
+        return (self.leases.get(channel, 0) - now < RENEW_BEFORE and
+                now - self.requested.get(channel, 0) > RESUBSCRIBE_AFTER)
+
+    def subscribe(self, channel, store, mode='subscribe'):
+        data = {
+            'hub.callback': self.callback_url,
+            'hub.topic': topic_url(channel),
+            'hub.mode': mode,
+            'hub.verify': 'async',
+            'hub.lease_seconds': str(LEASE_SECONDS),
+            'hub.secret': self.secret}
+        # recorded first since the hub may verify before it has answered us
+        with self.lock:
+            (self.requested if mode == 'subscribe' else self.unsubscribing)[channel] = self.clock()
+        self.save(channel, store)
+        return store.post_to_hub(self.hub_url, data)
+
+    def renew(self, channels, store):
+        """Subscribes every channel whose lease is missing or close to running out."""
+        if not self.enabled():
+            print("Websub is not configured so not subscribing")
+            return {}
+        channels = list(channels)
+        now = self.clock()
+        try:
+            items = store.batch_get_from_dynamodb([websub_key(channel) for channel in channels])
+        except Exception as exc:
+            print("Exception loading websub subscriptions: %s" % (exc,))
+            traceback.print_exc()
+            items = None
+        if items is not None:
+            for channel in channels:
+                self.remember(channel, items.get(websub_key(channel)), now)
+        renewed = {}
+        for channel in channels:
+            if items is None:
+                self.load(channel, store)
+            if self.due(channel, now):
+                try:
+                    renewed[channel] = self.subscribe(channel, store)
+                except Exception as exc:
+                    print("Exception subscribing to websub hub: %s" % (exc,))
+                    traceback.print_exc()
+                    renewed[channel] = f"error {exc}"
+        print(f"Renewed websub subscriptions: {renewed}")
+        return renewed
+
+    def verify(self, mode, topic, challenge, lease_seconds, channels, store):
+        """Answers the hub's verification of intent, returning the challenge to echo or None to refuse."""
+        channel = topic_channel(topic)
+        if not self.enabled() or channel not in channels or mode not in ('subscribe', 'unsubscribe', 'denied'):
+            return None
+        if mode in ('subscribe', 'unsubscribe'):
+            # only confirm what we asked for, maybe from another container, so nobody else can quieten
+            # polling with a subscription or stop the pushes with an unsubscription
+            self.load(channel, store, force=True)
+            requested = self.requested if mode == 'subscribe' else self.unsubscribing
+            if self.clock() - requested.get(channel, 0) > RESUBSCRIBE_AFTER:
+                print(f"Refusing websub {mode} for {channel} that was not requested")
+                return None
+        now = self.clock()
+        with self.lock:
+            if mode == 'subscribe':
+                try:
+                    self.leases[channel] = now + int(lease_seconds or LEASE_SECONDS)
+                except ValueError:
+                    return None
+            else:
+                self.leases[channel] = 0
+            self.loaded[channel] = now
+        print(f"Websub {mode} verified for {channel}")
+        self.save(channel, store)
+        return challenge or ''
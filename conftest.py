@@ -0,0 +1,179 @@
+"""The fakes and fixtures that the tests share."""
+import collections.abc
+import itertools
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import app
+from app import RealYoutubeDynamodb
+from chalicelib.record import checked_since
+from chalicelib.store import SqliteStore
+
+STORES = ['memory', 'sqlite']
+SQLITE_DIRECTORY = None  # set while a test runs against sqlite
+PATHS = itertools.count()
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryStore:
+    """The storage calls answered from dicts, with the refresh leases kept apart from the items."""
+    def __init__(self):
+        self.items = {}
+        self.leases = {}
+        self.reads = 0
+        self.lock = threading.Lock()
+
+    def get_from_dynamodb(self, channel):
+        self.reads += 1
+        return self.items.get(channel)
+
+    def batch_get_from_dynamodb(self, channels):
+        return {channel: self.items[channel] for channel in channels if channel in self.items}
+
+    def put_to_dynamodb(self, item):
+        self.items[item['channel']['S']] = item
+        self.leases.pop(item['channel']['S'], None)
+
+    def conditional_put_to_dynamodb(self, item, revision):
+        with self.lock:
+            stored = self.items.get(item['channel']['S']) or {}
+            if int(stored.get('revision', {}).get('N', 0)) != revision:
+                return False
+            self.put_to_dynamodb(dict(item, revision={'N': str(revision + 1)}))
+            return True
+
+    def batch_write_to_dynamodb(self, items):
+        for item in items:
+            self.put_to_dynamodb(item)
+
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        with self.lock:
+            now = time.time()
+            if self.leases.get(channel, 0) > now or checked_since(self.items.get(channel, {}), last_checked_time):
+                return False
+            self.leases[channel] = now + lease_seconds
+            return True
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        with self.lock:
+            item = self.items.setdefault(usage_key, {'channel': {'S': usage_key}})
+            for name, value in (('spent', units), ('failures', failures)):
+                item[name] = {'N': str(int(item.get(name, {'N': '0'})['N']) + value)}
+            if quarantined_until:
+                item['quarantined_until'] = {'N': str(quarantined_until)}
+
+
+class SqliteItems(collections.abc.MutableMapping):
+    """A SqliteStore's items as a dict, for tests to arrange and inspect."""
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, channel):
+        item = self.store.get_from_dynamodb(channel)
+        if item is None:
+            raise KeyError(channel)
+        return item
+
+    def __setitem__(self, channel, item):
+        self.store.put_to_dynamodb(item)
+
+    def __delitem__(self, channel):
+        self.store.db.execute('DELETE FROM items WHERE channel = ?', (channel,))
+
+    def __iter__(self):
+        return iter([channel for channel, in self.store.db.execute('SELECT channel FROM items')])
+
+    def __len__(self):
+        return self.store.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+
+class InspectableSqliteStore(SqliteStore):
+    @property
+    def items(self):
+        return SqliteItems(self)
+
+    @property
+    def leases(self):
+        return {channel: float(item['lease_until']['N']) for channel, item in self.items.items() if 'lease_until' in item}
+
+
+class MemoryYoutubeDynamodb(RealYoutubeDynamodb):
+    """The real youtube side, pointed at a test's stand-in api, with dynamodb kept in dicts or sqlite."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.store = new_store()
+
+    @property
+    def items(self):
+        return self.store.items
+
+    def get_from_dynamodb(self, channel):
+        return self.store.get_from_dynamodb(channel)
+
+    def batch_get_from_dynamodb(self, channels):
+        return self.store.batch_get_from_dynamodb(channels)
+
+    def put_to_dynamodb(self, item):
+        self.store.put_to_dynamodb(item)
+
+    def conditional_put_to_dynamodb(self, item, revision):
+        return self.store.conditional_put_to_dynamodb(item, revision)
+
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        return True
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        pass
+
+
+def broadcast_video(video_id, state, channel_id):
+    """A videos.list item for a broadcast that is 'upcoming', 'live' or 'ended'."""
+    details = {"scheduledStartTime": "2026-10-18T18:00:00Z"}
+    if state in ('live', 'ended'):
+        details["actualStartTime"] = "2026-10-18T18:01:00Z"
+    if state == 'ended':
+        details["actualEndTime"] = "2026-10-18T20:00:00Z"
+    return {
+        "id": video_id, "etag": "etag",
+        "snippet": {"channelId": channel_id, "title": f"Broadcast {video_id}",
+                    "liveBroadcastContent": {"ended": "none"}.get(state, state)},
+        "liveStreamingDetails": details}
+
+
+def new_store():
+    """What a fake backend keeps its items in: dicts, or a sqlite database of its own while `each_store` says so."""
+    if SQLITE_DIRECTORY is None:
+        return MemoryStore()
+    return InspectableSqliteStore(str(SQLITE_DIRECTORY / f"store{next(PATHS)}.db"), app.NODE_ID)
+
+
+@pytest.fixture(params=STORES)
+def each_store(request, tmp_path, monkeypatch):
+    """Runs a test once with the fakes' items in dicts and once in sqlite."""
+    monkeypatch.setattr(sys.modules[__name__], 'SQLITE_DIRECTORY', tmp_path if request.param == 'sqlite' else None)
+    return request.param
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "store.db")
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    """Gives the app a pool of its own and joins it after the test, so no call it abandoned outlives it."""
+    pool = ThreadPoolExecutor(max_workers=app.MAX_WORKERS)
+    monkeypatch.setattr(app, 'EXECUTOR', pool)
+    monkeypatch.setattr(app.CACHE, 'submit', pool.submit)
+    monkeypatch.setattr(app.SEARCH_CACHE, 'submit', pool.submit)
+    yield pool
+    pool.shutdown(wait=True)
@@ -1,11 +1,30 @@
 import json
+import os
+import sys
 import time
 import copy
+import collections
+import itertools
+import subprocess
+import threading
 from unittest import mock
+from botocore.exceptions import ClientError
+from chalice.config import Config
+from chalice.local import LocalGateway
 import pytest
 from app import do_search_on_youtube, DYNAMODB_IF_STREAM_TTL, MIN_TIME_BEFORE_UPSTREAM_CHECKS
-from app import CHANNELS, DEFAULT_PARAMS, MAX_GRACE_PERIOD, reset_cache, get_cache
-from app import DYNAMODB_IF_NO_STREAM_TTL, force_video_id
+from app import CHANNELS, DEFAULT_PARAMS, reset_cache, get_cache, reset_key_scheduler, reset_all
+from app import reset_registry, get_probes, get_registry, get_schedules, renew_websub
+from app import DYNAMODB_IF_NO_STREAM_TTL, force_video_id, live, dynamodb_item, RealYoutubeDynamodb, are_there_videos
+from app import request_from_youtube_and_write_to_cache, get_key_scheduler, poll, decode_item, prefetch_channels
+from app import app, CACHE, LIVE_CACHE_TTL, SEARCH_CACHE, SEARCH_ITEM_RETENTION
+from chalicelib.breaker import CircuitOpen
+from chalicelib.keys import SEARCH_COST
+from chalicelib.metrics import Metrics
+from chalicelib.payload import PayloadRenderer
+from conftest import new_store
+
+pytestmark = pytest.mark.usefixtures('each_store')
 
 
 class FakeYoutubeDynamodb:
@@ -75,6 +94,10 @@ class FakeYoutubeDynamodb:
 
     request_from_youtube = request_from_youtube_online
 
+    @classmethod
+    def request_videos_from_youtube(cls, params, key_origin):
+        return 200, {"kind": "youtube#videoListResponse", "items": []}
+
     @classmethod
     def get_from_dynamodb(cls, channel):
         return None
@@ -87,6 +110,106 @@ class FakeYoutubeDynamodb:
     def update_dynamodb(cls, channel, result, create_time, expiry_time=None):
         return None
 
+    @classmethod
+    def batch_get_from_dynamodb(cls, channels):
+        return {}
+
+    @classmethod
+    def acquire_refresh_lease(cls, channel, lease_seconds, last_checked_time=None):
+        return True
+
+    @classmethod
+    def record_key_usage(cls, usage_key, units, failures, quarantined_until=None):
+        return None
+
+    @classmethod
+    def put_to_dynamodb(cls, item):
+        return None
+
+    @classmethod
+    def conditional_put_to_dynamodb(cls, item, revision):
+        return True
+
+    @classmethod
+    def batch_write_to_dynamodb(cls, items):
+        return None
+
+
+class CountingFakeYoutubeDynamodb(FakeYoutubeDynamodb):
+    def __init__(self, youtube_delay=0):
+        self.store = new_store()
+        self.calls = collections.Counter()
+        self.youtube_params = []
+        self.youtube_delay = youtube_delay
+        self.lock = threading.Lock()
+
+    @property
+    def items(self):
+        return self.store.items
+
+    @property
+    def leases(self):
+        return self.store.leases
+
+    def request_from_youtube(self, params, key_origin):
+        with self.lock:
+            self.calls['youtube'] += 1
+            self.youtube_params.append(dict(params))
+        time.sleep(self.youtube_delay)
+        return FakeYoutubeDynamodb.request_from_youtube_online(params, key_origin)
+
+    def request_videos_from_youtube(self, params, key_origin):
+        with self.lock:
+            self.calls['videos'] += 1
+        return FakeYoutubeDynamodb.request_videos_from_youtube(params, key_origin)
+
+    def acquire_refresh_lease(self, channel, lease_seconds, last_checked_time=None):
+        return self.store.acquire_refresh_lease(channel, lease_seconds, last_checked_time)
+
+    def get_from_dynamodb(self, channel):
+        self.calls['get_item'] += 1
+        return self.store.get_from_dynamodb(channel)
+
+    def batch_get_from_dynamodb(self, channels):
+        self.calls['batch_get_item'] += 1
+        return self.store.batch_get_from_dynamodb(channels)
+
+    def put_to_dynamodb(self, item):
+        self.calls['put_item'] += 1
+        self.store.put_to_dynamodb(item)
+
+    def conditional_put_to_dynamodb(self, item, revision):
+        self.calls['conditional_put_item'] += 1
+        return self.store.conditional_put_to_dynamodb(item, revision)
+
+    def batch_write_to_dynamodb(self, items):
+        self.calls['batch_write_item'] += 1
+        self.store.batch_write_to_dynamodb(items)
+
+    def record_key_usage(self, usage_key, units, failures, quarantined_until=None):
+        with self.lock:
+            self.calls['key_usage'] += 1
+        self.store.record_key_usage(usage_key, units, failures, quarantined_until)
+
+    def write_to_dynamodb(self, channel, result, expiry_time=None):
+        now = time.time()
+        self.put_to_dynamodb(dynamodb_item(channel, result, now, now, expiry_time))
+
+    def update_dynamodb(self, channel, result, create_time, expiry_time=None):
+        self.put_to_dynamodb(dynamodb_item(channel, result, create_time, time.time(), expiry_time))
+
+
+class SlowFakeYoutubeDynamodb(FakeYoutubeDynamodb):
+    delays = {}
+
+    @classmethod
+    def request_from_youtube(cls, params, key_origin):
+        time.sleep(cls.delays.get(params.get("channelId"), 0))
+        return FakeYoutubeDynamodb.request_from_youtube_online(params, key_origin)
+
+
+THREE_CHANNELS = {"mainhall": "UCmainhall", "elc": "UCelc", "ladies": "UCladies"}
+
 
 @pytest.fixture
 def search_params():
@@ -97,7 +220,7 @@ def search_params():
 
 def setup_function(function):
     print("Resetting cache")
-    reset_cache()
+    reset_all()
 
 
 def test_local_cache(search_params):
@@ -116,7 +239,7 @@ def test_after_ttl_expires_uses_youtube(search_params):
             'result': {'S': json.dumps(FakeYoutubeDynamodb.request_from_youtube_online(1, None)[1])},
             'time': {'N': str(time.time() - DYNAMODB_IF_STREAM_TTL - 1)},
             'expiry_time': {'N': str(time.time() - 1)},
-            'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - MAX_GRACE_PERIOD - 1)}}
+            'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - 1)}}
         _status, _, where, _, _ = do_search_on_youtube(search_params, FakeYoutubeDynamodb)
         assert where == 'youtube'
 
@@ -130,7 +253,7 @@ def test_after_if_stream_ttl_expires_but_video_expiry_not_reached_checks_youtube
                 'result': {'S': json.dumps(FakeYoutubeDynamodb.request_from_youtube_online(1, None)[1])},
                 'time': {'N': str(time.time() - DYNAMODB_IF_STREAM_TTL - 1)},
                 'expiry_time': {'N': str(time.time() + 1)},
-                'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - MAX_GRACE_PERIOD - 1)}}
+                'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - 1)}}
             _status, _, where, _, _ = do_search_on_youtube(search_params, FakeYoutubeDynamodb)
             assert where == 'dynamodb'
             assert request_from_youtube_mock.called
@@ -142,7 +265,7 @@ def test_after_if_stream_ttl_expires_but_video_expiry_not_reached_youtube_has_vi
             'result': {'S': json.dumps(FakeYoutubeDynamodb.request_from_youtube_online(1, None)[1])},
             'time': {'N': str(time.time() - DYNAMODB_IF_STREAM_TTL - 1)},
             'expiry_time': {'N': str(time.time() + 1)},
-            'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - MAX_GRACE_PERIOD - 1)}}
+            'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - 1)}}
         _status, _, where, _, _ = do_search_on_youtube(search_params, FakeYoutubeDynamodb)
         assert where == 'youtube'
 
@@ -162,7 +285,7 @@ def test_after_if_no_stream_ttl_expires_uses_youtube(search_params):
         get_from_dynamodb_mock.return_value = {
             'result': {'S': json.dumps(FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1])},
             'time': {'N': str(time.time() - DYNAMODB_IF_NO_STREAM_TTL - 1)},
-            'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - MAX_GRACE_PERIOD - 1)}}
+            'last_checked_time': {'N': str(time.time() - MIN_TIME_BEFORE_UPSTREAM_CHECKS - 1)}}
 
         _status, _, where, _, _ = do_search_on_youtube(search_params, FakeYoutubeDynamodb)
         assert where == 'youtube'
@@ -178,9 +301,661 @@ def test_from_dynamodb_before_if_no_stream_ttl(search_params):
         assert where == 'dynamodb'
 
 
+def test_learnt_cadence_checks_youtube_sooner_than_the_fixed_gate(search_params):
+    # a scheduled start now polls every MIN_INTERVAL, well inside MIN_TIME_BEFORE_UPSTREAM_CHECKS
+    backend = CountingFakeYoutubeDynamodb()
+    checked = time.time() - 90
+    backend.items[search_params["channelId"]] = dynamodb_item(
+        search_params["channelId"], FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1], checked, checked)
+    get_schedules().add_scheduled(search_params["channelId"], time.time(), [time.time()], backend)
+    _status, _, where, _, _ = do_search_on_youtube(search_params, backend)
+    assert where == 'youtube'
+
+
+def test_sticky_video_kept_past_its_stored_ttl_is_cached_until_the_next_check(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    channel = search_params["channelId"]
+    old = time.time() - DYNAMODB_IF_STREAM_TTL - 1
+    backend.items[channel] = dynamodb_item(
+        channel, FakeYoutubeDynamodb.request_from_youtube_online(1, None)[1], old, old, time.time() + 3600)
+    with mock.patch.object(
+            backend, 'request_from_youtube', return_value=FakeYoutubeDynamodb.request_from_youtube_offline(1, None)):
+        results = [do_search_on_youtube(dict(search_params), backend) for _ in range(7)]
+        assert [result[2] for result in results] == ['dynamodb'] + ['cache'] * 6
+        assert are_there_videos(results[-1][1])
+        backend.calls.clear()
+        do_search_on_youtube(dict(search_params), backend)
+    assert backend.calls == {}
+
+
+def test_result_checked_recently_is_cached_until_the_next_check(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    channel = search_params["channelId"]
+    created, checked = time.time() - DYNAMODB_IF_NO_STREAM_TTL - 1, time.time() - 10
+    backend.items[channel] = dynamodb_item(
+        channel, FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1], created, checked)
+    assert do_search_on_youtube(dict(search_params), backend)[2] == 'dynamodb'
+    backend.calls.clear()
+    assert [do_search_on_youtube(dict(search_params), backend)[2] for _ in range(4)] == ['cache'] * 4
+    assert backend.calls == {}
+
+
 def test_force_video_id_writes_to_dynamodb(search_params):
     with mock.patch.object(FakeYoutubeDynamodb, 'write_to_dynamodb') as write_to_dynamodb_mock:
         force_video_id('ABCD', list(CHANNELS.keys())[0], 3600, youtube_and_dynamodb=FakeYoutubeDynamodb)
         assert write_to_dynamodb_mock.called
         assert write_to_dynamodb_mock.call_args.args[0] == list(CHANNELS.values())[0]
         assert abs(int(write_to_dynamodb_mock.call_args.args[2] - time.time()) - 3600) <= 1
+
+
+def test_live_searches_channels_concurrently():
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True), \
+            mock.patch.object(SlowFakeYoutubeDynamodb, 'delays', {"UCmainhall": 0.3, "UCelc": 0.3, "UCladies": 0.5}):
+        start = time.time()
+        results = live(youtube_and_dynamodb=SlowFakeYoutubeDynamodb)
+        elapsed = time.time() - start
+    assert elapsed < 0.9
+    assert results["any_live"]
+    for channel in THREE_CHANNELS:
+        assert results[channel]["how"] == 'youtube'
+        assert results[channel]["status_code"] == 200
+
+
+def test_refresh_searches_channels_concurrently():
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True), \
+            mock.patch.object(SlowFakeYoutubeDynamodb, 'delays', {"UCmainhall": 0.3, "UCelc": 0.3, "UCladies": 0.3}):
+        start = time.time()
+        results = live(skip_cache=True, youtube_and_dynamodb=SlowFakeYoutubeDynamodb)
+        elapsed = time.time() - start
+    assert elapsed < 0.8
+    assert all(results[channel]["how"] == 'youtube' for channel in THREE_CHANNELS)
+
+
+def test_live_slow_channel_is_degraded_not_blocking(executor):
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True), \
+            mock.patch.object(SlowFakeYoutubeDynamodb, 'delays', {"UCladies": 0.8}):
+        start = time.time()
+        results = live(youtube_and_dynamodb=SlowFakeYoutubeDynamodb, deadline=0.3)
+        elapsed = time.time() - start
+    assert elapsed < 1
+    assert results["any_live"]
+    assert results["mainhall"]["status_code"] == 200
+    assert results["ladies"]["status_code"] == 504
+    assert results["ladies"]["how"] == 'timeout'
+    assert results["ladies"]["result"] == {}
+
+
+def test_live_reads_and_writes_all_channels_in_one_batch():
+    backend = CountingFakeYoutubeDynamodb()
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        results = live(youtube_and_dynamodb=backend)
+    assert results["any_live"]
+    # the channel registry, one batch read for the channels, one for the shared api key usage;
+    # the probe states and stream schedules learnt from the searches are merged into the table one
+    # conditional write each
+    assert backend.calls == {
+        'get_item': 1, 'batch_get_item': 2, 'batch_write_item': 1, 'conditional_put_item': 6, 'youtube': 3,
+        'key_usage': 3}
+    assert set(THREE_CHANNELS.values()) < set(backend.items)
+
+
+def test_live_uses_batched_items_within_ttl():
+    backend = CountingFakeYoutubeDynamodb()
+    now = time.time()
+    for channel_id in THREE_CHANNELS.values():
+        backend.items[channel_id] = dynamodb_item(
+            channel_id, FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1], now, now)
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        results = live(youtube_and_dynamodb=backend)
+    assert not results["any_live"]
+    assert all(results[channel]["how"] == 'dynamodb' for channel in THREE_CHANNELS)
+    assert backend.calls == {'get_item': 1, 'batch_get_item': 1}
+
+
+def test_live_skips_batch_read_when_all_cached():
+    backend = CountingFakeYoutubeDynamodb()
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        live(youtube_and_dynamodb=backend)
+        backend.calls.clear()
+        results = live(youtube_and_dynamodb=backend)
+    assert all(results[channel]["how"] == 'cache' for channel in THREE_CHANNELS)
+    assert backend.calls == {}
+
+
+def test_real_backend_reuses_client_and_session():
+    backend = RealYoutubeDynamodb()
+    with mock.patch('boto3.client') as client_mock, mock.patch.dict('os.environ', {'TABLE': 'test'}):
+        client_mock.return_value.get_item.return_value = {}
+        backend.get_from_dynamodb('a')
+        backend.get_from_dynamodb('b')
+        backend.put_to_dynamodb(dynamodb_item('a', {}, 0, 0))
+    assert client_mock.call_count == 1
+    assert backend.session is backend.session
+
+
+def run_concurrently(fn, count):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        results[index] = fn()
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_misses_share_one_upstream_call(search_params):
+    backend = CountingFakeYoutubeDynamodb(youtube_delay=0.2)
+    results = run_concurrently(lambda: do_search_on_youtube(dict(search_params), backend), 20)
+    assert backend.calls['youtube'] == 1
+    # the channel item, its probe state and its stream schedule, then both again to merge into
+    assert backend.calls['get_item'] == 5
+    assert all(result[0] == 200 and result[2] == 'youtube' for result in results)
+
+
+def test_refresh_lease_lets_one_node_go_to_youtube(search_params):
+    # each call stands in for a different container: no shared in-process state, only the shared table
+    backend = CountingFakeYoutubeDynamodb(youtube_delay=0.2)
+    stored = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    stale = time.time() - DYNAMODB_IF_NO_STREAM_TTL - 1
+    results = run_concurrently(
+        lambda: request_from_youtube_and_write_to_cache(
+            dict(search_params), stored, stale, stale, stale, youtube_and_dynamodb=backend), 20)
+    assert backend.calls['youtube'] == 1
+    assert sorted(result[2] for result in results) == ['dynamodb'] * 19 + ['youtube']
+    assert all(result[0] == 200 for result in results)
+    assert not backend.leases
+
+
+def test_node_that_read_before_another_refreshed_does_not_refresh_again(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    stored = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    stale = int(time.time() - DYNAMODB_IF_NO_STREAM_TTL - 1)
+    backend.store.put_to_dynamodb(dynamodb_item(search_params["channelId"], stored, stale, stale))
+    # both nodes read the stale item; the second only asks for the lease once the first has put its refresh back
+    for _node in range(2):
+        request_from_youtube_and_write_to_cache(
+            dict(search_params), stored, stale, stale, stale, youtube_and_dynamodb=backend)
+    assert backend.calls['youtube'] == 1
+    assert not backend.leases
+
+
+def test_refresh_lease_without_stored_result_is_unavailable(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    backend.acquire_refresh_lease(search_params["channelId"], 30, 0)
+    status, result, where, _, _ = request_from_youtube_and_write_to_cache(
+        search_params, youtube_and_dynamodb=backend)
+    assert status == 503
+    assert where == 'dynamodb'
+    assert backend.calls['youtube'] == 0
+
+
+def test_real_backend_lease_conflict():
+    backend = RealYoutubeDynamodb()
+    conflict = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+    with mock.patch('boto3.client') as client_mock, mock.patch.dict('os.environ', {'TABLE': 'test'}):
+        assert backend.acquire_refresh_lease('a', 30, 0)
+        client_mock.return_value.update_item.side_effect = conflict
+        assert not backend.acquire_refresh_lease('a', 30, 0)
+        condition = client_mock.return_value.update_item.call_args[1]
+        assert 'last_checked_time < :checked' in condition['ConditionExpression']
+        assert condition['ExpressionAttributeValues'][':checked'] == {'N': '1'}
+
+
+def test_quota_exceeded_retries_once_with_another_key(search_params):
+    quota_exceeded = (403, {"error": {"code": 403, "errors": [{"reason": "quotaExceeded"}]}})
+    with mock.patch.dict('os.environ', {'YOUTUBE_API_KEYS': 'first:1,second:2'}):
+        reset_key_scheduler()
+    lines = []
+    metrics = Metrics(emit=lines.append)
+    with mock.patch.object(FakeYoutubeDynamodb, 'request_from_youtube') as request_from_youtube_mock, \
+            mock.patch('app.METRICS', metrics):
+        request_from_youtube_mock.side_effect = [
+            quota_exceeded, FakeYoutubeDynamodb.request_from_youtube_online(1, None)]
+        status, _, where, info, key_origin = do_search_on_youtube(search_params, FakeYoutubeDynamodb)
+    metrics.flush()
+    assert status == 200
+    # only the answered call spent quota
+    assert [(record["Key"], record["QuotaUnits"]) for record in map(json.loads, lines) if "QuotaUnits" in record] == [
+        (key_origin, SEARCH_COST)]
+    assert where == 'youtube'
+    assert request_from_youtube_mock.call_count == 2
+    health = get_key_scheduler().health()
+    assert health[key_origin]["quarantined_until"] is None
+    assert [origin for origin in health if health[origin]["quarantined_until"]] == [
+        ({'first', 'second'} - {key_origin}).pop()]
+    assert "quarantined until" in info
+
+
+def test_all_keys_exhausted_serves_stored_result(search_params):
+    with mock.patch.dict('os.environ', {'YOUTUBE_API_KEYS': 'only:1'}):
+        reset_key_scheduler()
+    stored = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    with mock.patch.object(FakeYoutubeDynamodb, 'request_from_youtube') as request_from_youtube_mock:
+        request_from_youtube_mock.return_value = (403, {"error": {"errors": [{"reason": "quotaExceeded"}]}})
+        status, result, where, _, _ = request_from_youtube_and_write_to_cache(
+            search_params, stored, youtube_and_dynamodb=FakeYoutubeDynamodb)
+        assert (status, result, where) == (200, stored, 'dynamodb')
+        status, result, where, _, _ = request_from_youtube_and_write_to_cache(
+            search_params, stored, youtube_and_dynamodb=FakeYoutubeDynamodb)
+        assert (status, result, where) == (200, stored, 'dynamodb')
+    assert request_from_youtube_mock.call_count == 1
+
+
+def test_poll_refreshes_due_channels_and_skips_recent_ones():
+    backend = CountingFakeYoutubeDynamodb()
+    now = time.time()
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    backend.items["UCelc"] = dynamodb_item("UCelc", offline, now, now)
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        polled = poll(youtube_and_dynamodb=backend)
+    assert polled == {"UCmainhall": 'youtube', "UCelc": 'not due', "UCladies": 'youtube'}
+    assert backend.calls['youtube'] == 2
+    assert are_there_videos(decode_item(backend.items["UCmainhall"])[0])
+    assert not are_there_videos(decode_item(backend.items["UCelc"])[0])
+
+
+def test_poll_keeps_forced_video_until_expiry():
+    backend = CountingFakeYoutubeDynamodb()
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True), \
+            mock.patch.object(CountingFakeYoutubeDynamodb, 'request_from_youtube') as request_from_youtube_mock:
+        request_from_youtube_mock.return_value = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)
+        force_video_id('FORCED', 'elc', 3600, youtube_and_dynamodb=backend)
+        # make the forced result due for a check
+        item = backend.items["UCelc"]
+        item['last_checked_time'] = {'N': str(time.time() - DYNAMODB_IF_STREAM_TTL - 1)}
+        backend.items["UCelc"] = item
+        polled = poll(youtube_and_dynamodb=backend)
+    assert polled["UCelc"] == 'dynamodb'
+    result, _, last_checked_time, _ = decode_item(backend.items["UCelc"])
+    assert result["items"][0]["id"]["videoId"] == 'FORCED'
+    assert time.time() - last_checked_time < 5
+
+
+def test_read_only_request_path_never_goes_to_youtube(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    stale = time.time() - DYNAMODB_IF_NO_STREAM_TTL - MIN_TIME_BEFORE_UPSTREAM_CHECKS - 1
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    with mock.patch.dict('os.environ', {'READ_ONLY_REQUEST_PATH': 'true'}):
+        status, _, where, info, _ = do_search_on_youtube(dict(search_params), backend)
+        assert (status, where) == (503, 'dynamodb')
+        backend.items[search_params["channelId"]] = dynamodb_item(search_params["channelId"], offline, stale, stale)
+        status, result, where, _, _ = do_search_on_youtube(dict(search_params), backend)
+        assert (status, result, where) == (200, offline, 'dynamodb')
+        status, result, where, _, _ = do_search_on_youtube(dict(search_params), backend)
+        assert where == 'cache'
+    assert backend.calls['youtube'] == 0
+
+
+@pytest.fixture
+def gateway():
+    backend = CountingFakeYoutubeDynamodb()
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True), mock.patch('app.YOUTUBE_AND_DYNAMODB', backend):
+        gateway = LocalGateway(app, Config())
+        gateway.backend = backend
+        yield gateway
+
+
+def get(gateway, path, headers=None):
+    return gateway.handle_request('GET', path, dict({'Host': 'localhost'}, **(headers or {})), b'')
+
+
+def test_refresh_honours_the_read_only_request_path(gateway):
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    stale = time.time() - DYNAMODB_IF_NO_STREAM_TTL - MIN_TIME_BEFORE_UPSTREAM_CHECKS - 1
+    gateway.backend.items["UCelc"] = dynamodb_item("UCelc", offline, stale, stale)
+    with mock.patch.dict('os.environ', {'READ_ONLY_REQUEST_PATH': 'true'}):
+        body = json.loads(get(gateway, '/refresh')['body'])
+    assert (body["elc"]["status_code"], body["elc"]["how"], body["elc"]["result"]) == (200, 'dynamodb', offline)
+    assert (body["mainhall"]["status_code"], body["mainhall"]["how"]) == (503, 'dynamodb')
+    assert gateway.backend.calls['youtube'] == 0
+
+
+def test_live_serves_etag_and_not_modified(gateway):
+    response = get(gateway, '/live')
+    assert response['statusCode'] == 200
+    etag = response['headers']['ETag']
+    assert json.loads(response['body'])["any_live"]
+    assert 'max-age=' in response['headers']['Cache-Control']
+    assert 'stale-while-revalidate=' in response['headers']['Cache-Control']
+    response = get(gateway, '/live', {'If-None-Match': etag})
+    assert response['statusCode'] == 304
+    assert response['body'] == ''
+    assert response['headers']['ETag'] == etag
+    response = get(gateway, '/live', {'If-None-Match': '"stale"'})
+    assert response['statusCode'] == 200
+
+
+def test_payload_renderer_serializes_once_per_state_change():
+    serialize = mock.Mock(side_effect=json.dumps)
+    renderer = PayloadRenderer(serialize=serialize)
+    online = FakeYoutubeDynamodb.request_from_youtube_online(1, None)[1]
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    first = renderer.render({"elc": {"status_code": 200, "result": online, "how": 'youtube'}, "any_live": True})
+    second = renderer.render({"elc": {"status_code": 200, "result": online, "how": 'cache'}, "any_live": True})
+    assert second is first
+    third = renderer.render({"elc": {"status_code": 200, "result": offline, "how": 'youtube'}, "any_live": False})
+    assert third.etag != first.etag
+    assert serialize.call_count == 2
+
+
+def test_containers_tag_the_same_live_state_alike():
+    online = FakeYoutubeDynamodb.request_from_youtube_online(1, None)[1]
+    first = PayloadRenderer().render({"elc": {"status_code": 200, "result": online, "how": 'youtube'}, "any_live": True})
+    # another container first rendered it from its own fetch, with its own key
+    other = PayloadRenderer().render(
+        {"elc": {"status_code": 200, "result": online, "how": 'dynamodb', "key_origin": 'second'}, "any_live": True})
+    assert other.body != first.body
+    assert other.etag == first.etag
+
+
+def test_live_etag_changes_with_state(gateway):
+    first = get(gateway, '/live')
+    second = get(gateway, '/live')
+    assert first['body'] == second['body']
+    reset_cache()
+    gateway.backend.items.clear()
+    with mock.patch.object(CountingFakeYoutubeDynamodb, 'request_from_youtube') as request_from_youtube_mock:
+        request_from_youtube_mock.return_value = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)
+        third = get(gateway, '/live', {'If-None-Match': first['headers']['ETag']})
+    assert third['statusCode'] == 200
+    assert not json.loads(third['body'])["any_live"]
+
+
+def test_live_compact_returns_only_what_the_widget_needs(gateway):
+    full = get(gateway, '/live')
+    compact = get(gateway, '/live/compact')
+    assert compact['statusCode'] == 200
+    body = json.loads(compact['body'])
+    assert body["any_live"]
+    fetched_at = body["elc"].pop("fetched_at")
+    assert body["elc"] == {
+        "live": True, "videoId": "KTf2_GL_6lA", "title": "The KSIMC of London - Stanmore - Main Hall Live Stream",
+        "how": 'cache', "status_code": 200}
+    assert fetched_at == int(get_cache()[CHANNELS["elc"]].fetched_at)
+    assert len(compact['body']) * 4 < len(full['body'])
+    assert get(gateway, '/live/compact', {'If-None-Match': compact['headers']['ETag']})['statusCode'] == 304
+
+
+def test_summary_is_computed_when_cached(search_params):
+    do_search_on_youtube(search_params, FakeYoutubeDynamodb)
+    entry = get_cache()[search_params["channelId"]]
+    assert entry.summary == {
+        "live": True, "videoId": "KTf2_GL_6lA", "title": "The KSIMC of London - Stanmore - Main Hall Live Stream"}
+    assert time.time() - entry.fetched_at < 5
+
+
+def test_live_wait_answers_at_once_for_an_old_version(gateway):
+    response = get(gateway, '/live/wait')
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert body["version"] == response['headers']['ETag']
+    assert body["elc"]["live"]
+    response = get(gateway, '/live/wait?etag=%22old%22')
+    assert response['statusCode'] == 200
+
+
+def test_live_wait_times_out_with_not_modified(gateway):
+    version = get(gateway, '/live/wait')['headers']['ETag']
+    with mock.patch('app.LONG_POLL_INTERVAL', 0.05):
+        start = time.time()
+        response = get(gateway, '/live/wait?timeout=0.3&etag=' + version)
+    assert response['statusCode'] == 304
+    assert response['headers']['ETag'] == version
+    assert 0.2 < time.time() - start < 1
+
+
+def test_live_wait_reads_the_state_less_often_the_longer_it_holds(gateway):
+    version = get(gateway, '/live/wait')['headers']['ETag']
+    gateway.backend.calls.clear()
+    with mock.patch('app.LONG_POLL_INTERVAL', 0.05), mock.patch('app.LONG_POLL_MAX_INTERVAL', 0.2):
+        response = get(gateway, '/live/wait?timeout=1&etag=' + version)
+    assert response['statusCode'] == 304
+    # after 0.05, 0.1 and then every 0.2s, against about 20 reads at a fixed 0.05s
+    assert gateway.backend.calls['batch_get_item'] <= 8
+
+
+def test_live_wait_counts_its_live_pass_against_the_timeout(gateway, executor):
+    # youtube slower than the whole wait: the /live pass gets what is left, not LIVE_DEADLINE on top
+    gateway.backend.youtube_delay = 0.5
+    with mock.patch('app.LONG_POLL_INTERVAL', 0.05):
+        start = time.time()
+        response = get(gateway, '/live/wait?timeout=0.2&etag=%22old%22')
+    assert response['statusCode'] == 200
+    assert time.time() - start < 0.45
+
+
+def test_live_wait_returns_when_state_changes(gateway):
+    version = get(gateway, '/live/wait')['headers']['ETag']
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+
+    def go_offline():
+        time.sleep(0.2)
+        now = time.time()
+        gateway.backend.items["UCelc"] = dynamodb_item("UCelc", offline, now, now)
+    changer = threading.Thread(target=go_offline)
+    with mock.patch('app.LONG_POLL_INTERVAL', 0.05):
+        start = time.time()
+        changer.start()
+        response = get(gateway, '/live/wait?timeout=5&etag=' + version)
+        changer.join()
+    assert response['statusCode'] == 200
+    assert time.time() - start < 2
+    body = json.loads(response['body'])
+    assert body["version"] != version
+    assert not body["elc"]["live"]
+    assert body["mainhall"]["live"]
+
+
+def test_soft_expired_entry_is_served_while_refreshed_in_background(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    assert do_search_on_youtube(search_params, backend)[2] == 'youtube'
+    channel = search_params["channelId"]
+    later = time.time() + LIVE_CACHE_TTL + 1
+    with mock.patch.object(CACHE, 'clock', lambda: later):
+        backend.calls.clear()
+        status, result, where, info, _ = do_search_on_youtube(search_params, backend)
+        assert (status, where) == (200, 'cache')
+        assert info.startswith("refreshing in the background")
+        for _ in range(100):
+            if channel not in get_cache().refreshing:
+                break
+            time.sleep(0.01)
+        # the stored item is still within its ttl, so the refresh only went as far as dynamodb
+        assert backend.calls == {'get_item': 1}
+        assert do_search_on_youtube(search_params, backend)[2] == 'cache'
+    assert get_cache().stats()['memory'] == {'miss': 1, 'stale': 1, 'hit': 1}
+    assert get_cache().stats()['dynamodb'] == {'miss': 1, 'hit': 1}
+
+
+def search_gateway(backend, query):
+    with mock.patch('app.YOUTUBE_AND_DYNAMODB', backend):
+        gateway = LocalGateway(app, Config())
+        return gateway.handle_request('GET', '/v3/search?' + query, {'Host': 'localhost'}, b'')
+
+
+def test_equivalent_searches_share_one_cache_entry():
+    backend = CountingFakeYoutubeDynamodb()
+    first = search_gateway(backend, 'part=snippet,id&q=majlis&type=video&key=one')
+    second = search_gateway(backend, 'type=video&q=%20majlis&part=id,snippet&key=two&callback=junk&_=123')
+    assert first['statusCode'] == second['statusCode'] == 200
+    assert json.loads(first['body']) == json.loads(second['body'])
+    assert backend.calls['youtube'] == 1
+    assert backend.youtube_params == [{"part": "id,snippet", "q": "majlis", "type": "video", "key": "one"}]
+    assert len(SEARCH_CACHE) == 1 and len(CACHE) == 0
+
+
+def test_different_searches_do_not_collide():
+    backend = CountingFakeYoutubeDynamodb()
+    search_gateway(backend, 'part=snippet&q=majlis')
+    search_gateway(backend, 'part=snippet&q=dua')
+    assert backend.calls['youtube'] == 2
+    assert len(SEARCH_CACHE) == 2
+    searches = [item for key, item in backend.items.items() if key.startswith('search#')]
+    assert len(searches) == 2
+    # only the open-ended searches are left for dynamodb's time to live to delete
+    assert all(
+        int(item['expires_at']['N']) == int(item['last_checked_time']['N']) + SEARCH_ITEM_RETENTION for item in searches)
+    assert not [item for key, item in backend.items.items() if 'expires_at' in item and not key.startswith('search#')]
+
+
+def test_default_live_search_stays_keyed_by_channel(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    query = '&'.join(f'{name}={value}' for name, value in reversed(list(search_params.items())))
+    assert search_gateway(backend, query + '&callback=junk')['statusCode'] == 200
+    assert search_params["channelId"] in CACHE
+    assert search_params["channelId"] in backend.items
+    assert len(SEARCH_CACHE) == 0
+
+
+def test_concurrent_equivalent_searches_share_one_upstream_call():
+    backend = CountingFakeYoutubeDynamodb(youtube_delay=0.2)
+    queries = itertools.cycle([{"q": "majlis", "part": "snippet"}, {"part": " snippet", "q": "majlis", "key": "mine"}])
+    results = run_concurrently(lambda: do_search_on_youtube(dict(next(queries)), backend), 10)
+    assert backend.calls['youtube'] == 1
+    assert all(result[0] == 200 for result in results)
+
+
+def live_gateway(backend, path, headers=None, method='GET'):
+    with mock.patch('app.YOUTUBE_AND_DYNAMODB', backend):
+        gateway = LocalGateway(app, Config())
+        return gateway.handle_request(method, path, dict({'Host': 'localhost'}, **(headers or {})), b'')
+
+
+def test_live_can_be_asked_for_some_channels():
+    backend = CountingFakeYoutubeDynamodb()
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        response = live_gateway(backend, '/live?channels=elc,%20ladies')
+        everything = live_gateway(backend, '/live')
+        unknown = live_gateway(backend, '/live/compact?channels=elc,nowhere')
+    assert set(json.loads(response['body'])) == {"elc", "ladies", "any_live"}
+    assert set(json.loads(everything['body'])) == set(THREE_CHANNELS) | {"any_live"}
+    assert response['headers']['ETag'] != everything['headers']['ETag']
+    assert unknown['statusCode'] == 400
+    assert backend.calls['youtube'] == 3
+
+
+def test_channels_are_registered_by_admins(monkeypatch):
+    backend = CountingFakeYoutubeDynamodb()
+    mainhall = "UCSSgKFdC-gRtxIgTrGGqP3g"
+    path = f'/channels/mainhall?channelId={mainhall}'
+    assert live_gateway(backend, path, method='PUT')['statusCode'] == 403
+    monkeypatch.setenv('ADMIN_TOKEN', 'sesame')
+    assert live_gateway(backend, path, {'X-Admin-Token': 'guess'}, 'PUT')['statusCode'] == 403
+    assert live_gateway(backend, '/channels/mainhall?channelId=junk', {'X-Admin-Token': 'sesame'}, 'PUT')[
+        'statusCode'] == 400
+    response = live_gateway(backend, path, {'X-Admin-Token': 'sesame'}, 'PUT')
+    assert json.loads(response['body']) == dict(CHANNELS, mainhall=mainhall)
+    reset_registry()  # as another container would see it
+    assert json.loads(live_gateway(backend, '/channels')['body']) == dict(CHANNELS, mainhall=mainhall)
+    assert set(json.loads(live_gateway(backend, '/live')['body'])) == set(CHANNELS) | {"mainhall", "any_live"}
+    response = live_gateway(backend, '/channels/mainhall', {'X-Admin-Token': 'sesame'}, 'DELETE')
+    assert json.loads(response['body']) == CHANNELS
+    assert live_gateway(backend, '/channels/mainhall', {'X-Admin-Token': 'sesame'}, 'DELETE')['statusCode'] == 404
+    assert get_registry().channels == CHANNELS
+
+
+def test_poll_probes_due_channels_in_shared_videos_calls():
+    backend = CountingFakeYoutubeDynamodb()
+    for channel_id in THREE_CHANNELS.values():
+        get_probes().learn(channel_id, [channel_id + "-video1", channel_id + "-video2"])
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        polled = poll(backend)
+    assert polled == {channel_id: 'youtube' for channel_id in THREE_CHANNELS.values()}
+    # one videos.list for the six known broadcasts, then each channel's own search as none was live
+    assert backend.calls['videos'] == 1
+    assert backend.calls['youtube'] == 3
+
+
+def test_poll_falls_back_to_search_when_the_batched_probe_fails():
+    backend = CountingFakeYoutubeDynamodb()
+    for channel_id in THREE_CHANNELS.values():
+        get_probes().learn(channel_id, [channel_id + "-video1"])
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True), \
+            mock.patch.object(backend, 'request_videos_from_youtube', side_effect=CircuitOpen("youtube circuit open")):
+        polled = poll(backend)
+    assert polled == {channel_id: 'youtube' for channel_id in THREE_CHANNELS.values()}
+    assert backend.calls['youtube'] == 3
+    assert set(THREE_CHANNELS.values()) <= set(backend.items)
+
+
+def test_force_offline_stores_a_decodable_result():
+    backend = CountingFakeYoutubeDynamodb()
+    channel_id = list(CHANNELS.values())[0]
+    force_video_id(None, list(CHANNELS.keys())[0], 3600, youtube_and_dynamodb=backend)
+    result = decode_item(backend.items[channel_id])[0]
+    assert isinstance(result, dict)
+    assert not are_there_videos(result)
+    assert get_cache()[channel_id].result == result
+
+
+def test_legacy_items_are_rewritten_compact(search_params):
+    backend = CountingFakeYoutubeDynamodb()
+    channel_id = search_params["channelId"]
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    backend.items[channel_id] = {
+        'channel': {'S': channel_id}, 'time': {'N': str(time.time() - 3600)}, 'result': {'S': json.dumps(offline)}}
+    status_code, result, how, _, _ = do_search_on_youtube(search_params, backend)
+    assert (status_code, how) == (200, 'youtube')
+    assert 'result' not in backend.items[channel_id]
+    assert decode_item(backend.items[channel_id])[0] == result
+
+
+def test_search_emits_tier_counts_and_a_trace(search_params):
+    lines = []
+    backend = CountingFakeYoutubeDynamodb()
+    path = '/v3/search?' + '&'.join(f"{name}={value}" for name, value in search_params.items())
+    with mock.patch('app.METRICS', Metrics(sample_rate=1.0, emit=lines.append)):
+        assert live_gateway(backend, path)['statusCode'] == 200
+        assert live_gateway(backend, path)['statusCode'] == 200
+    records = [json.loads(line) for line in lines]
+    lookups = {(record["Tier"], record["Outcome"]): record["TierLookups"] for record in records if "TierLookups" in record}
+    assert lookups == {('memory', 'miss'): 1, ('dynamodb', 'miss'): 1, ('memory', 'hit'): 1}
+    assert [record["YoutubeCalls"] for record in records if record.get("Api") == 'search.list' and "YoutubeCalls" in record
+            ] == [1]
+    traces = [record for record in records if "trace_id" in record]
+    assert [trace["trace"] for trace in traces] == ['youtube', 'youtube']
+    assert [span["name"] for span in traces[0]["spans"]] == ['dynamodb_read', 'lease', 'youtube', 'dynamodb_write']
+    assert traces[1]["spans"] == []
+
+
+def test_websub_renewal_flushes_what_it_records_in_its_own_trace(capsys):
+    event = {"version": "0", "account": "123456789012", "region": "us-east-1", "detail": {},
+             "detail-type": "Scheduled Event", "source": "aws.events", "time": "2026-01-01T00:00:00Z",
+             "id": "renew", "resources": []}
+    with mock.patch('boto3.client') as client_mock, mock.patch.dict('os.environ', {'TABLE': 'test'}), \
+            mock.patch('app.YOUTUBE_AND_DYNAMODB', RealYoutubeDynamodb()), \
+            mock.patch('app.METRICS', Metrics(sample_rate=1.0)):
+        client_mock.return_value.get_item.return_value = {}
+        capsys.readouterr()
+        renew_websub(event, None)
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert [record["trace"] for record in records if "trace_id" in record] == ['renew_websub']
+    assert [record["Operation"] for record in records if "DynamodbLatency" in record] == ['get_item']
+
+
+def test_importing_the_app_leaves_the_heavy_dependencies_for_later():
+    loaded = subprocess.check_output([sys.executable, '-c', (
+        "import sys, app; print(','.join(m for m in ('boto3', 'botocore', 'requests', 'durations') if m in sys.modules))")],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert loaded.decode().strip() == ''
+
+
+def test_prefetch_caches_channels_still_within_their_ttl():
+    backend = CountingFakeYoutubeDynamodb()
+    channel_ids = list(THREE_CHANNELS.values())
+    offline = FakeYoutubeDynamodb.request_from_youtube_offline(1, None)[1]
+    now = time.time()
+    backend.items[channel_ids[0]] = dynamodb_item(channel_ids[0], offline, now, now)
+    backend.items[channel_ids[1]] = dynamodb_item(
+        channel_ids[1], offline, now - DYNAMODB_IF_NO_STREAM_TTL - 1, now - DYNAMODB_IF_NO_STREAM_TTL - 1)
+    with mock.patch.dict('app.CHANNELS', THREE_CHANNELS, clear=True):
+        assert prefetch_channels(backend) == [channel_ids[0]]
+        assert backend.calls['youtube'] == 0
+        response = live_gateway(backend, '/live')
+    assert json.loads(response['body'])[list(THREE_CHANNELS)[0]]['how'] == 'cache'
+    assert backend.calls['youtube'] == 2
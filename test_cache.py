@@ -0,0 +1,154 @@
+import threading
+import time
+from chalicelib.cache import TieredCache, FRESH, STALE, MISS
+from conftest import FakeClock
+
+
+class Submissions(list):
+    """Collects background refreshes so a test can run them when it wants."""
+    def __call__(self, fn, *args):
+        self.append((fn, args))
+
+    def run(self):
+        while self:
+            fn, args = self.pop(0)
+            fn(*args)
+
+
+def make_cache(clock, submit=None, maxsize=100):
+    return TieredCache(live_ttl=60, offline_ttl=20, stale_window=30, maxsize=maxsize, clock=clock,
+                       submit=Submissions() if submit is None else submit)
+
+
+def test_live_and_offline_entries_have_their_own_ttl():
+    clock = FakeClock()
+    cache = make_cache(clock)
+    cache.put('live', 1, live=True)
+    cache.put('offline', 0, live=False)
+    clock.now += 19
+    assert cache.get('live') == (1, FRESH)
+    assert cache.get('offline') == (0, FRESH)
+    clock.now += 2
+    assert cache.get('live') == (1, FRESH)
+    assert cache.get('offline') == (0, STALE)
+    clock.now += 40
+    assert cache.get('live') == (1, STALE)
+    assert cache.get('offline') == (None, MISS)
+
+
+def test_expiry_time_caps_freshness():
+    clock = FakeClock()
+    cache = make_cache(clock)
+    cache.put('forced', 1, live=True, expiry_time=clock.now + 5)
+    assert cache.get('forced') == (1, FRESH)
+    clock.now += 5
+    assert cache.get('forced') == (1, STALE)
+    cache.put('later', 1, live=True, expiry_time=clock.now + 600)
+    clock.now += 61
+    assert cache.get('later') == (1, STALE)
+
+
+def test_stale_entry_is_served_while_one_refresh_runs():
+    clock = FakeClock()
+    submissions = Submissions()
+    cache = make_cache(clock, submissions)
+    cache.put('a', 'old')
+    clock.now += 25
+    refreshes = []
+
+    def refresh():
+        refreshes.append(clock.now)
+        cache.put('a', 'new')
+    assert cache.get('a', refresh) == ('old', STALE)
+    assert cache.get('a', refresh) == ('old', STALE)
+    assert len(submissions) == 1
+    submissions.run()
+    assert refreshes == [clock.now]
+    assert cache.get('a', refresh) == ('new', FRESH)
+    clock.now += 25
+    assert cache.get('a', refresh) == ('new', STALE)
+    assert len(submissions) == 1
+
+
+def test_failed_refresh_can_be_retried():
+    clock = FakeClock()
+    submissions = Submissions()
+    cache = make_cache(clock, submissions)
+    cache.put('a', 'old')
+    clock.now += 25
+
+    def refresh():
+        raise RuntimeError("upstream down")
+    cache.get('a', refresh)
+    submissions.run()
+    assert cache.get('a', refresh) == ('old', STALE)
+    assert len(submissions) == 1
+
+
+def test_concurrent_stale_lookups_start_one_refresh():
+    clock = FakeClock()
+    cache = TieredCache(live_ttl=60, offline_ttl=20, stale_window=30, clock=clock)
+    cache.put('a', 'old')
+    clock.now += 25
+    release = threading.Event()
+    calls = []
+
+    def refresh():
+        calls.append(1)
+        release.wait(5)
+        cache.put('a', 'new')
+    threads = [threading.Thread(target=cache.get, args=('a', refresh)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    release.set()
+    for _ in range(100):
+        if cache.get('a')[0] == 'new':
+            break
+        time.sleep(0.01)
+    assert cache.get('a') == ('new', FRESH)
+    assert calls == [1]
+
+
+def test_expired_entry_is_kept_as_last_good():
+    clock = FakeClock()
+    cache = make_cache(clock)
+    cache.put('a', 'value')
+    clock.now += 3600
+    assert cache.get('a') == (None, MISS)
+    assert 'a' not in cache
+    assert cache.last_good('a') == 'value'
+    cache.put('b', 'value')
+    cache.invalidate('b')
+    assert cache.get('b') == (None, MISS)
+    assert cache.last_good('b') == 'value'
+    assert cache.last_good('c') is None
+
+
+def test_least_recently_used_entries_are_dropped_past_maxsize():
+    clock = FakeClock()
+    cache = make_cache(clock, maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert len(cache) == 2
+    assert 'a' in cache and 'c' in cache
+    assert cache.last_good('b') is None
+
+
+def test_counts_by_tier():
+    clock = FakeClock()
+    cache = make_cache(clock)
+    cache.get('a')
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('a')
+    clock.now += 25
+    cache.get('a')
+    cache.record('dynamodb', 'hit')
+    assert cache.stats() == {'memory': {'miss': 1, 'hit': 2, 'stale': 1}, 'dynamodb': {'hit': 1}}
+    cache.clear()
+    assert cache.stats() == {}
+    assert len(cache) == 0
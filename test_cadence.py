@@ -0,0 +1,96 @@
+import calendar
+import datetime
+from chalicelib.cadence import ScheduleBook, StreamSchedule, MIN_INTERVAL, MAX_INTERVAL, RELOAD_INTERVAL, SCHEDULED_LEAD
+from chalicelib.cadence import schedule_key
+from conftest import FakeClock, MemoryStore
+
+
+def utc(*args):
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+def learnt_schedule(weeks=4):
+    # live every Monday at 19:30 for the last few weeks
+    schedule = StreamSchedule()
+    for week in range(weeks):
+        start = utc(2026, 9, 7, 19, 30) + week * 7 * 24 * 3600
+        schedule.observe(start - 600, False)
+        schedule.observe(start, True)
+        schedule.observe(start + 7200, False)
+    return schedule
+
+
+def test_without_history_uses_fixed_interval():
+    schedule = StreamSchedule()
+    assert schedule.next_check_time(1000, False, 200) == 1200
+    schedule.observe(1000, False)
+    assert schedule.next_check_time(1000, False, 200) == 1200
+
+
+def test_only_offline_to_live_transitions_are_counted():
+    schedule = StreamSchedule()
+    assert schedule.observe(utc(2026, 10, 5, 19, 30), True)
+    assert not schedule.counts
+    assert not schedule.observe(utc(2026, 10, 5, 19, 35), True)
+    assert schedule.observe(utc(2026, 10, 5, 21), False)
+    assert schedule.observe(utc(2026, 10, 12, 19, 30), True)
+    assert sum(schedule.counts.values()) == 1
+
+
+def test_polls_tightly_near_learnt_start_and_sparsely_otherwise():
+    schedule = learnt_schedule()
+    assert schedule.interval_at(utc(2026, 10, 5, 19, 30)) == MIN_INTERVAL
+    assert schedule.interval_at(utc(2026, 10, 5, 3, 0)) == MAX_INTERVAL
+    assert schedule.next_check_time(utc(2026, 10, 5, 3, 0), False, 200) == utc(2026, 10, 5, 3, 30)
+    # the check before the usual start may not overshoot it
+    assert schedule.next_check_time(utc(2026, 10, 5, 18, 45), False, 200) <= utc(2026, 10, 5, 19, 5)
+    # live streams keep the fixed interval
+    assert schedule.next_check_time(utc(2026, 10, 5, 19, 30), True, 900) == utc(2026, 10, 5, 19, 45)
+
+
+def test_scheduled_start_tightens_polling():
+    schedule = StreamSchedule()
+    now = utc(2026, 10, 6, 10)
+    start = utc(2026, 10, 6, 12)
+    assert schedule.add_scheduled(now, [start])
+    assert not schedule.add_scheduled(now, [start])
+    assert schedule.interval_at(start - SCHEDULED_LEAD) == MIN_INTERVAL
+    assert schedule.next_check_time(start - SCHEDULED_LEAD - 600, False, 200) <= start - SCHEDULED_LEAD + MIN_INTERVAL
+
+
+def test_round_trips_through_json():
+    schedule = learnt_schedule()
+    restored = StreamSchedule.from_json(schedule.to_json())
+    assert restored.counts == schedule.counts
+    assert restored.live == schedule.live
+    now = utc(2026, 10, 5, 18, 45)
+    assert restored.next_check_time(now, False, 200) == schedule.next_check_time(now, False, 200)
+
+
+def test_safety_interval_replaces_history_but_not_scheduled_starts():
+    schedule = learnt_schedule()
+    monday = utc(2026, 10, 5, 19, 0)
+    assert schedule.next_check_time(monday, False, 200) < monday + 1800
+    assert schedule.next_check_time(monday, False, 200, safety_interval=7200) == monday + 7200
+    assert StreamSchedule().next_check_time(monday, False, 200, safety_interval=7200) == monday + 7200
+    schedule.add_scheduled(monday, [monday + 3600])
+    assert schedule.next_check_time(monday, False, 200, safety_interval=7200) <= monday + 3600 - SCHEDULED_LEAD + MIN_INTERVAL
+    assert schedule.next_check_time(monday, True, 200, safety_interval=7200) == monday + 200
+
+
+def test_a_scheduled_start_learnt_elsewhere_survives_the_pollers_observations():
+    clock, store = FakeClock(), MemoryStore()
+    api, poller = ScheduleBook(clock), ScheduleBook(clock)
+    channel, start = "UCcadence", utc(2026, 10, 6, 12)
+    poller.observe(channel, utc(2026, 10, 6, 9), False, store)
+    api.add_scheduled(channel, utc(2026, 10, 6, 10), [start], store)
+    poller.observe(channel, utc(2026, 10, 6, 10, 5), True, store)
+    stored = StreamSchedule.from_json(store.items[schedule_key(channel)]['schedule']['S'])
+    assert (stored.scheduled, stored.live) == ([start], True)
+    assert poller.get(channel).scheduled == [start]
+    api.add_scheduled(channel, utc(2026, 10, 6, 10), [start + 3600], store)
+    poller.load(channel, store)
+    assert poller.get(channel).scheduled == [start]
+    clock.now += RELOAD_INTERVAL
+    poller.load(channel, store)
+    assert poller.get(channel).scheduled == [start, start + 3600]
@@ -0,0 +1,101 @@
+import calendar
+import datetime
+import threading
+from chalicelib.keys import KeyScheduler, next_pacific_midnight, pacific_day, SEARCH_COST, RATE_LIMIT_BACKOFF
+from conftest import FakeClock, MemoryStore
+
+QUOTA_EXCEEDED = {"error": {"code": 403, "errors": [{"reason": "quotaExceeded", "domain": "youtube.quota"}]}}
+RATE_LIMIT_EXCEEDED = {"error": {"code": 403, "errors": [{"reason": "rateLimitExceeded", "domain": "youtube.quota"}]}}
+
+
+def utc(*args):
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+def test_next_pacific_midnight():
+    assert next_pacific_midnight(utc(2026, 7, 1, 12)) == utc(2026, 7, 2, 7)
+    assert next_pacific_midnight(utc(2026, 1, 15, 12)) == utc(2026, 1, 16, 8)
+    # 00:30 PST on the day clocks go forward: the next midnight is already PDT
+    assert next_pacific_midnight(utc(2026, 3, 8, 8, 30)) == utc(2026, 3, 9, 7)
+    assert pacific_day(utc(2026, 7, 2, 6, 59)) == '2026-07-01'
+    assert pacific_day(utc(2026, 7, 2, 7)) == '2026-07-02'
+
+
+def test_prefers_key_with_most_remaining_quota():
+    store = MemoryStore()
+    scheduler = KeyScheduler('a:1,b:2', daily_quota=1000, clock=FakeClock(utc(2026, 7, 1, 12)))
+    scheduler.record(store, 'a', 200)
+    assert scheduler.pick(store) == ('b', '2')
+    scheduler.record(store, 'b', 200)
+    scheduler.record(store, 'b', 200)
+    assert scheduler.pick(store) == ('a', '1')
+    assert scheduler.health()['b']['remaining'] == 1000 - 2 * SEARCH_COST
+
+
+def test_quota_exceeded_quarantines_until_pacific_midnight():
+    store = MemoryStore()
+    clock = FakeClock(utc(2026, 7, 1, 12))
+    scheduler = KeyScheduler('a:1,b:2', clock=clock)
+    scheduler.record(store, 'a', 403, QUOTA_EXCEEDED)
+    assert scheduler.health()['a']['quarantined_until'] == utc(2026, 7, 2, 7)
+    assert scheduler.pick(store) == ('b', '2')
+    assert scheduler.pick(store, exclude={'b'}) is None
+    assert 'a quarantined until 2026-07-02T07:00:00Z' in scheduler.health_summary()
+    clock.now = utc(2026, 7, 2, 7, 0, 1)
+    assert scheduler.pick(store, exclude={'b'}) == ('a', '1')
+
+
+def test_rate_limited_key_backs_off_briefly():
+    store = MemoryStore()
+    clock = FakeClock(utc(2026, 7, 1, 12))
+    scheduler = KeyScheduler('a:1', clock=clock)
+    scheduler.record(store, 'a', 429)
+    assert scheduler.pick(store) is None
+    clock.now += RATE_LIMIT_BACKOFF + 1
+    assert scheduler.pick(store) == ('a', '1')
+
+
+def test_per_second_rate_limit_is_not_the_daily_quota():
+    store = MemoryStore()
+    clock = FakeClock(utc(2026, 7, 1, 12))
+    scheduler = KeyScheduler('a:1', clock=clock)
+    scheduler.record(store, 'a', 403, RATE_LIMIT_EXCEEDED)
+    assert scheduler.health()['a']['quarantined_until'] == clock.now + RATE_LIMIT_BACKOFF
+    clock.now += RATE_LIMIT_BACKOFF + 1
+    assert scheduler.pick(store) == ('a', '1')
+    assert scheduler.health()['a']['remaining'] == 10000
+
+
+def test_picks_do_not_wait_on_another_threads_usage_read():
+    reading, release = threading.Event(), threading.Event()
+
+    class SlowStore(MemoryStore):
+        def batch_get_from_dynamodb(self, keys):
+            reading.set()
+            release.wait(5)
+            return super().batch_get_from_dynamodb(keys)
+    store = SlowStore()
+    scheduler = KeyScheduler('a:1', clock=FakeClock(utc(2026, 7, 1, 12)))
+    refreshing = threading.Thread(target=scheduler.pick, args=(store,))
+    refreshing.start()
+    assert reading.wait(5)
+    picked = []
+    other = threading.Thread(target=lambda: picked.append(scheduler.pick(store)))
+    other.start()
+    other.join(1)
+    release.set()
+    refreshing.join()
+    assert picked == [('a', '1')]
+
+
+def test_spend_is_shared_between_containers_through_the_store():
+    store = MemoryStore()
+    clock = FakeClock(utc(2026, 7, 1, 12))
+    first = KeyScheduler('a:1,b:2', daily_quota=1000, clock=clock)
+    second = KeyScheduler('a:1,b:2', daily_quota=1000, clock=clock)
+    for _ in range(3):
+        first.record(store, 'a', 200)
+    first.record(store, 'b', 403, QUOTA_EXCEEDED)
+    assert second.pick(store) == ('a', '1')
+    assert second.health()['a']['remaining'] == 1000 - 3 * SEARCH_COST
+    assert second.health()['b']['quarantined_until'] == utc(2026, 7, 2, 7)
@@ -0,0 +1,119 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from chalicelib.metrics import Metrics, NullMetrics, MAX_VALUES
+
+
+def emitted(capsys):
+    """The EMF lines the metrics printed to stdout, where Lambda hands them to CloudWatch."""
+    return capsys.readouterr().out.splitlines()
+
+
+def records(lines):
+    return [json.loads(line) for line in lines]
+
+
+def metric_records(lines):
+    return [record for record in records(lines) if "_aws" in record]
+
+
+def test_counts_and_timings_are_emitted_once_per_dimension_set(capsys):
+    metrics = Metrics("Test", clock=lambda: 1000.0)
+    metrics.count("TierLookups", Tier='memory', Outcome='hit')
+    metrics.count("TierLookups", Tier='memory', Outcome='hit')
+    metrics.count("TierLookups", Tier='dynamodb', Outcome='miss')
+    metrics.timing("DynamodbLatency", 5.5, Operation='get_item')
+    metrics.timing("DynamodbLatency", 7.25, Operation='get_item')
+    metrics.flush()
+    lines = emitted(capsys)
+    by_dimensions = {tuple(record["_aws"]["CloudWatchMetrics"][0]["Dimensions"][0]): record
+                     for record in metric_records(lines)}
+    assert len(lines) == 3
+    memory = [record for record in metric_records(lines) if record.get("Tier") == 'memory'][0]
+    assert memory["TierLookups"] == 2
+    assert memory["_aws"]["Timestamp"] == 1000000
+    assert memory["_aws"]["CloudWatchMetrics"] == [{
+        "Namespace": "Test", "Dimensions": [["Outcome", "Tier"]],
+        "Metrics": [{"Name": "TierLookups", "Unit": "Count"}]}]
+    latency = by_dimensions[("Operation",)]
+    assert latency["DynamodbLatency"] == [5.5, 7.25]
+    assert latency["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [{"Name": "DynamodbLatency", "Unit": "Milliseconds"}]
+
+
+def test_flush_starts_afresh(capsys):
+    metrics = Metrics()
+    metrics.count("Decisions", Decision='youtube check')
+    metrics.flush()
+    metrics.flush()
+    lines = emitted(capsys)
+    assert len(lines) == 1
+
+
+def test_timings_are_split_into_records_cloudwatch_accepts(capsys):
+    metrics = Metrics()
+    for value in range(MAX_VALUES + 1):
+        metrics.timing("YoutubeLatency", value, Api='search.list')
+    metrics.flush()
+    lines = emitted(capsys)
+    assert [len(record["YoutubeLatency"]) if isinstance(record["YoutubeLatency"], list) else 1
+            for record in metric_records(lines)] == [MAX_VALUES, 1]
+
+
+def test_sampled_trace_emits_its_spans(capsys):
+    metrics = Metrics(sample_rate=1.0)
+    with metrics.trace("youtube", path="/v3/search"):
+        with metrics.span("dynamodb_read", key="UC1"):
+            pass
+        with metrics.span("youtube") as span:
+            span.set(status_code=200)
+    lines = emitted(capsys)
+    trace = [record for record in records(lines) if "trace_id" in record][0]
+    assert trace["trace"] == "youtube"
+    assert trace["path"] == "/v3/search"
+    assert [span["name"] for span in trace["spans"]] == ["dynamodb_read", "youtube"]
+    assert trace["spans"][1]["status_code"] == 200
+    stages = [record for record in metric_records(lines) if "Stage" in record]
+    assert {record["Stage"] for record in stages} == {"dynamodb_read", "youtube"}
+
+
+def test_unsampled_trace_still_flushes_counts_but_no_spans(capsys):
+    metrics = Metrics(sample_rate=0.1, rng=lambda: 0.5)
+    with metrics.trace("live"):
+        metrics.count("ChannelResults", How='cache')
+        with metrics.span("channels"):
+            pass
+    lines = emitted(capsys)
+    assert [record.get("ChannelResults") for record in records(lines)] == [1]
+
+
+def test_spans_outside_a_trace_are_not_recorded(capsys):
+    metrics = Metrics()
+    with metrics.span("youtube") as span:
+        span.set(status_code=200)
+    metrics.flush()
+    assert emitted(capsys) == []
+
+
+def test_bound_work_on_other_threads_joins_the_trace(capsys):
+    metrics = Metrics()
+
+    def stage(name):
+        with metrics.span(name, thread=threading.get_ident()):
+            pass
+    with ThreadPoolExecutor(max_workers=4) as pool, metrics.trace("live"):
+        for future in [pool.submit(metrics.bind(stage), f"channel{index}") for index in range(8)]:
+            future.result()
+        pool.submit(stage, "unbound").result()
+    lines = emitted(capsys)
+    trace = [record for record in records(lines) if "trace_id" in record][0]
+    assert sorted(span["name"] for span in trace["spans"]) == [f"channel{index}" for index in range(8)]
+
+
+def test_null_metrics_record_nothing():
+    metrics = NullMetrics()
+    with metrics.trace("youtube"), metrics.span("youtube") as span:
+        metrics.count("Decisions", Decision='error')
+        metrics.timing("YoutubeLatency", 1.0)
+        span.set(status_code=500)
+    assert metrics.bind(len)("abc") == 3
+    metrics.flush()
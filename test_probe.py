@@ -0,0 +1,150 @@
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+from app import DEFAULT_PARAMS, are_there_videos, request_from_youtube_and_write_to_cache
+from app import reset_all, get_probes
+from chalicelib.probe import ProbeState, search_response, probe_key, RELOAD_INTERVAL, SEARCH_SAFETY_INTERVAL
+from conftest import FakeClock, MemoryStore, MemoryYoutubeDynamodb, broadcast_video
+
+CHANNEL = "UCprobe"
+
+
+class FakeYoutubeApi(BaseHTTPRequestHandler):
+    """Just enough of search.list and videos.list, driven by the broadcasts dict."""
+    broadcasts = {}
+    calls = collections.Counter()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path.endswith('/search'):
+            self.calls['search'] += 1
+            live = [video_id for video_id, state in self.broadcasts.items() if state == 'live']
+            body = {
+                "kind": "youtube#searchListResponse",
+                "pageInfo": {"totalResults": len(live), "resultsPerPage": 1},
+                "items": [{"id": {"kind": "youtube#video", "videoId": video_id},
+                           "snippet": {"channelId": query["channelId"], "title": "Live"}} for video_id in live[:1]]}
+        else:
+            self.calls['videos'] += 1
+            body = {"kind": "youtube#videoListResponse", "items": [
+                broadcast_video(video_id, self.broadcasts[video_id], CHANNEL)
+                for video_id in query["id"].split(",") if video_id in self.broadcasts]}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def youtube_api(monkeypatch, each_store):
+    monkeypatch.delenv('TABLE', raising=False)
+    reset_all()
+    FakeYoutubeApi.broadcasts = {}
+    FakeYoutubeApi.calls = collections.Counter()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeYoutubeApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}/youtube/v3"
+    yield MemoryYoutubeDynamodb(youtube_search_url=base + "/search", youtube_videos_url=base + "/videos")
+    server.shutdown()
+
+
+def refresh(backend):
+    params = dict(DEFAULT_PARAMS, channelId=CHANNEL)
+    return request_from_youtube_and_write_to_cache(params, youtube_and_dynamodb=backend)
+
+
+def test_synthesized_response_matches_search_shape():
+    result = search_response([{"id": "abc", "snippet": {"title": "t"}}])
+    assert result["kind"] == "youtube#searchListResponse"
+    assert result["items"][0]["id"]["videoId"] == "abc"
+    assert are_there_videos(result)
+    assert not are_there_videos(search_response([]))
+
+
+def test_known_live_broadcast_is_confirmed_without_search(youtube_api):
+    FakeYoutubeApi.broadcasts = {"live1": 'live'}
+    status, result, _, _, _ = refresh(youtube_api)
+    assert (status, FakeYoutubeApi.calls) == (200, {'search': 1})
+    status, result, where, _, _ = refresh(youtube_api)
+    assert status == 200
+    assert where == 'youtube'
+    assert result["items"][0]["id"]["videoId"] == "live1"
+    assert FakeYoutubeApi.calls == {'search': 1, 'videos': 1}
+
+
+def test_ended_broadcast_falls_back_to_search(youtube_api):
+    FakeYoutubeApi.broadcasts = {"live1": 'live'}
+    refresh(youtube_api)
+    FakeYoutubeApi.broadcasts = {"live1": 'ended'}
+    status, result, _, _, _ = refresh(youtube_api)
+    assert not are_there_videos(result)
+    assert FakeYoutubeApi.calls == {'search': 2, 'videos': 1}
+    assert get_probes().known(CHANNEL) == []
+
+
+def test_upcoming_broadcast_answers_offline_until_search_is_due(youtube_api):
+    FakeYoutubeApi.broadcasts = {"soon": 'upcoming'}
+    refresh(youtube_api)
+    get_probes().learn(CHANNEL, ["soon"])
+    status, result, _, _, _ = refresh(youtube_api)
+    assert status == 200 and not are_there_videos(result)
+    assert FakeYoutubeApi.calls == {'search': 1, 'videos': 1}
+    FakeYoutubeApi.broadcasts = {"soon": 'live'}
+    status, result, _, _, _ = refresh(youtube_api)
+    assert result["items"][0]["id"]["videoId"] == "soon"
+    assert FakeYoutubeApi.calls == {'search': 1, 'videos': 2}
+    FakeYoutubeApi.broadcasts = {"soon": 'ended', "later": 'upcoming'}
+    get_probes().learn(CHANNEL, ["later"])
+    # the last search is as old in the stored probe state as in ours, so the next load doesn't bring it back
+    searched = time.time() - SEARCH_SAFETY_INTERVAL - 1
+    stored = youtube_api.items[probe_key(CHANNEL)]
+    youtube_api.items[probe_key(CHANNEL)] = dict(stored, last_search={'N': str(searched)})
+    get_probes().last_search[CHANNEL] = searched
+    refresh(youtube_api)
+    assert FakeYoutubeApi.calls == {'search': 2, 'videos': 3}
+
+
+def test_ids_learnt_on_another_container_survive_and_reach_the_poller():
+    clock, store = FakeClock(), MemoryStore()
+    api, poller = ProbeState(clock), ProbeState(clock)
+    poller.load(CHANNEL, store)
+    api.learn(CHANNEL, ["upcoming1"], store)
+    # the poller's search merges into what the api stored rather than writing its own view over it
+    poller.learn_from_search(CHANNEL, search_response([{"id": "live1"}]), store)
+    assert sorted(json.loads(store.items[probe_key(CHANNEL)]['videos']['S'])) == ["live1", "upcoming1"]
+    assert sorted(poller.known(CHANNEL)) == ["live1", "upcoming1"]
+    api.learn(CHANNEL, ["upcoming2"], store)
+    poller.load(CHANNEL, store)
+    assert "upcoming2" not in poller.known(CHANNEL)
+    clock.now += RELOAD_INTERVAL
+    assert poller.stale(CHANNEL)
+    poller.load(CHANNEL, store)
+    assert "upcoming2" in poller.known(CHANNEL)
+
+
+def test_a_write_that_lost_the_race_is_retried_on_what_won():
+    clock, store = FakeClock(), MemoryStore()
+    api, poller = ProbeState(clock), ProbeState(clock)
+    api.learn(CHANNEL, ["upcoming1", "ended1"], store)
+    poller.load(CHANNEL, store)
+    stored = store.get_from_dynamodb
+
+    def read_then_lose(channel):
+        item = stored(channel)
+        store.get_from_dynamodb = stored
+        api.learn(CHANNEL, ["upcoming2"], store)
+        return item
+    store.get_from_dynamodb = read_then_lose
+    poller.learn_from_probe(CHANNEL, ["ended1"], {"items": []}, store)
+    assert sorted(json.loads(store.items[probe_key(CHANNEL)]['videos']['S'])) == ["upcoming1", "upcoming2"]
+    assert store.items[probe_key(CHANNEL)]['revision'] == {'N': '3'}
@@ -0,0 +1,21 @@
+from chalicelib.query import canonical_params, is_search_key, search_cache_key
+
+
+def test_canonical_params_drops_unknown_params_and_the_key():
+    params = {"q": " majlis ", "part": "snippet", "key": "secret", "callback": "jsonp", "_": "1", "pageToken": ""}
+    assert canonical_params(params) == {"part": "snippet", "q": "majlis"}
+
+
+def test_canonical_params_sorts_names_and_list_values():
+    canonical = canonical_params({"type": "video,channel", "part": "snippet, id", "order": "date"})
+    assert list(canonical) == ["order", "part", "type"]
+    assert canonical == {"order": "date", "part": "id,snippet", "type": "channel,video"}
+
+
+def test_search_cache_key_ignores_order_and_the_key():
+    key = search_cache_key({"q": "majlis", "part": "snippet,id", "key": "one"})
+    assert key == search_cache_key({"part": "id,snippet", "key": "two", "q": "majlis"})
+    assert key != search_cache_key({"part": "id,snippet", "q": "dua"})
+    assert is_search_key(key)
+    assert not is_search_key("UCupstream")
+    assert not is_search_key(None)
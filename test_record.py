@@ -0,0 +1,61 @@
+import json
+from chalicelib.probe import search_response
+from chalicelib.record import encode_item, read_item, RECORD_VERSION
+
+LIVE = search_response([{"id": "vid1", "snippet": {"title": "Majlis", "publishedAt": "2026-10-18T19:30:00Z"}}])
+OFFLINE = search_response([])
+
+
+def legacy_item(result):
+    return {
+        'channel': {'S': 'UCchannel'},
+        'time': {'N': '1000.25'},
+        'last_checked_time': {'N': '1100.75'},
+        'expiry_time': {'N': '1900.5'},
+        'result': {'S': json.dumps(result)}}
+
+
+def test_round_trip_keeps_the_essentials_outside_the_payload():
+    item = encode_item('UCchannel', LIVE, 1000.25, 1100.75, 1900.5, 'vid1')
+    assert item['v'] == {'N': str(RECORD_VERSION)}
+    assert item['time'] == {'N': '1000'}
+    assert item['live'] == {'BOOL': True}
+    assert item['videoId'] == {'S': 'vid1'}
+    assert item['title'] == {'S': 'Majlis'}
+    assert item['publishedAt'] == {'S': '2026-10-18T19:30:00Z'}
+    assert isinstance(item['payload']['B'], bytes)
+    stored = read_item(item)
+    assert (stored.create_time, stored.last_checked_time, stored.expiry_time) == (1000, 1100, 1900)
+    assert stored.live and stored.state == 'vid1'
+    assert stored.decoded is None  # nothing so far needed the payload
+    assert stored.result() == LIVE
+
+
+def test_missing_essentials_are_left_out():
+    item = encode_item('UCchannel', OFFLINE, 1000, 1000, 1900, 'offline')
+    assert item['live'] == {'BOOL': False}
+    assert not {'videoId', 'title', 'publishedAt'} & set(item)
+    assert read_item(item).result() == OFFLINE
+
+
+def test_legacy_string_items_are_read_as_before():
+    stored = read_item(legacy_item(LIVE))
+    assert stored.version == 1
+    assert (stored.create_time, stored.last_checked_time, stored.expiry_time) == (1000, 1100, 1900)
+    assert stored.live
+    assert stored.result() == LIVE
+    assert not read_item(legacy_item(OFFLINE)).live
+
+
+def test_items_without_a_result_are_not_records():
+    assert read_item(None) is None
+    assert read_item({'channel': {'S': 'UCchannel'}, 'lease_until': {'N': '1000'}}) is None
+    assert read_item({'channel': {'S': 'UCchannel'}, 'time': {'N': '1000'}, 'result': {'S': ''}}) is None
+
+
+def test_compact_item_is_smaller():
+    result = json.loads(json.dumps(LIVE))
+    result["items"][0]["snippet"]["description"] = "Live from the main hall " * 20
+    legacy = legacy_item(result)['result']['S'].encode('utf-8')
+    compact = encode_item('UCchannel', result, 1000, 1000, 1900, 'vid1')['payload']['B']
+    assert len(compact) < len(legacy) / 2
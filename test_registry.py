@@ -0,0 +1,75 @@
+import pytest
+from chalicelib.registry import ChannelRegistry, InvalidChannel, RegistryConflict, REGISTRY_KEY, RELOAD_INTERVAL
+from conftest import FakeClock, MemoryStore
+
+DEFAULTS = {"elc": "UCvjUFF1C3yO2KK17EjpiWGQ"}
+MAINHALL = "UCSSgKFdC-gRtxIgTrGGqP3g"
+
+
+def test_nothing_registered_leaves_the_defaults_to_the_caller():
+    store = MemoryStore()
+    registry = ChannelRegistry()
+    assert registry.snapshot(store) is None
+    assert registry.remove("elc", store) is None
+    assert REGISTRY_KEY not in store.items
+
+
+def test_first_registration_starts_from_the_defaults():
+    store = MemoryStore()
+    registry = ChannelRegistry()
+    assert registry.add("mainhall", MAINHALL, store, DEFAULTS) == dict(DEFAULTS, mainhall=MAINHALL)
+    assert registry.remove("elc", store, DEFAULTS) == {"mainhall": MAINHALL}
+    assert ChannelRegistry().snapshot(store) == {"mainhall": MAINHALL}
+
+
+@pytest.mark.parametrize("name, channel_id", [
+    ("main hall", MAINHALL), ("any_live", MAINHALL), ("", MAINHALL), ("mainhall", "UCshort"),
+    ("mainhall", None), ("mainhall", "XX" + MAINHALL[2:])])
+def test_invalid_channels_are_refused(name, channel_id):
+    store = MemoryStore()
+    with pytest.raises(InvalidChannel):
+        ChannelRegistry().add(name, channel_id, store, DEFAULTS)
+    assert store.items == {}
+
+
+def test_snapshot_is_reread_every_reload_interval():
+    clock = FakeClock()
+    store = MemoryStore()
+    registry = ChannelRegistry(clock=clock)
+    other = ChannelRegistry(clock=clock)
+    assert registry.snapshot(store) is None
+    snapshot = other.add("mainhall", MAINHALL, store, DEFAULTS)
+    clock.now += RELOAD_INTERVAL - 1
+    assert registry.snapshot(store) is None
+    assert store.reads == 2
+    clock.now += 1
+    assert registry.snapshot(store) == snapshot
+    other.remove("mainhall", store)
+    # a snapshot handed out earlier is never changed in place
+    assert snapshot == dict(DEFAULTS, mainhall=MAINHALL)
+
+
+def test_changes_racing_on_other_containers_are_both_kept():
+    store = MemoryStore()
+    first, second = ChannelRegistry(), ChannelRegistry()
+    first.add("mainhall", MAINHALL, store, DEFAULTS)
+    second.snapshot(store)
+    ladies = "UC" + "l" * 22
+    original = store.get_from_dynamodb
+
+    def read_then_race(key):
+        item = original(key)
+        # the other container's change lands between this read and the write that follows it
+        store.get_from_dynamodb = original
+        second.add("ladies", ladies, store, DEFAULTS)
+        return item
+    store.get_from_dynamodb = read_then_race
+    assert first.remove("elc", store, DEFAULTS) == {"mainhall": MAINHALL, "ladies": ladies}
+    assert ChannelRegistry().snapshot(store) == {"mainhall": MAINHALL, "ladies": ladies}
+
+
+def test_gives_up_when_every_write_loses():
+    store = MemoryStore()
+    store.conditional_put_to_dynamodb = lambda item, revision: False
+    with pytest.raises(RegistryConflict):
+        ChannelRegistry().add("mainhall", MAINHALL, store, DEFAULTS)
@@ -0,0 +1,121 @@
+import threading
+import app
+from app import DEFAULT_PARAMS, SqliteYoutubeDynamodb, decode_item, do_search_on_youtube, dynamodb_item
+from chalicelib.probe import search_response
+from chalicelib.store import SqliteStore, MAX_VARIABLES
+from conftest import FakeClock, new_store
+
+CHANNEL = "UCstore"
+LIVE = search_response([{"id": "vid1", "snippet": {"title": "Live"}}])
+
+
+def test_items_round_trip_with_their_binary_payload(path):
+    store = SqliteStore(path, "node")
+    item = dynamodb_item(CHANNEL, LIVE, 1000, 1100)
+    store.put_to_dynamodb(item)
+    assert store.get_from_dynamodb(CHANNEL) == item
+    assert decode_item(store.get_from_dynamodb(CHANNEL))[0] == LIVE
+    assert store.get_from_dynamodb("UCnothing") is None
+    assert store.db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_batch_reads_and_writes_past_the_query_limit(path):
+    store = SqliteStore(path, "node")
+    channels = ["UC%d" % (index,) for index in range(MAX_VARIABLES + 10)]
+    store.batch_write_to_dynamodb([dynamodb_item(channel, LIVE, 1000, 1000) for channel in channels])
+    items = store.batch_get_from_dynamodb(channels + ["UCnothing"])
+    assert sorted(items) == sorted(channels)
+    assert store.batch_get_from_dynamodb([]) == {}
+
+
+def test_refresh_lease_is_held_until_the_item_is_put_back_or_expires(path):
+    clock = FakeClock()
+    store = SqliteStore(path, "node", clock)
+    other = SqliteStore(path, "other node", clock)
+    assert store.acquire_refresh_lease(CHANNEL, 30, 0)
+    assert not other.acquire_refresh_lease(CHANNEL, 30, 0)
+    # a lease alone is not a stored result
+    assert decode_item(store.get_from_dynamodb(CHANNEL))[0] is None
+    store.put_to_dynamodb(dynamodb_item(CHANNEL, LIVE, 1000, 1000))
+    assert other.acquire_refresh_lease(CHANNEL, 30, 1000)
+    assert other.get_from_dynamodb(CHANNEL)['lease_owner'] == {'S': "other node"}
+    clock.now += 31
+    assert store.acquire_refresh_lease(CHANNEL, 30, 1000)
+
+
+def test_no_lease_once_the_item_was_checked_after_the_caller_read_it(each_store):
+    store = new_store()
+    store.put_to_dynamodb(dynamodb_item(CHANNEL, LIVE, 1000, 1000))
+    seen = decode_item(store.get_from_dynamodb(CHANNEL))[2]
+    # another node reads the same stale item, refreshes it and puts it back, clearing its lease
+    assert store.acquire_refresh_lease(CHANNEL, 30, seen)
+    store.put_to_dynamodb(dynamodb_item(CHANNEL, LIVE, 1000, 1200))
+    assert not store.acquire_refresh_lease(CHANNEL, 30, seen)
+    assert store.acquire_refresh_lease(CHANNEL, 30, 1200)
+
+
+def test_one_of_many_concurrent_workers_gets_the_lease(path):
+    stores = [SqliteStore(path, f"node{index}") for index in range(10)]
+    barrier = threading.Barrier(len(stores))
+    acquired = []
+
+    def acquire(store):
+        barrier.wait()
+        acquired.append(store.acquire_refresh_lease(CHANNEL, 30, 0))
+    threads = [threading.Thread(target=acquire, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(acquired) == [False] * 9 + [True]
+
+
+def test_key_usage_adds_up_across_workers(path):
+    stores = [SqliteStore(path, f"node{index}") for index in range(4)]
+    threads = [
+        threading.Thread(target=lambda store=store: [store.record_key_usage("apikey#a", 100, 0) for _ in range(5)])
+        for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stores[0].record_key_usage("apikey#a", 0, 1, quarantined_until=2000)
+    item = stores[1].get_from_dynamodb("apikey#a")
+    assert (item['spent'], item['failures'], item['quarantined_until']) == ({'N': '2000'}, {'N': '1'}, {'N': '2000'})
+
+
+def test_failures_are_answered_as_nothing_stored(tmp_path):
+    store = SqliteStore(str(tmp_path / "store.db"), "node")
+    store.db.execute('DROP TABLE items')
+    assert store.get_from_dynamodb(CHANNEL) is None
+    assert store.batch_get_from_dynamodb([CHANNEL]) is None
+    assert store.put_to_dynamodb(dynamodb_item(CHANNEL, LIVE, 1000, 1000)) is None
+    assert store.acquire_refresh_lease(CHANNEL, 30, 0)
+
+
+class Worker(SqliteYoutubeDynamodb):
+    """One worker process's backend: youtube always live, counted."""
+    searches = 0
+
+    def request_from_youtube(self, params, key_origin):
+        Worker.searches += 1
+        return 200, LIVE
+
+    def request_videos_from_youtube(self, params, key_origin):
+        return 200, {"kind": "youtube#videoListResponse", "items": []}
+
+
+def test_workers_on_one_host_share_what_one_of_them_fetched(path, monkeypatch):
+    monkeypatch.setenv('SQLITE_PATH', path)
+    assert isinstance(app.storage_backend(), SqliteYoutubeDynamodb)
+    monkeypatch.delenv('SQLITE_PATH')
+    assert type(app.storage_backend()) is app.RealYoutubeDynamodb
+    app.reset_all()
+    Worker.searches = 0
+    params = dict(DEFAULT_PARAMS, channelId=CHANNEL)
+    assert do_search_on_youtube(params, Worker(path))[2] == 'youtube'
+    # another worker starts with its own empty cache
+    app.reset_all()
+    status_code, result, how, _, _ = do_search_on_youtube(params, Worker(path))
+    assert (status_code, result, how) == (200, LIVE, 'dynamodb')
+    assert Worker.searches == 1
@@ -0,0 +1,233 @@
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import pytest
+from chalice.config import Config
+from chalice.local import LocalGateway
+import app
+from app import DEFAULT_PARAMS, RealYoutubeDynamodb, dynamodb_item, request_from_youtube_and_write_to_cache
+from chalicelib.breaker import CircuitBreaker, CircuitOpen, CLOSED, OPEN, HALF_OPEN
+from chalicelib.probe import search_response
+from conftest import FakeClock, MemoryYoutubeDynamodb
+
+pytestmark = pytest.mark.usefixtures('each_store')
+
+CHANNEL = "UCupstream"
+LIVE = search_response([{"id": "vid1", "snippet": {"title": "Live"}}])
+
+
+class FlakyUpstream(BaseHTTPRequestHandler):
+    """Answers youtube GETs and dynamodb POSTs alike, after `delay` seconds and with `status`.
+
+    `dynamodb_delay`, when set, holds up the POSTs alone.
+    """
+    delay = 0
+    dynamodb_delay = None
+    status = 200
+    hits = collections.Counter()
+
+    def do_GET(self):
+        self.answer(json.dumps(LIVE), self.delay)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.answer('{}', self.delay if self.dynamodb_delay is None else self.dynamodb_delay)
+
+    def answer(self, body, delay):
+        self.hits[self.command] += 1
+        time.sleep(delay)
+        try:
+            data = body.encode()
+            self.send_response(self.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass  # the client gave up waiting
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch, executor):
+    monkeypatch.delenv('TABLE', raising=False)
+    app.reset_all()
+    FlakyUpstream.delay = 0
+    FlakyUpstream.dynamodb_delay = None
+    FlakyUpstream.status = 200
+    FlakyUpstream.hits = collections.Counter()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def youtube_backend(url, timeout=(0.2, 0.2)):
+    return MemoryYoutubeDynamodb(
+        youtube_search_url=url + "/search", youtube_videos_url=url + "/videos", youtube_timeout=timeout)
+
+
+def refresh(backend):
+    # as the poller does: straight to youtube whatever the last check was
+    item = backend.get_from_dynamodb(CHANNEL)
+    decoded, create_time, last_checked_time, expiry_time = app.decode_item(item)
+    return request_from_youtube_and_write_to_cache(
+        dict(DEFAULT_PARAMS, channelId=CHANNEL), decoded, create_time, 0, expiry_time, backend)
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def test_breaker_opens_after_consecutive_failures_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=10, clock=clock)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    breaker.record(False)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: 1)
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()  # one trial at a time
+    breaker.record(False)
+    assert breaker.state == OPEN
+    clock.now += 10
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.state == CLOSED
+
+
+def test_breaker_counts_slow_calls_and_failed_results_but_not_expected_errors():
+    clock = FakeClock()
+    breaker = CircuitBreaker('test', failure_threshold=1, slow_call_seconds=1, clock=clock)
+
+    def slow():
+        clock.now += 2
+        return 'answer'
+    assert breaker.call(slow) == 'answer'
+    assert breaker.state == OPEN
+
+    breaker = CircuitBreaker('test', failure_threshold=1, clock=clock)
+    with pytest.raises(KeyError):
+        breaker.call({}.__getitem__, 'missing', expected=lambda exc: isinstance(exc, KeyError))
+    assert breaker.state == CLOSED
+    assert breaker.call(lambda: 500, failed=lambda status: status >= 500) == 500
+    assert breaker.state == OPEN
+
+
+def test_hung_youtube_serves_stored_result_within_the_read_timeout(upstream):
+    backend = youtube_backend(upstream)
+    stored_at = time.time() - 3600
+    backend.items[CHANNEL] = dynamodb_item(CHANNEL, LIVE, stored_at, stored_at)
+    FlakyUpstream.delay = 2
+    for _ in range(app.BREAKER_FAILURES):
+        (status_code, result, how, info, key_origin), elapsed = timed(refresh, backend)
+        assert elapsed < 1
+        assert (status_code, result, how) == (200, LIVE, 'dynamodb')
+        assert info.startswith("stale for 360")
+    hits = FlakyUpstream.hits['GET']
+    assert hits == app.BREAKER_FAILURES
+    # now the circuit is open and youtube isn't even tried
+    (status_code, result, how, info, key_origin), elapsed = timed(refresh, backend)
+    assert elapsed < 0.1
+    assert (status_code, result) == (200, LIVE)
+    assert "youtube circuit open" in info
+    assert FlakyUpstream.hits['GET'] == hits
+
+
+def test_hung_websub_hub_is_bounded_and_counts_against_the_youtube_circuit(upstream):
+    backend = youtube_backend(upstream)
+    FlakyUpstream.delay = 2
+    start = time.time()
+    for _ in range(app.BREAKER_FAILURES):
+        with pytest.raises(app.upstream_errors()):
+            backend.post_to_hub(upstream + "/hub", {"hub.mode": "subscribe"})
+    assert time.time() - start < 0.3 * app.BREAKER_FAILURES
+    assert backend.youtube_breaker.state == OPEN
+
+
+def test_failing_youtube_falls_back_to_last_good_result(upstream):
+    backend = youtube_backend(upstream)
+    assert refresh(backend)[:3] == (200, LIVE, 'youtube')
+    backend.items.clear()
+    FlakyUpstream.status = 500
+    # the probe and the search that follows it both fail, so this trips within BREAKER_FAILURES refreshes
+    for _ in range(app.BREAKER_FAILURES):
+        status_code, result, how, info, key_origin = refresh(backend)
+        assert (status_code, result, how) == (200, LIVE, 'stale')
+        assert info.startswith("stale for")
+    assert backend.youtube_breaker.state == OPEN
+    hits = FlakyUpstream.hits['GET']
+    assert refresh(backend)[:3] == (200, LIVE, 'stale')
+    assert FlakyUpstream.hits['GET'] == hits
+
+
+def test_live_is_bounded_by_its_deadline_and_serves_last_good(upstream):
+    backend = youtube_backend(upstream, timeout=(0.2, 1))
+    with mock.patch.dict('app.CHANNELS', {"elc": CHANNEL}, clear=True), \
+            mock.patch('app.YOUTUBE_AND_DYNAMODB', backend), mock.patch('app.LIVE_DEADLINE', 0.3):
+        gateway = LocalGateway(app.app, Config())
+        response = gateway.handle_request('GET', '/live', {'Host': 'localhost'}, b'')
+        assert json.loads(response['body'])["elc"]["how"] == 'youtube'
+        app.CACHE.invalidate(CHANNEL)
+        backend.items.clear()
+        FlakyUpstream.delay = 2
+        start = time.time()
+        response = gateway.handle_request('GET', '/live', {'Host': 'localhost'}, b'')
+        assert time.time() - start < 0.8
+    body = json.loads(response['body'])
+    assert body["elc"]["status_code"] == 200
+    assert body["elc"]["how"] == 'stale'
+    assert body["elc"]["result"] == LIVE
+    assert "no result within 0.3 seconds" in body["elc"]["extra_info"]
+    assert response['headers']['Cache-Control'] == 'no-cache'
+
+
+def test_live_answers_within_its_deadline_from_a_hung_dynamodb(upstream, monkeypatch):
+    monkeypatch.setenv('TABLE', 'table')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-2')
+    backend = RealYoutubeDynamodb(
+        youtube_search_url=upstream + "/search", youtube_videos_url=upstream + "/videos", youtube_timeout=(0.2, 0.2),
+        dynamodb_endpoint_url=upstream, dynamodb_timeout=(0.2, 0.2))
+    FlakyUpstream.dynamodb_delay = 2
+    # the registry read, the prefetch, every channel's reads and the flush all share the one deadline
+    with mock.patch('app.YOUTUBE_AND_DYNAMODB', backend), mock.patch('app.LIVE_DEADLINE', 0.5):
+        gateway = LocalGateway(app.app, Config())
+        response, elapsed = timed(gateway.handle_request, 'GET', '/live', {'Host': 'localhost'}, b'')
+    assert elapsed < 0.8
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert set(body) == set(app.CHANNELS) | {"any_live"}
+    assert all(body[channel]["how"] == 'timeout' for channel in app.CHANNELS)
+
+
+def test_hung_dynamodb_is_tried_dynamodb_max_attempts_times_and_trips_its_circuit(upstream, monkeypatch):
+    monkeypatch.setenv('TABLE', 'table')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-2')
+    backend = RealYoutubeDynamodb(dynamodb_endpoint_url=upstream, dynamodb_timeout=(0.2, 0.2))
+    FlakyUpstream.delay = 2
+    for _ in range(app.BREAKER_FAILURES):
+        item, elapsed = timed(backend.get_from_dynamodb, CHANNEL)
+        assert item is None
+        assert elapsed < 0.2 * app.DYNAMODB_MAX_ATTEMPTS + 0.3
+    hits = FlakyUpstream.hits['POST']
+    assert hits == app.DYNAMODB_MAX_ATTEMPTS * app.BREAKER_FAILURES
+    assert backend.dynamodb_breaker.state == OPEN
+    assert timed(backend.get_from_dynamodb, CHANNEL)[1] < 0.1
+    assert backend.acquire_refresh_lease(CHANNEL, 30, 0)  # fails open, as before
+    assert FlakyUpstream.hits['POST'] == hits
@@ -0,0 +1,261 @@
+import collections
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+import requests
+from chalice.config import Config
+from chalice.local import create_local_server
+import app
+from app import decode_item, dynamodb_item, next_check_time
+from chalicelib.probe import search_response
+from chalicelib.websub import Subscriptions, parse_feed, topic_url, verify_signature, websub_key, SAFETY_INTERVAL
+from conftest import MemoryYoutubeDynamodb, broadcast_video
+
+pytestmark = pytest.mark.usefixtures('each_store')
+
+CHANNEL = "UCwebsub"
+SECRET = "s3cret"
+
+
+def atom_entry(video_id, channel=CHANNEL):
+    return f"""<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns="http://www.w3.org/2005/Atom">
+  <link rel="hub" href="https://pubsubhubbub.appspot.com"/>
+  <link rel="self" href="{topic_url(channel)}"/>
+  <title>YouTube video feed</title>
+  <updated>2026-10-18T18:01:00.000000+00:00</updated>
+  <entry>
+    <id>yt:video:{video_id}</id>
+    <yt:videoId>{video_id}</yt:videoId>
+    <yt:channelId>{channel}</yt:channelId>
+    <title>Broadcast {video_id}</title>
+    <link rel="alternate" href="https://www.youtube.com/watch?v={video_id}"/>
+    <author><name>Channel</name><uri>https://www.youtube.com/channel/{channel}</uri></author>
+    <published>2026-10-18T18:00:00+00:00</published>
+    <updated>2026-10-18T18:01:00.000000+00:00</updated>
+  </entry>
+</feed>"""
+
+
+def atom_deleted(video_id, channel=CHANNEL):
+    return f"""<feed xmlns:at="http://purl.org/atompub/tombstones/1.0" xmlns="http://www.w3.org/2005/Atom">
+  <at:deleted-entry ref="yt:video:{video_id}" when="2026-10-18T20:00:00+00:00">
+    <link href="https://www.youtube.com/watch?v={video_id}"/>
+    <at:by><name>Channel</name><uri>https://www.youtube.com/channel/{channel}</uri></at:by>
+  </at:deleted-entry>
+</feed>"""
+
+
+class FakeVideosApi(BaseHTTPRequestHandler):
+    broadcasts = {}
+    calls = collections.Counter()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.calls[url.path.rpartition('/')[2]] += 1
+        ids = parse_qs(url.query).get('id', [''])[0].split(',')
+        body = {"kind": "youtube#videoListResponse", "items": [
+            broadcast_video(video_id, self.broadcasts[video_id], CHANNEL) for video_id in ids if video_id in self.broadcasts]}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInHub(BaseHTTPRequestHandler):
+    """A WebSub hub that verifies subscriptions at once and publishes whatever a test hands it."""
+    subscriptions = {}
+    requests = []
+
+    def do_POST(self):
+        form = {name: values[0] for name, values in parse_qs(
+            self.rfile.read(int(self.headers['Content-Length'])).decode()).items()}
+        self.requests.append(form)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        threading.Thread(target=self.verify, args=(form,)).start()
+
+    def verify(self, form):
+        challenge = f"challenge-{time.time()}"
+        r = requests.get(form['hub.callback'], params={
+            'hub.mode': form['hub.mode'], 'hub.topic': form['hub.topic'], 'hub.challenge': challenge,
+            'hub.lease_seconds': form['hub.lease_seconds']})
+        if r.status_code == 200 and r.text == challenge:
+            self.subscriptions[form['hub.topic']] = (form['hub.callback'], form['hub.secret'])
+
+    @classmethod
+    def publish(cls, topic, body, secret=None):
+        callback, subscribed_secret = cls.subscriptions[topic]
+        body = body.encode()
+        signature = hmac.new((secret or subscribed_secret).encode(), body, hashlib.sha1).hexdigest()
+        return requests.post(callback, data=body, headers={
+            'Content-Type': 'application/atom+xml', 'X-Hub-Signature': f"sha1={signature}"})
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+@pytest.fixture
+def websub(monkeypatch):
+    monkeypatch.delenv('TABLE', raising=False)
+    app.reset_all()
+    FakeVideosApi.broadcasts = {}
+    FakeVideosApi.calls = collections.Counter()
+    StandInHub.subscriptions = {}
+    StandInHub.requests = []
+    youtube = ThreadingHTTPServer(('127.0.0.1', 0), FakeVideosApi)
+    hub = ThreadingHTTPServer(('127.0.0.1', 0), StandInHub)
+    callback = create_local_server(app.app, Config(), '127.0.0.1', 0)
+    youtube_url = serve(youtube)
+    hub_url = serve(hub)
+    callback_url = serve(callback.server)
+    backend = MemoryYoutubeDynamodb(
+        youtube_search_url=youtube_url + "/search", youtube_videos_url=youtube_url + "/videos")
+    monkeypatch.setattr(app, 'YOUTUBE_AND_DYNAMODB', backend)
+    monkeypatch.setattr(app, 'CHANNELS', {"elc": CHANNEL})
+    monkeypatch.setattr(app, 'SUBSCRIPTIONS', Subscriptions(callback_url + "/websub", SECRET, hub_url + "/subscribe"))
+    yield backend
+    for server in (youtube, hub, callback.server):
+        server.shutdown()
+
+
+def subscribe(backend):
+    assert app.get_subscriptions().renew(app.CHANNELS.values(), backend) == {CHANNEL: 202}
+    for _ in range(100):
+        if topic_url(CHANNEL) in StandInHub.subscriptions:
+            return
+        time.sleep(0.01)
+    raise AssertionError("hub never verified the subscription")
+
+
+def test_parses_new_and_deleted_entries():
+    assert parse_feed(atom_entry("vid1")) == [("vid1", CHANNEL, False)]
+    assert parse_feed(atom_deleted("vid1")) == [("vid1", CHANNEL, True)]
+
+
+def test_signature_must_match_secret_and_body():
+    signature = "sha1=" + hmac.new(b"secret", b"body", hashlib.sha1).hexdigest()
+    assert verify_signature("secret", b"body", signature)
+    assert verify_signature("secret", b"body", signature.upper().replace("SHA1", "sha1"))
+    assert not verify_signature("other", b"body", signature)
+    assert not verify_signature("secret", b"changed", signature)
+    assert not verify_signature("secret", b"body", "md5=" + hmac.new(b"secret", b"body", hashlib.md5).hexdigest())
+    assert not verify_signature("secret", b"body", None)
+    assert not verify_signature(None, b"body", signature)
+
+
+def test_subscribes_through_the_hub_and_records_the_lease(websub):
+    subscribe(websub)
+    form = StandInHub.requests[0]
+    assert form['hub.mode'] == 'subscribe'
+    assert form['hub.topic'] == topic_url(CHANNEL)
+    assert form['hub.secret'] == SECRET
+    assert app.get_subscriptions().active(CHANNEL, websub)
+    assert float(websub.items[websub_key(CHANNEL)]['lease_until']['N']) > time.time() + 24 * 3600
+    # nothing to renew until the lease is close to running out
+    assert app.get_subscriptions().renew(app.CHANNELS.values(), websub) == {}
+
+
+def test_refuses_verification_it_did_not_ask_for(websub):
+    callback = app.get_subscriptions().callback_url
+    params = {'hub.mode': 'subscribe', 'hub.topic': topic_url(CHANNEL), 'hub.challenge': 'x', 'hub.lease_seconds': '100'}
+    assert requests.get(callback, params=params).status_code == 404
+    params['hub.topic'] = topic_url("UCsomeoneelse")
+    assert requests.get(callback, params=params).status_code == 404
+    assert not app.get_subscriptions().active(CHANNEL, websub)
+
+
+def test_only_confirms_an_unsubscribe_it_asked_for(websub):
+    subscribe(websub)
+    callback = app.get_subscriptions().callback_url
+    params = {'hub.mode': 'unsubscribe', 'hub.topic': topic_url(CHANNEL), 'hub.challenge': 'x'}
+    assert requests.get(callback, params=params).status_code == 404
+    assert app.get_subscriptions().active(CHANNEL, websub)
+    assert app.get_subscriptions().subscribe(CHANNEL, websub, mode='unsubscribe') == 202
+    for _ in range(100):
+        if not app.get_subscriptions().active(CHANNEL, websub):
+            return
+        time.sleep(0.01)
+    raise AssertionError("the unsubscribe we asked for was never verified")
+
+
+def test_pushed_broadcast_is_checked_with_videos_list_and_stored(websub):
+    subscribe(websub)
+    FakeVideosApi.broadcasts = {"vid1": 'live'}
+    response = StandInHub.publish(topic_url(CHANNEL), atom_entry("vid1"))
+    assert response.status_code == 200
+    assert response.json() == {"vid1": 'live'}
+    assert FakeVideosApi.calls == {'videos': 1}
+    result = decode_item(websub.items[CHANNEL])[0]
+    assert result["items"][0]["id"]["videoId"] == "vid1"
+    assert app.cached(CHANNEL).summary["videoId"] == "vid1"
+
+    FakeVideosApi.broadcasts = {"vid1": 'ended'}
+    assert StandInHub.publish(topic_url(CHANNEL), atom_entry("vid1")).json() == {"vid1": 'sticky'}
+    assert decode_item(websub.items[CHANNEL])[0]["items"]
+    # once it is past its expiry_time
+    fetched = time.time() - app.BEFORE_GOING_OFFLINE - 1
+    websub.items[CHANNEL] = dynamodb_item(CHANNEL, result, fetched, fetched)
+    assert StandInHub.publish(topic_url(CHANNEL), atom_entry("vid1")).json() == {"vid1": 'ended'}
+    assert not decode_item(websub.items[CHANNEL])[0]["items"]
+    assert not app.cached(CHANNEL).summary["live"]
+
+
+def test_upcoming_broadcast_is_remembered_without_touching_the_channel(websub):
+    subscribe(websub)
+    FakeVideosApi.broadcasts = {"vid2": 'upcoming'}
+    assert StandInHub.publish(topic_url(CHANNEL), atom_entry("vid2")).json() == {"vid2": 'upcoming'}
+    assert CHANNEL not in websub.items
+    assert app.get_probes().known(CHANNEL) == ["vid2"]
+    assert app.get_schedules().get(CHANNEL).scheduled
+
+
+def test_deleted_live_broadcast_takes_the_channel_offline(websub):
+    subscribe(websub)
+    fetched = time.time() - app.BEFORE_GOING_OFFLINE - 1
+    websub.items[CHANNEL] = dynamodb_item(CHANNEL, search_response([{"id": "vid3"}]), fetched, fetched)
+    assert StandInHub.publish(topic_url(CHANNEL), atom_deleted("vid3")).json() == {"vid3": 'ended'}
+    assert not decode_item(websub.items[CHANNEL])[0]["items"]
+
+
+def test_forced_video_outlives_a_pushed_end_until_its_expiry(websub):
+    subscribe(websub)
+    app.force_video_id("vid4", "elc", 3600, youtube_and_dynamodb=websub)
+    FakeVideosApi.broadcasts = {"vid4": 'ended'}
+    assert StandInHub.publish(topic_url(CHANNEL), atom_entry("vid4")).json() == {"vid4": 'sticky'}
+    result, _, _, expiry_time = decode_item(websub.items[CHANNEL])
+    assert result["items"][0]["id"]["videoId"] == "vid4"
+    assert expiry_time > time.time() + 3000
+
+
+def test_ignores_notifications_with_a_bad_signature(websub):
+    subscribe(websub)
+    FakeVideosApi.broadcasts = {"vid1": 'live'}
+    response = StandInHub.publish(topic_url(CHANNEL), atom_entry("vid1"), secret="wrong")
+    assert response.status_code == 202
+    assert not FakeVideosApi.calls
+    assert CHANNEL not in websub.items
+
+
+def test_polling_becomes_a_safety_net_while_subscribed(websub):
+    since = time.time() - 600
+    assert next_check_time(CHANNEL, since, False, websub) < time.time()
+    subscribe(websub)
+    assert next_check_time(CHANNEL, since, False, websub) == since + SAFETY_INTERVAL
+    assert next_check_time(CHANNEL, since, True, websub) == since + app.DYNAMODB_IF_STREAM_TTL
@@ -8,38 +8,90 @@ function wp_hujjat_live_stream_put_offline_info(channel) {
     jQuery("div#wp_hujjat_live_stream_" + channel).addClass('wp-hujjat-live-stream-offline');
 }
 
+var wp_hujjat_live_stream_last_data = null;
+
+function wp_hujjat_live_stream_put_online_info(channel) {
+    wp_hujjat_live_stream_log(channel + ' live stream is online');
+    jQuery("div#wp_hujjat_live_stream_" + channel).removeClass('wp-hujjat-live-stream-offline');
+    jQuery("div#wp_hujjat_live_stream_" + channel).addClass('wp-hujjat-live-stream-online');
+}
+
+function wp_hujjat_live_stream_wait(channels, etag) {
+    /* the api holds the request until a channel changes state or the timeout passes (304) */
+    url = "https://api.poc.hujjat.org/youtube/live/wait?timeout=27";
+    if (etag) {
+        url += "&etag=" + encodeURIComponent(etag);
+    }
+    jQuery.ajax({url: url, dataType: "json"}).done(function(data, textStatus, jqXHR) {
+        if (jqXHR.status == 304 || !data) {
+            wp_hujjat_live_stream_wait(channels, etag);
+            return;
+        }
+        for (var key in data) {
+            if (jQuery.inArray(key, channels) == -1) {
+                continue;
+            }
+            if (data[key]["status_code"] >= 200 && data[key]["status_code"] <= 299 && data[key]["live"]) {
+                wp_hujjat_live_stream_put_online_info(key);
+            }
+            else {
+                wp_hujjat_live_stream_put_offline_info(key);
+            }
+        }
+        wp_hujjat_live_stream_wait(channels, data["version"]);
+    }).fail(function() {
+        wp_hujjat_live_stream_log("failure waiting on youtube api");
+        setTimeout(function() { wp_hujjat_live_stream_wait(channels, etag);}, 60000);
+    });
+}
+
 function wp_hujjat_live_stream_is_any_stream_online(channels) {
     var params = {};
-    url = "https://api.poc.hujjat.org/youtube/live/";
+    url = "https://api.poc.hujjat.org/youtube/live/compact";
     let offline_channels = [];
-    jQuery.getJSON(url, function(data) {
+    /* ifModified makes jQuery send If-None-Match with the last ETag; the api answers 304 if nothing changed */
+    jQuery.ajax({url: url, dataType: "json", ifModified: true}).done(function(data, textStatus) {
+        if (textStatus == "notmodified" || !data) {
+            wp_hujjat_live_stream_log('live status not modified');
+            data = wp_hujjat_live_stream_last_data || {};
+        }
+        else {
+            wp_hujjat_live_stream_last_data = data;
+        }
         wp_hujjat_live_stream_log('going through the channels');
 
         for(var key in data) {
             if (jQuery.inArray(key, channels) != -1) {
-                if (data[key]["status_code"] >= 200 || data[key]["status_code"] <= 299) {
+                if (data[key]["status_code"] >= 200 && data[key]["status_code"] <= 299) {
                     wp_hujjat_live_stream_log("got 2xx for " + key);
-                    if (data[key]["result"]["items"].length > 0) {
-                        let videoid = data[key]["result"]["items"][0]["id"]["videoId"];
-                        wp_hujjat_live_stream_log(key + ' live stream is online');
-                        jQuery("div#wp_hujjat_live_stream_" + key).removeClass('wp-hujjat-live-stream-offline');
-                        jQuery("div#wp_hujjat_live_stream_" + key).addClass('wp-hujjat-live-stream-online');
+                    if (data[key]["live"]) {
+                        wp_hujjat_live_stream_put_online_info(key);
                     }
                     else {
                         wp_hujjat_live_stream_put_offline_info(key);
                         offline_channels.push(key);
                     }
                 }
+                else {
+                    offline_channels.push(key);
+                }
             }
         }
         setTimeout(function() { wp_hujjat_live_stream_is_any_stream_online(offline_channels);}, 60000);
     }).fail(function() {
         wp_hujjat_live_stream_log("failure querying youtube api");
-        setTimeout(function() { wp_hujjat_live_stream_is_any_stream_online(offline_channels);}, 60000);
+        setTimeout(function() { wp_hujjat_live_stream_is_any_stream_online(channels);}, 60000);
     });
 }
 
 jQuery(document).ready(function($) {
     /* live stream widget hiding */
-    wp_hujjat_live_stream_is_any_stream_online(["mainhall", "elc", "ladies"]);
+    let channels = ["mainhall", "elc", "ladies"];
+    let settings = window.wp_hujjat_live_stream_settings || {};
+    if (settings.mode == "wait") {
+        wp_hujjat_live_stream_wait(channels, null);
+    }
+    else {
+        wp_hujjat_live_stream_is_any_stream_online(channels);
+    }
 });
\ No newline at end of file
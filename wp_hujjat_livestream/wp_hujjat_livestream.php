@@ -3,7 +3,7 @@
  * Plugin Name: Hujjat Livestream
  * Plugin URI:  https://github.com/zaheerm/hujjatytproxy/wp_hujjat_livestream
  * Description: Module to allow real-time status of live streams at KSIMC of London
- * Version:     1.0.3
+ * Version:     1.0.6
  * Author:      Zaheer Abbas Merali
  * Author URI:  https://zaheer.merali.org
  * Text Domain: 
@@ -18,6 +18,11 @@ if ( ! defined( 'WPINC' ) ) {
 
 function wp_hujjat_livesteam_enqueue_scripts( $hook ) {
     wp_enqueue_script('wp_hujjat_livestream.js', plugins_url( 'wp_hujjat_livestream.js', __FILE__), array('jquery'));
+    // 'wait' long-polls /live/wait so a stream going live shows within seconds, at several times the cost
+    // per viewer of 'poll', which checks every minute (see README.md)
+    wp_localize_script('wp_hujjat_livestream.js', 'wp_hujjat_live_stream_settings', array(
+        'mode' => get_option('wp_hujjat_livestream_mode', 'poll'),
+    ));
 }
 add_action( 'wp_enqueue_scripts', 'wp_hujjat_livesteam_enqueue_scripts' );
 ?>
\ No newline at end of file